@@ -2,15 +2,30 @@ import subprocess
 import os
 from easygui import *
 import sys
+import multiprocessing
 from multiprocessing import Process
 import re
 import numpy
+import heapq
 import random
 import string
 import math
 from collections import OrderedDict
 import shutil
 from scipy.interpolate import *
+import batch_fit_module
+import triples_enum_module
+import triples_queue_module
+import triples_checkpoint_module
+import triples_scoring_module
+import triples_results_module
+import triples_hits_module
+import triples_progress_module
+import triples_store_module
+import triples_timing_module
+import program_call_module
+import triples_workers_module
+import triples_sandbox_module
 
 """"
 Python Triples Fitter
@@ -28,79 +43,152 @@ This should be able to do a standard fitting run on a normal species case withou
 autofit_NS is called with the appropriate arguments.  Currently isotopologue searches and fit refinements aren't included on
 completion; those will probably be separated modules later.
 
+-autofit_NS takes an engine argument.  engine="batch" builds a linear model of the transitions once per job and screens the
+triples with batch_fit_module before they're fit with SPFIT (only A, B and C that aren't fixed are solved for in the
+screen, distortions stay at their input values); the default engine="spfit" fits every triple with SPFIT.
 
-"""
+-fit_triples gets its triples from triples_enum_module.best_first_triples (lazy, ascending scaled_diff) instead of sorting the
+full list of combinations and going through all_combo_list%s.txt.
 
-def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK,fixed_flags):
-    
-    all_combo_file = "all_combo_list%s.txt"%(str(file_num)) 
-    
-    all_combo_list_file  = open(all_combo_file,"a")
-    
-    temp_list_a = []
-    temp_list_b = []
-    temp_list_c = []
+-Check transitions are scored with triples_scoring_module.score_fits (searchsorted nearest-peak lookup) instead of walking
+a quarter of the peak list for each one.
 
-    peak_list_1 = peaklist[0:int(len(peaklist)/4)]#splits peaks into 4 parts to speed up processing
-    peak_list_2 = peaklist[int(len(peaklist)/4):int(len(peaklist)/2)]
-    peak_list_3 = peaklist[int(len(peaklist)/2):int(len(peaklist)*0.75)]
-    peak_list_4 = peaklist[int(len(peaklist)*0.75):len(peaklist)]
+-Processes no longer get an equal slice of a shuffled peak window each.  The driver enumerates every triple once in global
+scaled_diff order and hands them out in chunks through a queue (triples_queue_module); each fit_triples process pulls its
+next chunk as soon as it's free.
 
-    p_1 = float(peak_list_1[0][0])
-    p_2 = float(peak_list_1[-1][0])
-    p_3 = float(peak_list_2[0][0])
-    p_4 = float(peak_list_2[-1][0])
-    p_5 = float(peak_list_3[0][0])
-    p_6 = float(peak_list_3[-1][0])
-    p_7 = float(peak_list_4[0][0])
-    p_8 = float(peak_list_4[-1][0])
+-Runs are checkpointed chunk by chunk in the job folder (triples_checkpoint_module).  autofit_NS returns "Paused" if the job
+was paused with "python triples_checkpoint_module.py pause job_folder"; resume_autofit_NS(job_folder) (or "python
+triples_checkpoint_module.py resume job_folder") carries on from the last finished chunk.  The fitting part of autofit_NS
+is now run_triples so both can use it.
 
+-The batch engine is now a tunable two-stage cascade: autofit_NS takes confirm_omc (screen bound, MHz), keep_fraction (keep
+the best fraction of each screened block instead of using the bound) and audit_every (let every n-th rejected triple through
+to SPFIT so the screen's misses show up).  The screen's rejected counts and how often it disagreed with SPFIT are written to
+cascade_report.txt in the job folder.
 
-    pred_ratio = pow(10,max(float(trans_1[0]),float(trans_2[0]),float(trans_3[0]))-min(float(trans_1[0]),float(trans_2[0]),float(trans_3[0])))
+-Early-abort scoring: with top_k or min_score set, fit_triples scores the check transitions strongest line first
+(triples_scoring_module.score_fit_ordered) and drops a fit as soon as it can't make its process's top_k any more (by avg w/
+inten penalty) or can't reach min_score lines within 2 MHz.  Dropped fits aren't written to final_output, so the merged
+files only hold fits that could still be in the top_k; fits that could still go to interim_good_output are kept.
 
-    for freq_1,inten_1 in list_a:
-      temp_diff = abs(float(trans_1[1])-float(freq_1))
-      temp_list_a.append((freq_1,inten_1,temp_diff))
+-pair_prune=True drops trans_1/trans_2 peak pairs that can't come from A >= B >= C > 0 with trans_3 inside its window
+(first-order model, batch_fit_module.admissible_pairs; fixed constants stay fixed) before any third peaks are enumerated.
+The number of triples in the job file is then the pruned count.  pair_prune="sweep" is the pair-line sweep: each pair
+is also only combined with the trans_3 peaks its line can reach (batch_fit_module.trans_3_windows, binary search).
 
-    for freq_2,inten_2 in list_b:
-      temp_diff = abs(float(trans_2[1])-float(freq_2))
-      temp_list_b.append((freq_2,inten_2,temp_diff))
+-No more sort -r per process and cat | sort in the driver: each fit_triples process keeps bounded heaps of its best
+result lines and sends them to run_triples on a result queue, which merges them and writes the sorted files and best100.txt
+(triples_results_module).  The sorted files now hold the best 10000 lines of each ranking, and there's a new
+sorted_real_omc_cat.txt ranked by avg w/out peaks over edge.
 
-    for freq_3,inten_3 in list_c:
-      temp_diff = abs(float(trans_3[1])-float(freq_3))
-      temp_list_c.append((freq_3,inten_3,temp_diff))
+-Every result line also goes to the columnar result store results%s.bin (peak indices, A, B, C, rms_fit, score and the
+three averages; triples_store_module), which the GUI and omc_reader.py query instead of parsing the text.
 
-    unsorted_full_list = []
+-dedup_tol (MHz, 0 is off): many triples converge on the same constants, and each of them used to be scored and written
+again.  fit_triples now keeps a dict on A, B and C rounded to dedup_tol (triples_scoring_module.constants_key); a repeat
+isn't scored or written, only counted.  The counts are per process and per start of the search; run_triples adds them up
+into fit_multiplicity.txt (triples_results_module.write_multiplicity).
 
-    for freq_1,inten_1,diff_1 in temp_list_a:
-        for freq_2,inten_2,diff_2 in temp_list_b:
-            for freq_3,inten_3,diff_3 in temp_list_c:
-                real_ratio = max(float(inten_1),float(inten_2),float(inten_3))/min(float(inten_1),float(inten_2),float(inten_3))
-                avg_diff = (diff_1+diff_2+diff_3)/3
-                scaled_diff = avg_diff*(abs(real_ratio-pred_ratio)+1) # Freq. difference scaled by deviation of intensity ratio from predicted
-                unsorted_full_list.append((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff))
+-Incremental reruns: fit_triples records the frequencies of every triple it fits in evaluated%s.bin.  When autofit_NS is
+started again with the name of a job folder that already has that index (the GUI relaunched after the windows were
+widened), run_triples skips every triple in it, so only the new outer shell of combinations is fitted, and the sorted
+files and best100.txt are written from the old and new results together.
 
-    sorted_full_list = sorted(unsorted_full_list, key=lambda entry: entry[6])
+-Anytime search: with hit_sigma set, fit_triples keeps Welford statistics of log10(average omc) over its fits and writes
+a fit hit_sigma standard deviations below them to hits%s.txt right away, with a normal tail estimate of how many fits
+would be that good by chance (triples_hits_module).  With stop_hits set, feed_queue stops handing out triples once that
+many hits agree on A, B and C, and run_triples merges the results so far and returns "Stopped".
 
-    for freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,total_diff in sorted_full_list:
-        all_combo_list_file.write(str(freq_1)+","+str(inten_1)+","+str(freq_2)+","+str(inten_2)+","+str(freq_3)+","+str(inten_3)+", \n")
+-Progress: fit_triples writes its triples done and best avg w/ inten penalty to shared counters every few triples, and
+run_triples publishes them (triples_progress_module.ProgressReporter) on the terminal, in status.json in the job folder
+and through progress_callback, which fitting_GUI_v11B connects to a Qt signal to show the progress in its status bar.
 
-    all_combo_list_file.close()
-    
-    all_combo_list_file = open(all_combo_file)
+-run_triples' ETA starts from this machine's stored seconds per triple for the engine and number of processes, and a
+finished search stores the rate it got (triples_timing_module), so the estimates follow the machine.
+
+-adaptive_workers (run_triples, autofit_NS): processors becomes the most processes the search may use, and a
+controller that the progress reporter polls moves the number that take chunks towards the best measured throughput
+(triples_workers_module).  pin_cpus pins each process to a CPU.
+
+-The fit_triples processes get None for the peak list and map the sorted peak columns run_triples saves in the job
+folder (triples_store_module.attach_peaks) instead of each getting a pickled copy to convert and sort.
+
+-SPFIT runs through program_call_module.run_program: killed after SPFIT_TIMEOUT, tried once more, and its .var and .fit
+are removed first so a crash can't leave the last triple's behind.  A triple that still fails is skipped and written to
+skipped%s.txt, and run_triples says how many there were.
+
+-in_flight (run_triples, autofit_NS): each fit_triples process keeps that many SPFIT runs going, on their own file sets,
+while it writes the next inputs and scores the last result (program_call_module.spfit_runs).  Results come back in
+triple order, so the output and the chunk checkpoints are the same as with 1.
+
+-ram_dir (run_triples, autofit_NS): the SPFIT files of each fit_triples process go in a sandbox folder on a RAM disk
+(/dev/shm by default, "off" for the job folder), and autofit_NS copies one SPFIT.EXE into the job folder that all the
+processes run (triples_sandbox_module).
+
+-engine "lib" fits every triple like "spfit", with SPFIT run from libcalpgm.so in a helper child of each fit_triples
+process (program_call_module.library_runs): the .par and .lin stay in memory and no process is started per triple.  The
+helper is killed after the same timeout as SPFIT.EXE, a crash only takes the helper down, and after a few triples in a
+row like that the process goes over to SPFIT.EXE.  Without the library (Windows, or not built) it's the same as "spfit".
+
+
+"""
+
+def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK,fixed_flags,engine="spfit",batch_model=None,task_queue=None,confirm_omc=2.0,top_k=0,min_score=0,result_queue=None,dedup_tol=0.0,hit_sigma=0.0,progress=None,active=None,pin_cpus=False,in_flight=1,ram_dir=None):
     
-    triples_counter = 0
-    output_file = ""
-    regular_counter = 0
+    if peaklist is None: # Mapped from the job directory (triples_store_module.save_peaks), not copied into every process
+        (peak_freqs,peak_intens) = triples_store_module.attach_peaks()
+    else:
+        (peak_freqs,peak_intens) = triples_scoring_module.sorted_peaks(peaklist) # Sorted peak arrays for the nearest-peak lookups in scoring
+    theor_inten = [10**float(entry[0]) for entry in top_17] # Predicted intensities of the check transitions, for the intensity penalty
+    check_order = triples_scoring_module.check_order(theor_inten) # Strongest check transition first, for early-abort scoring
+    best_penalized = [] # Negated avg w/ inten penalty of this process's top_k fits so far (max-heap), for early-abort scoring
+    result_heaps = triples_results_module.new_heaps() # Best result lines of this process for each ranking, sent to the driver at the end
+    output_lines = [] # Result lines for final_output%s.txt since the last flush
+    store_records = [] # Records for results%s.bin, written together with output_lines
+    evaluated_triples = [] # Frequencies of every triple fitted, for the evaluated%s.bin index (incremental reruns)
+    hit_stats = triples_hits_module.new_stats() # Running statistics of this process's fits, for flagging hits (hit_sigma)
+    progress_done = 0 # Triples done and best avg w/ inten penalty, written to the driver's shared progress counters
+    progress_best = float('inf')
+    multiplicity = triples_results_module.Multiplicity() # Constants fitted so far and their counts, with dedup_tol set
+    if pin_cpus:
+        triples_workers_module.pin_cpu(file_num)
+    library = engine == "lib" and program_call_module.library_available() # SPFIT from libcalpgm.so in a helper child of this process; SPFIT.EXE where that can't be loaded
+    if library:
+        in_flight = 1 # One fit at a time, in memory
+        ram_dir = "off"
+    sandbox = triples_sandbox_module.open_sandbox(file_num,ram_dir) # This process's SPFIT files go on the RAM disk if there is one (None: in the job folder)
+    spfit = triples_sandbox_module.spfit_program() # The job folder's one SPFIT, shared by all the processes
+
+
+    def flush(): # Appends what was fitted since the last flush to this process's output files
+        fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
+        fh_final.write("".join(output_lines))
+        fh_final.close()
+        triples_store_module.append_results(file_num,store_records)
+        triples_store_module.append_evaluated(file_num,evaluated_triples)
+        if dedup_tol > 0:
+            multiplicity.save(file_num)
+        del output_lines[:]
+        del store_records[:]
+        del evaluated_triples[:]
+
+    flush_count = 100000
+    if task_queue != None: # Triples handed out by the driver in global scaled_diff order (already screened if engine is "batch")
+        sorted_triples = triples_queue_module.queue_triples(task_queue,file_num,active,in_flight > 1,flush) # Every fit of a chunk goes to disk before the chunk is checkpointed
+    else:
+        sorted_triples = triples_enum_module.best_first_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3) # Lazy, in ascending scaled_diff order; fitting starts right away
+
+    free = (not fixed_flags[0],not fixed_flags[1],not fixed_flags[2])
+    if engine == "batch" and task_queue == None: # Only triples that survive the batched solve get an SPFIT run.
+        sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,free,confirm_omc,peaks=(peak_freqs,peak_intens)) # peaklist is None if the peaks are mapped
+
+    cascade_fits = 0 # Screen vs SPFIT comparison for the cascade report (engine "batch")
+    cascade_disagreements = 0
+    cascade_const_dev = 0.0
 
-    theor_inten_list = [] # Theoretical intensity ratios and unitless standard deviations for use in scoring fit results below.
-    for x in range(len(top_17)):
-        temp_inten = 10**float(top_17[x][0])
-        theor_inten_list.append(temp_inten)
+    triples_counter = 0
 
-    theor_inten_ratio = (max(theor_inten_list)/min(theor_inten_list))
-    theor_inten_avg = (sum(theor_inten_list)/len(theor_inten_list))
-    theor_inten_unitless_stdev = numpy.std(theor_inten_list)/theor_inten_avg
 
     a_uncert = '1.0E+025'
     b_uncert = '1.0E+025'
@@ -140,50 +228,39 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
 
 
 
-    for all_combo_line in all_combo_list_file:
-        all_combo_line = all_combo_line.split(",")
-        peaks_triple= [(all_combo_line[0],all_combo_line[1]),(all_combo_line[2],all_combo_line[3]),(all_combo_line[4],all_combo_line[5])]
-        
-
-        input_file = ""
-        input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
-        input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
-        input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
-        input_file += "           10000  %s %s \n" % (A,a_uncert)
-        input_file += "           20000  %s %s \n" % (B,b_uncert)
-        input_file += "           30000  %s %s \n" % (C,c_uncert)
-        input_file += "             200  %s %s \n" % (DJ,DJ_uncert)
-        input_file += "            1100  %s %s \n" % (DJK,DJK_uncert)
-        input_file += "            2000  %s %s \n" % (DK,DK_uncert)
-        input_file += "           40100  %s %s \n" % (dJ,dJ_uncert)
-        input_file += "           41000  %s %s \n" % (dK,dK_uncert)
-        fh_par = open("default%s.par"%(str(file_num)),'w')
-        fh_par.write(input_file)
-        fh_par.close()
-
-        input_file = ""#the next part adds in the three peaks to be fit
-        input_file += trans_1[2][0:2]+' '+trans_1[2][2:4]+' '+trans_1[2][4:6]+' '+\
-                      trans_1[3][0:2]+' '+trans_1[3][2:4]+' '+trans_1[3][4:6]+'                      '+peaks_triple[0][0]+' 0.50 1.0000\n' 
-        input_file += trans_2[2][0:2]+' '+trans_2[2][2:4]+' '+trans_2[2][4:6]+' '+\
-                      trans_2[3][0:2]+' '+trans_2[3][2:4]+' '+trans_2[3][4:6]+'                      '+peaks_triple[1][0]+' 0.50 1.0000\n' 
-        input_file += trans_3[2][0:2]+' '+trans_3[2][2:4]+' '+trans_3[2][4:6]+' '+\
-                      trans_3[3][0:2]+' '+trans_3[3][2:4]+' '+trans_3[3][4:6]+'                      '+peaks_triple[2][0]+' 0.50 1.0000\n'
-        counter = 0
-        for line in top_17:#the hack that adds in the check transitions but doesn't use them in the fit
-            input_file += line[2][0:2]+' '+line[2][2:4]+' '+line[2][4:6]+' '+\
-                      line[3][0:2]+' '+line[3][2:4]+' '+line[3][4:6]+'                      '+'%s.0'%(str(counter))+' 0.00 1.0000\n'
-            counter += 1
-        fh_lin = open("default%s.lin"%(str(file_num)), "w")
-        fh_lin.write(input_file)
-        fh_lin.close()        
-
-        a = subprocess.Popen("SPFIT%s default%s"%(str(file_num),str(file_num)), stdout=subprocess.PIPE, shell=False)
-        a.stdout.read()#used to let SPFIT finish
+    input_file = "" # The .par is the same for every triple; write_inputs writes it with each triple's .lin
+    input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
+    input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
+    input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
+    input_file += "           10000  %s %s \n" % (A,a_uncert)
+    input_file += "           20000  %s %s \n" % (B,b_uncert)
+    input_file += "           30000  %s %s \n" % (C,c_uncert)
+    input_file += "             200  %s %s \n" % (DJ,DJ_uncert)
+    input_file += "            1100  %s %s \n" % (DJK,DJK_uncert)
+    input_file += "            2000  %s %s \n" % (DK,DK_uncert)
+    input_file += "           40100  %s %s \n" % (dJ,dJ_uncert)
+    input_file += "           41000  %s %s \n" % (dK,dK_uncert)
+    write_inputs = lambda triple,base: program_call_module.write_triple_inputs(base,input_file,triple,trans_1,trans_2,trans_3,top_17)
+    if in_flight > 1 and task_queue == None: # Pipelined runs take the triples in chunks; here the whole search is one
+        sorted_triples = [sorted_triples]
+    if library:
+        spfit_results = program_call_module.library_runs(sorted_triples,input_file,lambda triple: program_call_module.triple_lin(triple,trans_1,trans_2,trans_3,top_17),\
+                                                             fallback=lambda rest: program_call_module.spfit_runs(rest,write_inputs,file_num,program=spfit,folder=sandbox)) # SPFIT.EXE if the library keeps hanging or crashing
+    else:
+        spfit_results = program_call_module.spfit_runs(sorted_triples,write_inputs,file_num,in_flight,program=spfit,folder=sandbox)
+    for (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff),spfit_output,failure in spfit_results:
+        evaluated_triples.append((float(freq_1),float(freq_2),float(freq_3)))
+        progress_done += 1
+        if progress_done <= triples_progress_module.REPORT_EVERY or progress_done % triples_progress_module.REPORT_EVERY == 0: # Each of the first ones too, so the driver sees the process has started and a calibration run (triples_timing_module) counts exactly
+            triples_progress_module.report(progress,file_num,progress_done,progress_best)
+        if failure != None: # Hung or crashed on the retry too; not marked evaluated, so a rerun in this folder tries it again
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),failure)
+            evaluated_triples.pop()
+            continue
 
         const_list = []
 
-        fh_var = open("default%s.var"%(str(file_num)))
-        for line in fh_var:
+        for line in program_call_module.read_output(spfit_output,"var"):
             if line[8:13] == "10000":
                 temp_A = float(line[15:37])
                 const_list.append("%.3f" %temp_A)
@@ -193,15 +270,11 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
             if line[8:13] == "30000":
                 temp_C = float(line[15:37])
                 const_list.append("%.3f" %temp_C)
-        fh_var.close()
 
-        fh_fit = open("default%s.fit"%(str(file_num)))
-        file_list = []
-        for line in fh_fit:
-                file_list.append(line)
-        fh_fit.close()
+        file_list = program_call_module.read_output(spfit_output,"fit")
 
         freq_list = []
+        rms_fit = None
         for x in range(len(file_list)):
             if file_list[-x][11:14] == "RMS":
                 rms_fit = float(file_list[-x][22:32]) #note - assumes RMS fit error is less than 1 GHz.  Change 22 to 21 if this is a problem.
@@ -209,6 +282,10 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 freq_list.append(file_list[-x][60:71])
             if file_list[-x][40:64]=="EXP.FREQ.  -  CALC.FREQ.":
                 break
+        if len(const_list) < 3 or rms_fit == None: # SPFIT exited normally but didn't fit
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),"SPFIT%s wrote no A, B, C or RMS"%(str(file_num)))
+            evaluated_triples.pop()
+            continue
         read_fit = (const_list[0],const_list[1], const_list[2],freq_list)
         triples_counter +=1
         constants = read_fit[0:3]
@@ -217,73 +294,48 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
         A_1 = float(constants[0])
         B_1 = float(constants[1])
         C_1 = float(constants[2])
-        omc_list = []
-        
-        for x in range(len(top_17)): #matches peaks in the top 17 to peaks in experimental peak list <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-            real_omc = 1.0
-            current_peak = float(freq_17[x])
-            if current_peak>p_1 and current_peak<p_2:#conditionals to find proper portion of experimental peak list to loop through
-                peaks_section = peak_list_1
-                peak = p_2
-                regular_counter +=1
-            elif current_peak>p_3 and current_peak<p_4:
-                peaks_section = peak_list_2
-                peak = p_4
-                regular_counter +=1
-            elif current_peak>p_5 and current_peak<p_6:
-                peaks_section = peak_list_3
-                peak = p_6
-                regular_counter +=1
-            elif current_peak>p_7 and current_peak<p_8:
-                peaks_section = peak_list_4
-                peak = p_8
-                regular_counter +=1
-            elif current_peak>p_8 or current_peak<p_1:
-                peaks_section = peaklist
-                peak = p_8
-                real_omc = 0.0# this is the omc if you throw out peaks that go over the edge of the spectrum
-            else:
-                peaks_section = peaklist
-                peak = p_8
-                regular_counter +=1
-            old_omc = 100000.0
-            for peak_freq,peak_inten in peaks_section: #find nearest peak in actual spectrum to the given top 20 peak
-                omc = abs(current_peak-float(peak_freq))
-                omc_low = abs(current_peak-float(peak))
-                if omc>old_omc:
-                    omc_low = old_omc
-                    omc_inten = temp_inten                    
-                    break
-                old_omc = omc
-                temp_inten = peak_inten
-            if real_omc == 1.0:
-                real_omc = omc_low
-            omc_list.append((omc_low, real_omc, omc_inten))
-        omc_avg = [float(omc) for omc, real_omc, omc_inten in omc_list]
-        real_omc_avg = [float(real_omc) for omc, real_omc, omc_inten in omc_list]
-        omc_inten_scoring = [float(omc_inten) for omc, real_omc, omc_inten in omc_list]
-        score = str(len([omc for omc in omc_avg if omc<2.0])) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
-        avg = (sum(omc_avg)/len(omc_avg))+rms_fit
-        real_avg = (sum(real_omc_avg)/len(real_omc_avg))+rms_fit
-
-        omc_inten_ratio = (max(omc_inten_scoring)/min(omc_inten_scoring))
-        omc_inten_avg = (sum(omc_inten_scoring)/len(omc_inten_scoring))
-        omc_inten_unitless_stdev = numpy.std(omc_inten_scoring)/omc_inten_avg
-
-        score_inten_penalty = 1
-
-        if (omc_inten_ratio <= 0.5*theor_inten_ratio) or (omc_inten_ratio >= 1.5*theor_inten_ratio):
-            score_inten_penalty += 1
-
-        if (omc_inten_unitless_stdev <= 0.5*theor_inten_unitless_stdev) or (omc_inten_unitless_stdev >= 1.5*theor_inten_unitless_stdev):
-            score_inten_penalty += 1
-        
-        penalized_avg = avg*score_inten_penalty
+        if engine == "batch":
+            (disagree,const_dev) = batch_fit_module.cascade_compare((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3),(A_1,B_1,C_1),freq_17,batch_model,peak_freqs,free,confirm_omc)
+            cascade_fits += 1
+            cascade_disagreements += int(disagree)
+            cascade_const_dev += const_dev
+        if dedup_tol > 0: # Constants this process has already scored (to within dedup_tol) are only counted
+            constants_key = triples_scoring_module.constants_key(A_1,B_1,C_1,dedup_tol)
+            if multiplicity.repeat(constants_key):
+                continue
+            multiplicity.record(constants_key) # Before early abort, so the duplicates of a dropped fit are only counted too
+        if top_k > 0 or min_score > 0: # Strongest check lines first; fits that can't make this process's top_k or reach min_score are dropped
+            cutoff = float('inf')
+            if top_k > 0 and len(best_penalized) == top_k:
+                cutoff = -best_penalized[0]
+            scores = triples_scoring_module.score_fit_ordered(freq_17,rms_fit,peak_freqs,peak_intens,theor_inten,check_order,cutoff,min_score)
+            if scores == None:
+                continue
+        else:
+            scores = triples_scoring_module.score_fits(numpy.array([freq_17],dtype=float),rms_fit,peak_freqs,peak_intens,theor_inten) #matches the check transitions to the nearest experimental peaks and scores the fit
+        score = str(scores['score'][0]) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
+        avg = float(scores['avg'][0])
+        real_avg = float(scores['real_avg'][0])
+        penalized_avg = float(scores['penalized_avg'][0])
 
         if float(A_1)>=float(B_1) and float(B_1)>=float(C_1) and float(C_1)>0:
             if int(score)<10: #makes sorting work properly later
                 score = '0'+score  
-            output_file += 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            result_line = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            output_lines.append(result_line)
+            triples_results_module.add_result(result_heaps,result_line,(avg,real_avg,penalized_avg))
+            peak_index = triples_scoring_module.nearest_peaks([float(freq_1),float(freq_2),float(freq_3)],peak_freqs)[1]
+            store_records.append((peak_index[0],peak_index[1],peak_index[2],A_1,B_1,C_1,rms_fit,int(score),avg,real_avg,penalized_avg))
+            progress_best = min(progress_best,penalized_avg)
+            if dedup_tol > 0:
+                multiplicity.keep_line(constants_key,result_line)
+            if hit_sigma > 0: # Anytime search: a fit far below this process's bulk of fits goes to hits%s.txt right away
+                triples_hits_module.check_hit(file_num,hit_stats,avg,result_line,hit_sigma)
+            if top_k > 0:
+                if len(best_penalized) < top_k:
+                    heapq.heappush(best_penalized,-penalized_avg)
+                else:
+                    heapq.heappushpop(best_penalized,-penalized_avg)
 
             if real_avg <= 0.2: #appends good finds (RMS < 0.2 MHz, ignoring peaks over edge) to interim file for each processor
                 interim_output = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
@@ -291,18 +343,95 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 fh_interim_good.write(interim_output)
                 fh_interim_good.close()
 
-            if triples_counter == 100000: #appends to file after every 100000 triples
-                fh_final = open("final_output%s.txt"%(str(file_num)), "a")
-                fh_final.write(output_file)
-                fh_final.close()
-                triples_counter = 0
-                output_file = ""
-    fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
-    fh_final.write(output_file)
-    fh_final.close()
-    os.system("sort -r 'final_output%s.txt'>sorted_final_out%s.txt"%(str(file_num),str(file_num)))#sorts output by score
+        if task_queue == None and triples_counter >= flush_count: #appends to file after every 100000 triples; queued chunks are only written when they're done (queue_triples), so a resume never finds half a chunk
+            flush()
+            triples_counter = 0
+    triples_sandbox_module.close_sandbox(sandbox)
+    flush()
+    if engine == "batch":
+        batch_fit_module.write_cascade_stats(file_num,cascade_fits,cascade_disagreements,cascade_const_dev)
+    triples_progress_module.report(progress,file_num,progress_done,progress_best)
+    if result_queue != None: # Best lines of this process, merged by the driver
+        result_queue.put(result_heaps)
     
-def autofit_NS(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,freq_high,freq_low,inten_high,inten_low,processors,temperature,Jmax,trans_1,trans_2,trans_3,check_peaks_list,peaklist,trans_1_peaks,trans_2_peaks,trans_3_peaks,fix_flags):
+def run_triples(trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,top_peaks_3cut,peaklist,processors,A,B,C,DJ,DJK,DK,dJ,dK,temperature,fixed_flags,engine,chunk_size=50,done_chunks=set(),confirm_omc=2.0,keep_fraction=None,audit_every=0,top_k=0,min_score=0,pair_prune=False,dedup_tol=0.0,evaluated_records={},hit_sigma=0.0,stop_hits=0,num_of_triples=0,progress_callback=None,adaptive_workers=False,pin_cpus=False,in_flight=1,ram_dir=None):
+
+    """ Fits every triple (except the chunks in done_chunks) with one fit_triples process per processor, in the job
+    directory, and writes sorted_omc_cat.txt, sorted_real_omc_cat.txt, sorted_inten_omc_cat.txt and best100.txt.  Returns "Paused" if the run was
+    paused before all triples were handed out (nothing is merged then), otherwise "Done".  With engine "batch",
+    confirm_omc, keep_fraction and audit_every set up the screen (see batch_fit_module.batch_screen) and its counts go to
+    cascade_report.txt.  top_k and min_score turn on early-abort scoring in fit_triples, and pair_prune skips
+    trans_1/trans_2 peak pairs that can't be part of a physical fit ("sweep": and trans_3 peaks their line can't reach).
+    evaluated_records (triples_store_module.evaluated_counts) skips the triples an earlier search in the job directory
+    already fitted; their results stay in the output files and are merged with the new ones.  hit_sigma flags fits that
+    far below the rest in hits%s.txt as they're found, and stop_hits stops the search ("Stopped", results merged) once
+    that many hits agree (triples_hits_module).  Progress goes to the terminal, status.json and progress_callback
+    (triples_progress_module), with num_of_triples as the total.  adaptive_workers makes processors the most processes
+    to use and finds the number with the best throughput (triples_workers_module); pin_cpus pins each to a CPU.  in_flight
+    is the number of SPFIT runs each process keeps going at once (program_call_module.spfit_runs), and ram_dir where
+    they keep their SPFIT files (triples_sandbox_module.open_sandbox)."""
+
+    batch_model = None
+    if engine == "batch": # Linear model for the batched solver, built once here instead of in every process.
+        batch_model = batch_fit_module.linear_model(trans_1,trans_2,trans_3,top_peaks_3cut,A,B,C,DJ,DJK,DK,dJ,dK,temperature)
+
+    free = (not fixed_flags[0],not fixed_flags[1],not fixed_flags[2])
+    (pair_mask,pair_window) = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature,free)[0:2]
+
+    sorted_triples = triples_enum_module.best_first_triples(trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_mask=pair_mask,pair_window=pair_window) # Every triple in global scaled_diff order, handed out in chunks to whichever process is free
+    if evaluated_records: # Incremental rerun: only the triples the earlier searches here didn't fit (e.g. the new outer shell of wider windows)
+        sorted_triples = triples_store_module.skip_evaluated(sorted_triples,triples_store_module.load_evaluated(evaluated_records))
+    screen_stats = {}
+    if engine == "batch":
+        sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,free,confirm_omc,keep_fraction=keep_fraction,stats=screen_stats,audit_every=audit_every)
+
+    processors = int(processors)
+    task_queue = multiprocessing.Queue(processors*4)
+    result_queue = multiprocessing.Queue()
+    progress = triples_progress_module.new_counters(processors) # Shared per-process counters, published by reporter
+    (active,controller) = triples_workers_module.adaptive(processors,progress,adaptive_workers) # Limit on the processes taking chunks, moved by controller
+    timing_key = triples_timing_module.timing_key(engine,processors)
+    reporter = triples_progress_module.ProgressReporter(progress,num_of_triples,len(done_chunks)*chunk_size,callback=progress_callback,seconds_per_triple=triples_timing_module.stored_seconds(timing_key),timing_key=timing_key,controller=controller)
+    triples_store_module.save_peaks(peaklist) # What the peak indices in results%s.bin point into
+    result_heaps = triples_results_module.new_heaps()
+    if done_chunks or evaluated_records: # Fits of the chunks done before the resume, or of the earlier searches, are only in the final_output files
+        result_heaps = triples_results_module.read_results()
+
+    workers = []
+    for num in range(processors):
+        vars()["p%s"%str(num)] = Process(target=fit_triples, args=([],[],[],trans_1,trans_2,trans_3,top_peaks_3cut,None,num,A,B,C,DJ,DJK,DK,dJ,dK,fixed_flags,engine,batch_model,task_queue,confirm_omc,top_k,min_score,result_queue,dedup_tol,hit_sigma,progress,active,pin_cpus,in_flight,ram_dir))
+        workers.append(vars()["p%s"%str(num)])
+
+    for num in range(processors):
+        vars()["p%s"%str(num)].start()
+
+    status = triples_queue_module.feed_queue(task_queue,sorted_triples,processors,workers,chunk_size,done_chunks,stop_hits=stop_hits,reporter=reporter,controller=controller,stats=screen_stats)
+    result_heaps = triples_results_module.collect_heaps(result_queue,workers,result_heaps,reporter=reporter)
+
+    for num in range(processors):
+        vars()["p%s"%str(num)].join()
+    reporter.finish(status)
+
+    if status == "Paused":
+        batch_fit_module.save_screen_stats(screen_stats) # Added to the resumed run's counts in its cascade report
+        return status
+
+    if engine == "batch":
+        print(batch_fit_module.cascade_report(screen_stats,confirm_omc,keep_fraction))
+
+    if status == "Stopped":
+        print("%s hits agree on the constants (hits*.txt), so the search was stopped early."%(stop_hits))
+
+    if program_call_module.skipped_count() > 0:
+        print(program_call_module.skipped_message())
+
+    triples_results_module.write_results(result_heaps)
+    if dedup_tol > 0:
+        triples_results_module.write_multiplicity(dedup_tol)
+
+    return status
+
+def autofit_NS(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,freq_high,freq_low,inten_high,inten_low,processors,temperature,Jmax,trans_1,trans_2,trans_3,check_peaks_list,peaklist,trans_1_peaks,trans_2_peaks,trans_3_peaks,fix_flags,engine="spfit",confirm_omc=2.0,keep_fraction=None,audit_every=0,top_k=0,min_score=0,pair_prune=False,dedup_tol=0.0,hit_sigma=0.0,stop_hits=0,progress_callback=None,adaptive_workers=False,pin_cpus=False,in_flight=1,ram_dir=None):
 
     global fixed_flags
     fixed_flags = fix_flags
@@ -315,16 +444,14 @@ def autofit_NS(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,freq_high,freq_low,int
     a = subprocess.Popen("mkdir %s"%job_name) # Need to be able to trust job_name.  Add error handling here later / build it into the GUI.
     a.wait()
 
-    for number in range(processors):
-        y = subprocess.Popen("cp SPFIT.EXE %s\SPFIT%s.EXE"%(job_name,number), stdout=subprocess.PIPE, shell=True)
-        y.stdout.read()     
-
-    y = subprocess.Popen("cp SPCAT.EXE %s\SPCAT.EXE"%(job_name), stdout=subprocess.PIPE, shell=True)
-    y.stdout.read() 
+    triples_sandbox_module.copy_programs(job_name) # One SPFIT and SPCAT, shared by all the processes
     
     os.chdir(job_name)
     
     num_of_triples = len(trans_1_peaks)*len(trans_2_peaks)*len(trans_3_peaks) #this tells you how many entries there will be in the all_combo_list
+    if pair_prune and num_of_triples != 0: # Only the triples run_triples will enumerate after the pair pruning or sweep
+        free = (not fixed_flags[0],not fixed_flags[1],not fixed_flags[2])
+        num_of_triples = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature,free)[2]
 
     trans_1_uncert = float(trans_1[4])
     trans_2_uncert = float(trans_2[4])
@@ -341,6 +468,13 @@ def autofit_NS(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,freq_high,freq_low,int
         else:
             top_peaks_3cut.append(entry)
 
+    evaluated_records = triples_store_module.start_search(triples_store_module.search_identity(trans_1,trans_2,trans_3,top_peaks_3cut,(A,B,C,DJ,DJK,DK,dJ,dK),engine,fixed_flags)) # Triples fitted by an earlier search of the same transitions, checks, constants and engine in this folder, skipped this time; any other search's outputs are moved to previous_search<n>
+    program_call_module.clear_skipped() # Tried again this time
+    triples_hits_module.clear_hits() # So an earlier search's hits can't stop this one
+    batch_fit_module.clear_cascade_stats() # Counted from 0 again too
+    if evaluated_records:
+        triples_checkpoint_module.start_rerun()
+
     job_file = ""
     str(top_peaks_3cut)
     str(trans_1)
@@ -350,159 +484,49 @@ def autofit_NS(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,freq_high,freq_low,int
     for entry in top_peaks_3cut:
         fitting_peaks_str+=str(entry)+"\n"
             
-    job_file += "Job Name %s \n u_A: %s \n u_B: %s \n u_C: %s \n A: %s \n B: %s \n C: %s \n DJ: %s \n DJK: %s \n DK: %s \n dJ: %s \n dK: %s \n processors: %s \n freq_high: %s \n freq_low: %s \n inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s "%(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
-        str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3))
+    job_file += "Job Name %s \n u_A: %s \n u_B: %s \n u_C: %s \n A: %s \n B: %s \n C: %s \n DJ: %s \n DJK: %s \n DK: %s \n dJ: %s \n dK: %s \n processors: %s \n freq_high: %s \n freq_low: %s \n inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s \n engine: %s \n confirm_omc: %s \n keep_fraction: %s \n audit_every: %s \n top_k: %s \n min_score: %s \n pair_prune: %s \n dedup_tol: %s \n hit_sigma: %s \n stop_hits: %s \n adaptive_workers: %s \n pin_cpus: %s \n in_flight: %s \n ram_dir: %s "%(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
+        str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3),engine,str(confirm_omc),str(keep_fraction),str(audit_every),str(top_k),str(min_score),str(pair_prune),str(dedup_tol),str(hit_sigma),str(stop_hits),str(adaptive_workers),str(pin_cpus),str(in_flight),str(ram_dir))
     
     Job_fh = open("input_data_%s.txt"%(job_name),"w")
     Job_fh.write(job_file) 
     Job_fh.close()
 
-    new_list = []
-
-    new_list = [(len(trans_1_peaks),"trans_1_peaks"),(len(trans_2_peaks),"trans_2_peaks"),(len(trans_3_peaks),"trans_3_peaks")]
-    new_list.sort()
-            
-    #list_key = []
-    #list_a_peaks = [globals()[new_list[0][1]],new_list[0][1]]
-    #list_b_peaks = [globals()[new_list[1][1]],new_list[1][1]]
-    #list_c_peaks = globals()[new_list[2][1]]
-
-    flag123 = 0
-    flag132 = 0
-    flag213 = 0
-    flag231 = 0
-    flag312 = 0
-    flag321 = 0
-
-    if (len(trans_1_peaks) >= len(trans_2_peaks)) and (len(trans_1_peaks) >= len(trans_3_peaks)):
-        list_a_peaks = trans_1_peaks
-        if len(trans_2_peaks) >= len(trans_3_peaks):
-            list_b_peaks = trans_2_peaks
-            list_c_peaks = trans_3_peaks
-            flag123 = 1
-        elif len(trans_3_peaks) >= len(trans_2_peaks):
-            list_b_peaks = trans_3_peaks
-            list_c_peaks = trans_2_peaks
-            flag132 = 1
-    elif (len(trans_2_peaks) >= len(trans_1_peaks)) and (len(trans_2_peaks) >= len(trans_3_peaks)):
-        list_a_peaks = trans_2_peaks
-        if len(trans_1_peaks) >= len(trans_3_peaks):
-            list_b_peaks = trans_1_peaks
-            list_c_peaks = trans_3_peaks
-            flag213 = 1
-        elif len(trans_3_peaks) >= len(trans_1_peaks):
-            list_b_peaks = trans_3_peaks
-            list_c_peaks = trans_1_peaks
-            flag231 = 1
-    elif (len(trans_3_peaks) >= len(trans_1_peaks)) and (len(trans_3_peaks) >= len(trans_2_peaks)):
-        list_a_peaks = trans_3_peaks
-        if len(trans_1_peaks) >= len(trans_2_peaks):
-            list_b_peaks = trans_1_peaks
-            list_c_peaks = trans_2_peaks
-            flag312 = 1
-        elif len(trans_2_peaks) >= len(trans_1_peaks):
-            list_b_peaks = trans_2_peaks
-            list_c_peaks = trans_1_peaks
-            flag321 = 1
-
-    random.shuffle(list_c_peaks)  # Shuffle so that each processor gets a range of values for the third peak, not processor 0 getting only the lowest frequencies.  
-
-    list_c_list = []
-    for num in range(processors):
-        processors = float(processors)
-        num = float(num)
-        x = int((num)*(len(list_c_peaks)/processors))
-        y = int(len(list_c_peaks)*((num+1)/processors))
-        list_c_list.append(list_c_peaks[x:y])
-    list_c_list.append("marker")
-
-
-#    globals()[new_list[0][1]] = list_a_peaks[0]
-#    globals()[new_list[1][1]] = list_b_peaks[0]
-#    globals()[new_list[2][1]] = list_c_list
-
-    if flag123 == 1:
-        trans_1_peaks = list_a_peaks
-        trans_2_peaks = list_b_peaks
-        trans_3_peaks = list_c_list
-    if flag213 == 1:
-        trans_1_peaks = list_b_peaks
-        trans_2_peaks = list_a_peaks
-        trans_3_peaks = list_c_list
-    if flag312 == 1:
-        trans_1_peaks = list_b_peaks
-        trans_2_peaks = list_c_list
-        trans_3_peaks = list_a_peaks
-    if flag132 == 1:
-        trans_1_peaks = list_a_peaks
-        trans_2_peaks = list_c_list
-        trans_3_peaks = list_b_peaks
-    if flag231 == 1:
-        trans_1_peaks = list_c_list
-        trans_2_peaks = list_a_peaks
-        trans_3_peaks = list_b_peaks
-    if flag321 == 1:
-        trans_1_peaks = list_c_list
-        trans_2_peaks = list_b_peaks
-        trans_3_peaks = list_a_peaks
-
-    processors = int(processors)
-    for num in range(processors):
+    triples_checkpoint_module.write_checkpoint_info({'program':"autofit_NS",'job_name':job_name,'A':A,'B':B,'C':C,'DJ':DJ,'DJK':DJK,'DK':DK,'dJ':dJ,'dK':dK,\
+        'temperature':temperature,'processors':int(processors),'engine':engine,'confirm_omc':confirm_omc,'keep_fraction':keep_fraction,'audit_every':audit_every,'top_k':top_k,'min_score':min_score,'pair_prune':pair_prune,'dedup_tol':dedup_tol,'hit_sigma':hit_sigma,'stop_hits':stop_hits,'adaptive_workers':adaptive_workers,'pin_cpus':pin_cpus,'in_flight':in_flight,'ram_dir':ram_dir,'evaluated_records':evaluated_records,'chunk_size':50,'fixed_flags':list(fixed_flags),'num_of_triples':num_of_triples,\
+        'trans_1':trans_1,'trans_2':trans_2,'trans_3':trans_3,'check_peaks':top_peaks_3cut,'trans_1_peaks':triples_checkpoint_module.string_peaks(trans_1_peaks),\
+        'trans_2_peaks':triples_checkpoint_module.string_peaks(trans_2_peaks),'trans_3_peaks':triples_checkpoint_module.string_peaks(trans_3_peaks)},peaklist)
 
-        if trans_1_peaks[-1]=="marker":
-            trans_x_peaks = trans_1_peaks[num]
-            trans_y_peaks = trans_2_peaks
-            trans_z_peaks = trans_3_peaks
-            
-        if trans_2_peaks[-1]=="marker":
-            trans_x_peaks = trans_1_peaks
-            trans_y_peaks = trans_2_peaks[num]
-            trans_z_peaks = trans_3_peaks
-
-        if trans_3_peaks[-1]=="marker":
-            trans_x_peaks = trans_1_peaks
-            trans_y_peaks = trans_2_peaks
-            trans_z_peaks = trans_3_peaks[num]
-            
-        vars()["p%s"%str(num)] = Process(target=fit_triples, args=(trans_x_peaks,trans_y_peaks,trans_z_peaks,trans_1,trans_2,trans_3,top_peaks_3cut,peaklist,num,A,B,C,DJ,DJK,DK,dJ,dK,fixed_flags))
+    status = run_triples(trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,top_peaks_3cut,peaklist,processors,A,B,C,DJ,DJK,DK,dJ,dK,temperature,fixed_flags,engine,confirm_omc=confirm_omc,keep_fraction=keep_fraction,audit_every=audit_every,top_k=top_k,min_score=min_score,pair_prune=pair_prune,dedup_tol=dedup_tol,evaluated_records=evaluated_records,hit_sigma=hit_sigma,stop_hits=stop_hits,num_of_triples=num_of_triples,progress_callback=progress_callback,adaptive_workers=adaptive_workers,pin_cpus=pin_cpus,in_flight=in_flight,ram_dir=ram_dir)
 
-    for num in range(processors):
-        vars()["p%s"%str(num)].start()
-    for num in range(processors):
-        vars()["p%s"%str(num)].join()
-            
-    a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 4 -n > sorted_omc_cat.txt', shell=True)
-    a.wait()
-    
-    a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 6 -n > sorted_inten_omc_cat.txt', shell=True)
-    a.wait()
+    os.chdir(os.pardir)
 
-    f = open('sorted_inten_omc_cat.txt','r')
-    fits = []
+    if status == "Paused":
+        return "Paused"
 
-    for i in range(100):
-        r = f.readline()
+    autofit_NS_success_flag = "Success"
 
-        if i < 10:
-            number = '0'+str(i)
-        else:
-            number = i
+    return autofit_NS_success_flag
 
-        temp = str(number) + ' ' + r
-        fits.append(temp)
+def resume_autofit_NS(job_dir):
 
-    f.close()
+    """ Picks up a paused or interrupted autofit_NS run from the checkpoint in job_dir, skipping every finished chunk.
+    Returns "Success" or "Paused" like autofit_NS."""
 
-    OMC_char_buffer = ""
-    for i in (fits):
-        OMC_char_buffer += i+''
+    cwd = os.getcwd()
+    os.chdir(job_dir)
 
-    f100=open('best100.txt','w')
-    f100.write(OMC_char_buffer)
-    f100.close()
+    (info,peaklist) = triples_checkpoint_module.read_checkpoint_info()
+    triples_checkpoint_module.clear_pause()
+    triples_checkpoint_module.rewind_outputs()
+    done_chunks = triples_checkpoint_module.completed_chunks()
 
-    os.chdir(os.pardir)
+    status = run_triples(info['trans_1'],info['trans_2'],info['trans_3'],info['trans_1_peaks'],info['trans_2_peaks'],info['trans_3_peaks'],info['check_peaks'],peaklist,\
+                         info['processors'],info['A'],info['B'],info['C'],info['DJ'],info['DJK'],info['DK'],info['dJ'],info['dK'],info['temperature'],info['fixed_flags'],info['engine'],info['chunk_size'],done_chunks,\
+                         info.get('confirm_omc',2.0),info.get('keep_fraction'),info.get('audit_every',0),info.get('top_k',0),info.get('min_score',0),info.get('pair_prune',False),info.get('dedup_tol',0.0),info.get('evaluated_records',{}),info.get('hit_sigma',0.0),info.get('stop_hits',0),info['num_of_triples'],\
+                         adaptive_workers=info.get('adaptive_workers',False),pin_cpus=info.get('pin_cpus',False),in_flight=info.get('in_flight',1),ram_dir=info.get('ram_dir',None))
 
-    autofit_NS_success_flag = "Success"
+    os.chdir(cwd)
 
-    return autofit_NS_success_flag
\ No newline at end of file
+    if status == "Paused":
+        return "Paused"
+    return "Success"
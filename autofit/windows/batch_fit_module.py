@@ -0,0 +1,511 @@
+import os
+import ast
+import itertools
+import math
+import glob
+import numpy
+import triples_scoring_module
+import program_call_module
+import prediction_cache_module
+
+""""
+Batched triples solver
+
+based on the fit_triples routine of the Python Triples Fitter (Ian Finneran, Steve Shipman at NCF)
+
+Please comment any changes you make to the code here:
+
+batch fit module:
+-fit_triples normally runs SPFIT once for every single triple, which is limited by process startup and file I/O rather than
+by the fit itself.  With only A, B, and C floated against three lines, the fit is a 3x3 nonlinear solve, so this module does
+it for whole blocks of triples at once in NumPy.  SPCAT is run once per job at the guess constants and at shifted A, B and C
+(the same kind of perturbation used by dependence_test, plus the three mixed shifts), which gives the frequency, gradient and
+Hessian of every fitting and check transition.  Each block of triples is solved with the linear model, then refined with a
+few batched Newton steps on the quadratic model, and the check transitions are predicted from the result.
+
+-Only triples whose predicted check transitions land close to experimental peaks (batch_screen) are handed back to
+fit_triples for the exact SPFIT fit, so the final constants and scores are still the SPFIT ones.  Distortion constants are
+held at their guess values by the batch model.  The quadratic model is good to a few tenths of a MHz on the check
+transitions for shifts of ~30 MHz in A from the guess; for much wider searches raise confirm_omc.
+
+-The screen is the cheap first stage of a two-stage cascade and can be tuned: batch_screen keeps either everything under
+confirm_omc or the best keep_fraction of each block, counts what it rejects, and can let every audit_every-th rejected
+triple through to SPFIT anyway.  For each triple it fits, fit_triples asks cascade_compare whether the screen and SPFIT
+agree on the check omc being under confirm_omc (and how far apart the constants are).  The processes write their counts
+to cascade_stats%s.txt and the driver adds everything up in cascade_report.txt.  With auditing on, disagreements on
+audited triples are the screen's false rejections.  For resumed jobs the disagreement counts include the refits of
+interrupted chunks.
+
+-admissible_pairs is a pre-join stage for the triples enumeration: with the linear model it works out, for every trans_1
+peak x trans_2 peak at once, whether any A >= B >= C > 0 that's consistent with both also puts trans_3 inside its window.
+best_first_triples only enumerates third peaks for the pairs that pass, and triples_gen counts only those.  It's only a
+necessary condition (ordering, trans_3 window, and a slack of 5 MHz by default on every bound for the peak positions), so
+it doesn't drop a pair the search would otherwise have fitted for being far from the guess, with the limit below.  It
+used to also keep the constants within 5% of the guess (max_shift), which quietly narrowed the search to that prior;
+max_shift is still there for callers that want it, and is off by default.
+
+-The fixed slack used to be all the room left for the model, but over wide constant windows its quadratic term (from the
+SPCAT differences) is far more than 5 MHz, so pairs the search would have fitted could be pruned.  pair_segments now
+adds to every bound the most the quadratic term moves it over the pair's admissible segment of the line (so pair_mask
+and pair_window build the model with its cross terms, 19 SPCAT runs); that widens the segment, so the two are iterated
+until it settles, and a pair whose segment doesn't is kept whole.  trans_3_windows widens each pair's interval by the
+same amount.  The limit: a pair that's outside the bounds on the first-order line itself is still dropped, since there's
+no segment to take the quadratic term over, and over very wide windows (shifts of a few hundred MHz in the constants) a
+few of those would have been fitted.  Taking the gap between the clashing bounds as the segment instead keeps nearly
+every pair, so that's left as is; tests/test_batch_fit_module.py bounds the miss rate.
+
+-trans_3_windows goes one step further for the pair-line sweep: along each pair's line trans_3 moves linearly, so the
+admissible part of the line maps to one trans_3 frequency interval per pair.  best_first_triples(pair_window=...) only
+pairs each trans_1/trans_2 pair with the list_c peaks in its interval, found by binary search, instead of the whole
+trans_3 window, and window_count gives the number of triples that leaves.
+
+-run_SPCAT_batch and predicted_freqs go through prediction_cache_module, so the shifted constants linear_model has
+already predicted (the same guess, for every isotopologue or rerun) aren't run through SPCAT again.
+
+-linear_model's .int only covers the J and frequency range of the transitions it looks up (prediction_limits), instead
+of J from 0 and everything up to 100 GHz.
+
+-The cascade counts belong to one search: a new search clears cascade_stats*.txt (clear_cascade_stats) instead of adding
+to the last one's.  A paused run saves the screen counts of the chunks it handed out to screen_stats.txt, and
+cascade_report adds them to the resumed run's, which only counts the chunks it hands out itself
+(triples_queue_module.feed_queue), so every chunk is counted once.
+
+"""
+
+SCREEN_STATS_FILE = "screen_stats.txt" # Screen counts of a search's runs before it was resumed
+SEGMENT_ITERATIONS = 20 # Rounds of widening pair_segments' bounds by the quadratic term over the segment before a pair is kept whole
+SEGMENT_TOLERANCE = 0.01 # MHz along the line; a segment that grew less than this has settled
+
+def int_writer_batch(J_max,temperature,file_num,J_min="00",freq="100.0"): # SPCAT input file for the linear model; all dipoles on so every transition type is predicted.
+    input_file = ""
+    input_file += "Molecule \n"
+    input_file += "0  91  300000  %s  %s  -20.0  -20.0 %s  %s\n"%(J_min,J_max,freq,temperature)
+    input_file += " 001  1.0 \n"
+    input_file += " 002  1.0 \n"
+    input_file += " 003  1.0 \n"
+    fh_int = open("batch%s.int"%(str(file_num)), "w")
+    fh_int.write(input_file)
+    fh_int.close()
+
+def var_writer_batch(A,B,C,DJ,DJK,DK,dJ,dK,file_num): # SPCAT var file for the linear model.  Uncertainties don't matter here, only frequencies are used.
+    input_file = ""
+    input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
+    input_file += "   8  430   51    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n"
+    input_file +="a   1  1  0  99  0  1  1  1  1  -1   0\n"
+    input_file += "           10000  %s 1.0E-004 \n" % A
+    input_file += "           20000  %s 1.0E-004 \n" % B
+    input_file += "           30000  %s 1.0E-004 \n" % C
+    input_file += "             200  %s 1.0E-025 \n" % DJ
+    input_file += "            1100  %s 1.0E-025 \n" % DJK
+    input_file += "            2000  %s 1.0E-025 \n" % DK
+    input_file += "           40100  %s 1.0E-025 \n" % dJ
+    input_file += "           41000  %s 1.0E-025 \n" % dK
+    fh_var = open("batch%s.var"%(str(file_num)),'w')
+    fh_var.write(input_file)
+    fh_var.close()
+
+def run_SPCAT_batch(file_num):
+    name = "batch%s"%(str(file_num))
+    prediction_cache_module.run_spcat(name,lambda: program_call_module.check_program("SPCAT "+name,[name+".cat"])) # Raises ProgramError if SPCAT hangs or writes no .cat
+
+def predicted_freqs(trans_list,file_num): # Looks up the predicted frequency of each transition in batch.cat; numpy.nan if SPCAT didn't predict it.
+    lookup = {}
+    for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog("batch%s"%(str(file_num))):
+        lookup[(qnum_up,qnum_low)] = value
+
+    freqs = numpy.zeros(len(trans_list))
+    for x in range(len(trans_list)):
+        freqs[x] = lookup.get((trans_list[x][2],trans_list[x][3]),numpy.nan)
+    return freqs
+
+def linear_model(trans_1,trans_2,trans_3,top_17,A,B,C,DJ,DJK,DK,dJ,dK,temperature="2",step=10.0,file_num="",curvature=True):
+
+    """ Frequencies, A/B/C gradients and Hessians of the fitting and check transitions at the guess constants.  Runs SPCAT 19 times
+    (7 with curvature=False, which leaves the cross terms of the Hessians at zero)."""
+
+    trans_list = [trans_1,trans_2,trans_3] + list(top_17)
+    (J_min,J_max,inten,freq) = prediction_cache_module.prediction_limits(trans_list,2*step,intensity=False) # Just their J and frequency range; with all dipoles on, their own intensities don't apply
+    int_writer_batch(J_max,temperature,file_num,J_min,freq)
+
+    constants = numpy.array([float(A),float(B),float(C)])
+
+    def freqs_at(shift): # Runs SPCAT with the guess constants shifted by shift (MHz)
+        shifted = constants + shift
+        var_writer_batch(shifted[0],shifted[1],shifted[2],DJ,DJK,DK,dJ,dK,file_num)
+        run_SPCAT_batch(file_num)
+        return predicted_freqs(trans_list,file_num)
+
+    unit = numpy.identity(3)*step
+    freqs_0 = freqs_at(numpy.zeros(3))
+    freqs_high = [freqs_at(unit[k]) for k in range(3)]
+    freqs_low = [freqs_at(-unit[k]) for k in range(3)]
+
+    jacobian = numpy.zeros((len(trans_list),3))
+    hessian = numpy.zeros((len(trans_list),3,3))
+
+    for k in range(3):
+        jacobian[:,k] = (freqs_high[k]-freqs_low[k])/(2*step)
+        hessian[:,k,k] = (freqs_high[k]-2*freqs_0+freqs_low[k])/(step**2)
+        for l in range(k+1,3): # Cross terms are needed; near-prolate lines mix A with B-C strongly.
+            if not curvature:
+                break
+            freqs_mixed = freqs_at(unit[k]+unit[l]) - freqs_at(unit[k]-unit[l]) - freqs_at(unit[l]-unit[k]) + freqs_at(-unit[k]-unit[l])
+            hessian[:,k,l] = freqs_mixed/(4*step**2)
+            hessian[:,l,k] = hessian[:,k,l]
+
+    if numpy.isnan(freqs_0[0:3]).any():
+        raise ValueError("SPCAT did not predict all three fitting transitions; the batch model can't be built.")
+
+    model = {}
+    model['constants'] = constants
+    model['fit_freqs'] = freqs_0[0:3]
+    model['fit_jacobian'] = jacobian[0:3]
+    model['fit_hessian'] = hessian[0:3]
+    model['check_freqs'] = freqs_0[3:]
+    model['check_jacobian'] = jacobian[3:]
+    model['check_hessian'] = hessian[3:]
+    return model
+
+def model_freqs(delta,freqs,jacobian,hessian): # Quadratic model frequencies for a block of constant shifts, shape (n_fits, n_lines)
+    return freqs + numpy.dot(delta,jacobian.T) + 0.5*numpy.einsum('nk,ikl,nl->ni',delta,hessian,delta)
+
+def batch_solve(obs_freqs,model,free=(True,True,True),n_iter=3):
+
+    """ Solves for A, B, C of a block of triples (obs_freqs has shape (n_fits,3)).  Linear solve, then n_iter Newton steps on the quadratic model."""
+
+    free = numpy.array(free,dtype=bool)
+    freqs = model['fit_freqs']
+    jacobian = model['fit_jacobian']
+    hessian = model['fit_hessian']
+
+    delta = numpy.zeros((len(obs_freqs),3))
+    step = numpy.linalg.lstsq(jacobian[:,free],(obs_freqs-freqs).T,rcond=-1)[0].T
+    delta[:,free] = step
+
+    for iteration in range(n_iter):
+        residual = model_freqs(delta,freqs,jacobian,hessian) - obs_freqs
+        local_jacobian = (jacobian[numpy.newaxis,:,:] + numpy.einsum('ikl,nl->nik',hessian,delta))[:,:,free] # d(freq)/d(const) at the current point, one matrix per fit
+        jacobian_t = local_jacobian.transpose(0,2,1)
+        normal = numpy.einsum('nij,njk->nik',jacobian_t,local_jacobian)
+        gradient = numpy.einsum('nij,nj->ni',jacobian_t,residual)
+        try:
+            step = numpy.linalg.solve(normal,gradient[:,:,numpy.newaxis])[:,:,0]
+        except numpy.linalg.LinAlgError: # A singular local matrix somewhere in the block; keep what we have.
+            break
+        delta[:,free] -= step
+
+    return model['constants'] + delta, delta
+
+def batch_predict(delta,model): # Predicted check transition frequencies, shape (n_fits, n_checks)
+    return model_freqs(delta,model['check_freqs'],model['check_jacobian'],model['check_hessian'])
+
+def batch_screen(triples,model,peaklist,free=(True,True,True),confirm_omc=2.0,block_size=20000,keep_fraction=None,stats=None,audit_every=0,peaks=None):
+
+    """ Batch fits (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff) entries from any iterable (list or
+    best_first_triples generator) a block at a time and yields only the ones with physically reasonable constants whose
+    predicted check transitions have a median omc of at most confirm_omc MHz (the median so that a couple of check lines
+    missing from the peak list don't throw out a good fit).  With keep_fraction set, the best keep_fraction of each block
+    (by that median omc) is kept instead, whatever its omc.  Every audit_every-th rejected triple is let through anyway so
+    the screen's misses can be counted against SPFIT.  If stats is a dict, the counts 'screened', 'rejected_constants',
+    'rejected_omc' and 'audited' are added to it as the triples go by.  Order is preserved, so the survivors can go straight through the normal
+    SPFIT loop in fit_triples.  peaks is (peak_freqs,peak_intens) already sorted (triples_scoring_module.sorted_peaks or
+    triples_store_module.attach_peaks), for callers that don't have the peak list itself; peaklist can be None then."""
+
+    if peaks is None:
+        peaks = triples_scoring_module.sorted_peaks(peaklist)
+    (peak_freqs,peak_intens) = peaks
+    triples = iter(triples)
+    if stats == None:
+        stats = {}
+    for key in ('screened','rejected_constants','rejected_omc','audited'):
+        stats.setdefault(key,0)
+    rejected_count = 0
+
+    while True:
+        block = list(itertools.islice(triples,block_size))
+        if block == []:
+            break
+        obs_freqs = numpy.array([(entry[0],entry[2],entry[4]) for entry in block],dtype=float)
+
+        constants,delta = batch_solve(obs_freqs,model,free)
+
+        reasonable = (constants[:,0]>=constants[:,1]) & (constants[:,1]>=constants[:,2]) & (constants[:,2]>0)
+        check_omc = check_median_omc(delta,model,peak_freqs)
+
+        if keep_fraction == None:
+            keep = reasonable & (check_omc <= confirm_omc)
+        else: # Best keep_fraction of the block; the stable sort keeps ties in scaled_diff order
+            ranked = numpy.nonzero(reasonable)[0]
+            ranked = ranked[numpy.argsort(check_omc[ranked],kind='mergesort')]
+            keep = numpy.zeros(len(block),dtype=bool)
+            keep[ranked[0:int(math.ceil(keep_fraction*len(block)))]] = True
+
+        reasonable = reasonable.tolist()
+        keep = keep.tolist()
+        for x in range(len(block)): # Counted a triple at a time, so the counts always cover exactly the triples passed on so far
+            stats['screened'] += 1
+            if not reasonable[x]:
+                stats['rejected_constants'] += 1
+            elif not keep[x]:
+                stats['rejected_omc'] += 1
+            if keep[x]:
+                yield block[x]
+            elif audit_every > 0:
+                rejected_count += 1
+                if rejected_count % audit_every == 0:
+                    stats['audited'] += 1
+                    yield block[x]
+
+def check_median_omc(delta,model,peak_freqs): # Median omc of the predicted check transitions of each fit in a block
+    if len(model['check_freqs']) == 0:
+        return numpy.zeros(len(delta))
+    return numpy.median(triples_scoring_module.nearest_peaks(batch_predict(delta,model),peak_freqs)[0],axis=1)
+
+def cascade_compare(entry,exact_constants,exact_check_freqs,model,peak_freqs,free=(True,True,True),confirm_omc=2.0):
+
+    """ Compares the screen's estimate for one triple with its SPFIT fit.  Returns (whether the two disagree about the
+    median check omc being within confirm_omc, largest A/B/C difference in MHz)."""
+
+    obs_freqs = numpy.array([(entry[0],entry[2],entry[4])],dtype=float)
+    constants,delta = batch_solve(obs_freqs,model,free)
+    cheap_pass = check_median_omc(delta,model,peak_freqs)[0] <= confirm_omc
+    if len(exact_check_freqs) > 0:
+        exact_pass = numpy.median(triples_scoring_module.nearest_peaks(numpy.array(exact_check_freqs,dtype=float),peak_freqs)[0]) <= confirm_omc
+    else:
+        exact_pass = True
+    return bool(cheap_pass != exact_pass),float(numpy.abs(constants[0]-numpy.array(exact_constants,dtype=float)).max())
+
+def write_cascade_stats(file_num,fits,disagreements,const_dev): # Appends one process's cascade comparison counts to cascade_stats%s.txt
+    fh = open("cascade_stats%s.txt"%(str(file_num)),"a")
+    fh.write("%s %s %s\n"%(fits,disagreements,const_dev))
+    fh.close()
+
+def save_screen_stats(stats): # Appends the screen counts of a paused run to SCREEN_STATS_FILE, for the report once the search is done
+    if stats == {}:
+        return
+    fh = open(SCREEN_STATS_FILE,"a")
+    fh.write("%s\n"%(repr(stats)))
+    fh.close()
+
+def clear_cascade_stats(job_dir="."): # A new search in job_dir starts its cascade counts from 0; only a resume adds to them
+    for filename in glob.glob(os.path.join(job_dir,"cascade_stats*.txt"))+glob.glob(os.path.join(job_dir,SCREEN_STATS_FILE)):
+        os.remove(filename)
+
+def cascade_report(stats,confirm_omc=2.0,keep_fraction=None):
+
+    """ Adds up the screen counts in stats (and those the runs before a resume saved), and the cascade_stats*.txt files of
+    the processes, writes cascade_report.txt in the job directory and returns its text."""
+
+    stats = dict(stats)
+    if os.path.exists(SCREEN_STATS_FILE):
+        fh = open(SCREEN_STATS_FILE)
+        for line in fh:
+            if line.strip() != "":
+                saved = ast.literal_eval(line.strip())
+                for key in saved:
+                    stats[key] = stats.get(key,0)+saved[key]
+        fh.close()
+
+    fits = 0
+    disagreements = 0
+    const_dev = 0.0
+    for filename in glob.glob("cascade_stats*.txt"):
+        fh = open(filename)
+        for line in fh:
+            if line.split() != []:
+                fits += int(line.split()[0])
+                disagreements += int(line.split()[1])
+                const_dev += float(line.split()[2])
+        fh.close()
+
+    if keep_fraction == None:
+        report = "screen: median check omc <= %s MHz\n"%(str(confirm_omc))
+    else:
+        report = "screen: best %s of each block\n"%(str(keep_fraction))
+    report += "triples screened: %s\n"%(str(stats.get('screened',0)))
+    report += "rejected for unphysical constants: %s\n"%(str(stats.get('rejected_constants',0)))
+    report += "rejected for check omc: %s\n"%(str(stats.get('rejected_omc',0)))
+    report += "rejected triples fit anyway (audit): %s\n"%(str(stats.get('audited',0)))
+    report += "triples fit with SPFIT: %s\n"%(str(fits))
+    if fits > 0:
+        report += "screen and SPFIT disagree on check omc <= %s MHz: %s (%.2f%%)\n"%(str(confirm_omc),str(disagreements),100.0*disagreements/fits)
+        report += "average largest A/B/C difference, screen vs SPFIT: %.4f MHz\n"%(const_dev/fits)
+
+    fh = open("cascade_report.txt","w")
+    fh.write(report)
+    fh.close()
+    return report
+
+def line_quadratic(along,direction,hessian): # (c0,c1,c2) per pair of 0.5*(along+t*direction).hessian.(along+t*direction), a polynomial in t
+    return (0.5*numpy.einsum('nma,ab,nmb->nm',along,hessian,along),numpy.einsum('nma,ab,b->nm',along,hessian,direction),0.5*numpy.dot(direction,numpy.dot(hessian,direction)))
+
+def largest_quadratic(quadratic,low,high): # Largest |c0 + c1*t + c2*t**2| over t in [low, high] (finite) of each pair
+    (c0,c1,c2) = quadratic
+    largest = numpy.maximum(numpy.abs(c0+c1*low+c2*low**2),numpy.abs(c0+c1*high+c2*high**2))
+    if c2 != 0:
+        vertex = -c1/(2*c2)
+        largest = numpy.where((vertex > low) & (vertex < high),numpy.maximum(largest,numpy.abs(c0+c1*vertex+c2*vertex**2)),largest)
+    return largest
+
+def pair_segments(list_a,list_b,list_c,model,free=(True,True,True),slack=5.0,max_shift=None):
+
+    """ The first-order line of constants through every trans_1 peak x trans_2 peak pair, as arrays of shape
+    (len(list_a), len(list_b)): the part of the line allowed by the bounds in admissible_pairs is t in [low, high], and
+    trans_3 moves along it as pred_3 + t*slope_3, to within error_3 MHz.  Returns (admissible,low,high,pred_3,slope_3,
+    error_3), or None if the two transitions don't pin anything down (empty window, fewer than two free constants or
+    parallel gradients).
+
+    Every bound is widened by slack plus the most the model's quadratic term moves it over the pair's segment: off the
+    line by 0.5*shift.H.shift in trans_1 and trans_2, the constants move by inverse times that and trans_3 by its own
+    quadratic term less jacobian[2].inverse times it, so each bound has a Hessian of its own, which is evaluated along the
+    line.  Widening the bounds widens the segment, so the two are iterated until the segment stops growing; a pair whose
+    segment doesn't settle in SEGMENT_ITERATIONS, or runs off to infinity, is kept whole.  A pair outside the bounds on
+    the line itself, before the quadratic term, is still dropped."""
+
+    free = numpy.array(free,dtype=bool)
+    freqs = model['fit_freqs']
+    jacobian = model['fit_jacobian']
+    hessian = model['fit_hessian']
+    constants = model['constants']
+    if len(list_a) == 0 or len(list_b) == 0 or len(list_c) == 0 or free.sum() < 2 or numpy.linalg.matrix_rank(jacobian[0:2][:,free]) < 2:
+        return None
+
+    inverse = numpy.zeros((3,2))
+    inverse[free] = numpy.linalg.pinv(jacobian[0:2][:,free])
+    direction = numpy.zeros(3)
+    if free.all(): # Shifts along the cross product don't move trans_1 or trans_2
+        direction = numpy.cross(jacobian[0],jacobian[1])
+        direction = direction/numpy.abs(direction).max()
+
+    resid_a = numpy.array([float(freq) for freq,inten in list_a]) - freqs[0]
+    resid_b = numpy.array([float(freq) for freq,inten in list_b]) - freqs[1]
+    point = constants + resid_a[:,numpy.newaxis,numpy.newaxis]*inverse[:,0] + resid_b[numpy.newaxis,:,numpy.newaxis]*inverse[:,1] # Constants on each pair's line, at t = 0
+    freqs_c = [float(freq) for freq,inten in list_c]
+    pred_3 = freqs[2] + numpy.dot(point-constants,jacobian[2])
+    slope_3 = numpy.dot(direction,jacobian[2])
+
+    hessian_const = -numpy.einsum('kj,jab->kab',inverse,hessian[0:2]) # Second order of each constant along the pair's curve
+    hessian_3 = hessian[2]-numpy.einsum('j,jab->ab',numpy.dot(jacobian[2],inverse),hessian[0:2]) # and of trans_3
+    along = point-constants
+    quadratics = [line_quadratic(along,direction,hessian_3),line_quadratic(along,direction,hessian_const[0]-hessian_const[1]),
+                  line_quadratic(along,direction,hessian_const[1]-hessian_const[2])]+[line_quadratic(along,direction,hessian_const[k]) for k in range(3)]
+
+    def bounds(error): # (low,high,admissible) with error[i] (trans_3, A-B, B-C, A, B, C) added to the bounds
+        constraints = [(pred_3-min(freqs_c)+slack+error[0],slope_3),(max(freqs_c)+slack+error[0]-pred_3,-slope_3), # Each is offset + t*slope >= 0
+                       (point[:,:,0]-point[:,:,1]+slack+error[1],direction[0]-direction[1]),(point[:,:,1]-point[:,:,2]+slack+error[2],direction[1]-direction[2]),
+                       (point[:,:,2]+error[5],direction[2])]
+        if max_shift != None:
+            for k in range(3):
+                constraints.append((max_shift*constants[k]-(point[:,:,k]-constants[k])+slack+error[3+k],-direction[k]))
+                constraints.append((max_shift*constants[k]+(point[:,:,k]-constants[k])+slack+error[3+k],direction[k]))
+        admissible = numpy.ones(point.shape[0:2],dtype=bool)
+        low = numpy.zeros(admissible.shape)-numpy.inf
+        high = numpy.zeros(admissible.shape)+numpy.inf
+        for offset,slope in constraints:
+            if slope > 0:
+                low = numpy.maximum(low,-offset/slope)
+            elif slope < 0:
+                high = numpy.minimum(high,-offset/slope)
+            else:
+                admissible &= offset >= 0
+        return low,high,admissible & (low <= high)
+
+    if not direction.any(): # No line, one constant is fixed: the pair is a point, t = 0
+        zero = numpy.zeros(pred_3.shape)
+        error = [largest_quadratic(quadratic,zero,zero) for quadratic in quadratics]
+        (low,high,admissible) = bounds(error)
+        return admissible,low,high,pred_3,slope_3,slack+error[0]
+
+    # Widening the bounds by the quadratic term over the segment widens the segment, until it stops growing
+    (low,high,admissible) = bounds([0.0]*len(quadratics))
+    (span_low,span_high) = (numpy.where(admissible,low,0.0),numpy.where(admissible,high,0.0))
+    unbounded = admissible & ~(numpy.isfinite(low) & numpy.isfinite(high))
+    growing = admissible & ~unbounded
+    for iteration in range(SEGMENT_ITERATIONS):
+        if not growing.any():
+            break
+        with numpy.errstate(over='ignore',invalid='ignore'):
+            error = [largest_quadratic(quadratic,numpy.where(growing,span_low,0.0),numpy.where(growing,span_high,0.0)) for quadratic in quadratics]
+            (low,high,admissible) = bounds(error)
+            new_low = numpy.where(growing,numpy.minimum(span_low,low),span_low)
+            new_high = numpy.where(growing,numpy.maximum(span_high,high),span_high)
+            grown = growing & ((new_low < span_low-SEGMENT_TOLERANCE) | (new_high > span_high+SEGMENT_TOLERANCE))
+        (span_low,span_high) = (new_low,new_high)
+        unbounded |= growing & ~(numpy.isfinite(span_low) & numpy.isfinite(span_high))
+        growing = grown & ~unbounded
+    unbounded |= growing # Still growing: the quadratic term isn't small enough along this line to bound it
+
+    span_low = numpy.where(unbounded,0.0,span_low)
+    span_high = numpy.where(unbounded,0.0,span_high)
+    first_order = bounds([0.0]*len(quadratics))[2]
+    error = [largest_quadratic(quadratic,span_low,span_high) for quadratic in quadratics]
+    (low,high,admissible) = bounds(error)
+    admissible = (admissible & first_order) | unbounded # A pair outside the bounds on the line itself stays dropped
+    low = numpy.where(unbounded,-numpy.inf,low)
+    high = numpy.where(unbounded,numpy.inf,high)
+    error_3 = numpy.where(unbounded,numpy.inf,slack+error[0])
+    return admissible,low,high,pred_3,slope_3,error_3
+
+def admissible_pairs(list_a,list_b,list_c,model,free=(True,True,True),slack=5.0,max_shift=None):
+
+    """ Boolean array of shape (len(list_a), len(list_b)): whether a trans_1 peak and a trans_2 peak can be part of the same
+    fit.  To first order the two peaks pin A, B and C to a line (to a point if one constant is fixed); the pair is kept if
+    somewhere on that line A >= B >= C > 0 and trans_3 lands inside the list_c window, to within slack MHz plus what the
+    model's curvature can move them over that part of the line (pair_segments).  max_shift (fraction) also keeps every
+    constant within that much of the guess; that's a prior on the constants, not a necessary condition, so it's off
+    (None) by default."""
+
+    segments = pair_segments(list_a,list_b,list_c,model,free,slack,max_shift)
+    if segments == None:
+        return numpy.ones((len(list_a),len(list_b)),dtype=bool) # Nothing to go on; keep every pair
+    return segments[0]
+
+def trans_3_windows(list_a,list_b,list_c,model,free=(True,True,True),slack=5.0,max_shift=None):
+
+    """ (low,high) arrays of shape (len(list_a), len(list_b)): the trans_3 frequencies each trans_1/trans_2 peak pair can
+    reach on the admissible part of its line (see admissible_pairs), widened by slack and the most the model's quadratic
+    term moves trans_3 over it (pair_segments' error_3).  Pairs that aren't admissible get low > high; if the model can't
+    tell anything every pair gets the whole real line."""
+
+    segments = pair_segments(list_a,list_b,list_c,model,free,slack,max_shift)
+    if segments == None:
+        return numpy.zeros((len(list_a),len(list_b)))-numpy.inf,numpy.zeros((len(list_a),len(list_b)))+numpy.inf
+    (admissible,low,high,pred_3,slope_3,error_3) = segments
+    if slope_3 == 0: # trans_3 doesn't move along the line (or there's no line, one constant is fixed)
+        freq_low = pred_3-error_3
+        freq_high = pred_3+error_3
+    else:
+        with numpy.errstate(invalid='ignore'): # Inadmissible pairs can have low = inf or high = -inf
+            freq_low = pred_3+slope_3*numpy.where(slope_3 > 0,low,high)-error_3
+            freq_high = pred_3+slope_3*numpy.where(slope_3 > 0,high,low)+error_3
+    freq_low = numpy.where(admissible,freq_low,numpy.inf)
+    freq_high = numpy.where(admissible,freq_high,-numpy.inf)
+    return freq_low,freq_high
+
+def window_count(window,list_c): # Number of list_c peaks inside each pair's trans_3 window, summed over all pairs
+    freqs_c = numpy.sort([float(freq) for freq,inten in list_c])
+    (freq_low,freq_high) = window
+    return int((numpy.searchsorted(freqs_c,freq_high,side='right')-numpy.searchsorted(freqs_c,freq_low,side='left')).clip(0).sum())
+
+def pair_mask(list_a,list_b,list_c,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature="2",free=(True,True,True)): # admissible_pairs with its own model (19 SPCAT runs; the cross terms go into its bound on the model error)
+    model = linear_model(trans_1,trans_2,trans_3,[],A,B,C,DJ,DJK,DK,dJ,dK,temperature)
+    return admissible_pairs(list_a,list_b,list_c,model,free)
+
+def pair_filter(pair_prune,list_a,list_b,list_c,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature="2",free=(True,True,True)):
+
+    """ What the pair_prune setting hands to best_first_triples, and how many triples that leaves: returns
+    (pair_mask,pair_window,num_of_triples).  pair_prune is False (every triple), True (admissible pairs only) or "sweep"
+    (each pair only with the trans_3 peaks inside its own trans_3 interval)."""
+
+    num_of_triples = len(list_a)*len(list_b)*len(list_c)
+    if num_of_triples == 0 or pair_prune in (False,"False"):
+        return None,None,num_of_triples
+    if pair_prune == "sweep":
+        window = pair_window(list_a,list_b,list_c,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature,free)
+        return None,window,window_count(window,list_c)
+    mask = pair_mask(list_a,list_b,list_c,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature,free)
+    return mask,None,int(mask.sum())*len(list_c)
+
+def pair_window(list_a,list_b,list_c,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature="2",free=(True,True,True)): # trans_3_windows with its own model (19 SPCAT runs; the cross terms go into its bound on the model error)
+    model = linear_model(trans_1,trans_2,trans_3,[],A,B,C,DJ,DJK,DK,dJ,dK,temperature)
+    return trans_3_windows(list_a,list_b,list_c,model,free)
@@ -3,6 +3,7 @@ import matplotlib
 
 import numpy as np
 import subprocess
+import prediction_cache_module
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, RadioButtons, CheckButtons
 from PyQt4.QtCore import *
@@ -483,28 +484,18 @@ def var_writer_uncert(A,B,C,DJ='0.0',DJK='0.0',DK='0.0',dJ='0.0',dK='0.0'):#gene
 
 
 def run_SPCAT(): 
-    a = subprocess.Popen('SPCAT default', stdout=subprocess.PIPE, shell=False)
-    a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen
+    prediction_cache_module.run_spcat("default",lambda: subprocess.Popen('SPCAT default', stdout=subprocess.PIPE, shell=False).stdout.read()) # Only run for a .var/.int it hasn't predicted; reading stdout is what waits for SPCAT
  
 def cat_reader(): #reads output from SPCAT
-    fh = open("default.cat")
     freq_high=float(f_upper_g)
     #print freq_high,freq_low
     
     freq_low=float(f_lower_g)
     linelist = []
-    for line in fh:
-        if line[8:9]==".": 
-
-            freq = line[3:13]
-            inten = line[22:29]
-            qnum_up = line[55:61]
-            qnum_low = line[67:73]
-            uncert = line[13:21]
-            #if float(freq)> freq_low and float(freq)<freq_high:#<<<<<<<<<<<<<<<<<<<<
-            linelist.append((freq,inten, qnum_up, qnum_low,uncert))
+    for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog("default"): # Parsed once per catalog
+        #if value > freq_low and value < freq_high:#<<<<<<<<<<<<<<<<<<<<
+        linelist.append((freq,inten, qnum_up, qnum_low,uncert))
     linelist.sort()
-    fh.close()
     return linelist
 
 
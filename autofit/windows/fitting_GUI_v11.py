@@ -2,6 +2,8 @@ import sys, os, random
 
 import fitting_GUI_B_v11
 import autofit_NS_module
+import prediction_cache_module
+import line_derivatives_module
 from time import sleep
 import subprocess
 from multiprocessing import Process
@@ -131,30 +133,16 @@ class AppForm(QMainWindow):
         fh_var.write(input_file)
         fh_var.close()
     def run_SPCAT(self): 
-        a = subprocess.Popen("SPCAT default", stdout=subprocess.PIPE, shell=False)
-        a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen 
+        prediction_cache_module.run_spcat("default",lambda: subprocess.Popen("SPCAT default", stdout=subprocess.PIPE, shell=False).stdout.read()) # Only run for a .var/.int it hasn't predicted; reading stdout is what waits for SPCAT 
 
 	 
     def cat_reader(self,freq_high,freq_low,flag="default"): #reads output from SPCAT
         
-        if flag == "default":
-            fh = open("default.cat")
-    
-        if flag == "refit":
-            fh = open("refit.cat")
-    
         linelist = []
-        for line in fh:
-            if line[8:9]==".": 
-                freq = line[3:13]
-                inten = line[22:29]
-                qnum_up = line[55:61]
-                qnum_low = line[67:73]
-                uncert = line[13:21]
-                if float(freq)> freq_low and float(freq)<freq_high:#<<<<<<<<<<<<<<<<<<<<
-                    linelist.append((inten,freq, qnum_up, qnum_low,uncert))
+        for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog(flag): # flag is the file name, parsed once per catalog
+            if value > freq_low and value < freq_high:#<<<<<<<<<<<<<<<<<<<<
+                linelist.append((inten,freq, qnum_up, qnum_low,uncert))
         linelist.sort()
-        fh.close()
         return linelist 	 
     def int_writer(self,u_A,u_B,u_C, J_min="00", J_max='20', inten="-10.0",Q_rot="300000",freq="25.8", temperature="298", flag="default"):#generates SPCAT input file
         input_file = ""
@@ -493,8 +481,8 @@ class AppForm(QMainWindow):
         
         if triple_style == 'Automatic scoring':
             #total_check_num = 10 # This is the number of peaks used to generate possible triples, ordered by intensity. 10 = 120 possibilities, 15 = 455 possibilities.
-            if len(full_list)>10:
-                total_check_num=10
+            if len(full_list)>line_derivatives_module.TRIPLE_POOL: # All the triples' dependences come from one derivative table, so the pool can be bigger than the old 10
+                total_check_num=line_derivatives_module.TRIPLE_POOL
             else:
                 total_check_num = len(full_list)
             triples_scores = []
@@ -502,6 +490,8 @@ class AppForm(QMainWindow):
             max_dependence = 0
             max_RMS = 0
             max_intensity = 0
+            table = self.derivative_table(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),temperature,u_A,u_B,u_C,main_flow,full_list[0:total_check_num]) # Six SPCAT runs for all the triples
+            pool_dependences = line_derivatives_module.pool_dependences(table,full_list[0:total_check_num])
     
             for i in range(0,total_check_num-2):
                 for j in range(i+1,total_check_num-1):
@@ -511,7 +501,7 @@ class AppForm(QMainWindow):
                         trans_2 = full_list[j]
                         
                         trans_3 = full_list[k]
-                        dependence = abs(self.dependence_test(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),trans_1,trans_2,trans_3,temperature,freq_high,freq_low,u_A,u_B,u_C,main_flow))
+                        dependence = abs(pool_dependences[(i,j,k)])
                         worst_RMS = max(float(trans_1[4]),float(trans_2[4]),float(trans_3[4]))
                         RMS_ratio = (worst_RMS/min(float(trans_1[4]),float(trans_2[4]),float(trans_3[4])))
                         RMS_function = RMS_ratio*worst_RMS
@@ -618,50 +608,22 @@ class AppForm(QMainWindow):
             if trans_3[2] == peak[2] and trans_3[3] == peak[3]:
                 peak_3_freq = peak[1]
         return peak_1_freq,peak_2_freq,peak_3_freq
-    def dependence_test(self,A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
-        self.int_writer(u_A,u_B,u_C, J_min="00", J_max=int(self.J_max_box.text()), inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
-    
-        self.var_writer(A+(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        high_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
-    
-        self.var_writer(A-(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        low_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
-    
-        dv1A = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-        dv2A = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-        dv3A = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
+    def derivative_table(self,A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,lines): # line_derivatives_module.derivative_table of lines on default.var/.int; leaves default.cat at A, B, C
+        (J_min,J_max,inten,freq) = prediction_cache_module.prediction_limits(lines,line_derivatives_module.STEP) # Only what lines need
+        self.int_writer(u_A,u_B,u_C, J_min=J_min, J_max=J_max, inten=inten,Q_rot="300000",freq=freq, temperature=T, flag = "default")
     
-        self.var_writer(A,B+(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        high_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
+        def predict(A,B,C):
+            self.var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
+            self.run_SPCAT()
+            return self.cat_reader(1000000, 0, flag="default")
     
-        self.var_writer(A,B-(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        low_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
-    
-        dv1B = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-        dv2B = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-        dv3B = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-    
-        self.var_writer(A,B,C+(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        high_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
-    
-        self.var_writer(A,B,C-(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-        self.run_SPCAT()
-        low_peak_freq = self.trans_freq_reader(trans_1, trans_2, trans_3)
-    
-        dv1C = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-        dv2C = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-        dv3C = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-    
-        self.var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")	# This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
-        self.run_SPCAT()
-    
-        matrix = numpy.array([(dv1A,dv1B,dv1C),(dv2A,dv2B,dv2C),(dv3A,dv3B,dv3C)])
-        return numpy.linalg.det(matrix)
+        table = line_derivatives_module.derivative_table(predict,A,B,C)
+        self.int_writer(u_A,u_B,u_C, J_min="00", J_max=int(self.J_max_box.text()), inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
+        predict(A,B,C) # This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
+        return table
+    def dependence_test(self,A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
+        table = self.derivative_table(A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,[trans_1,trans_2,trans_3])
+        return line_derivatives_module.dependences(table,[(trans_1,trans_2,trans_3)])[0]
                                                                              
                                     
     def selectFile_spectrum(self):
@@ -2,15 +2,32 @@ import subprocess
 import os
 from easygui import *
 import sys
+import multiprocessing
 from multiprocessing import Process
 import re
 import numpy
+import heapq
 import random
 import string
 import math
 from collections import OrderedDict
 import shutil
 from scipy.interpolate import *
+import batch_fit_module
+import triples_enum_module
+import triples_queue_module
+import triples_checkpoint_module
+import triples_scoring_module
+import triples_results_module
+import triples_hits_module
+import triples_progress_module
+import triples_store_module
+import triples_timing_module
+import program_call_module
+import prediction_cache_module
+import line_derivatives_module
+import triples_workers_module
+import triples_sandbox_module
 
 """"
 Python Triples Fitter
@@ -31,6 +48,56 @@ multiple potential steps of user interaction because the initial list of fitting
 An alternate approach for this module would be to have it process a single isotopologue, with all of the other heavy lifting being
 done by the GUI.  That can be done by isotopologue_module_b.
 
+-isotopologue_fit takes an engine argument.  engine="batch" screens the triples of each isotopologue with batch_fit_module
+(linear model built around the predicted isotopologue constants) before they're fit with SPFIT; the default engine="spfit"
+fits every triple with SPFIT.  confirm_omc, keep_fraction and audit_every tune that screen (see batch_fit_module); its
+rejected counts and disagreements with SPFIT go to cascade_report.txt in each isotopologue folder.
+
+-isotopologue_fit takes top_k and min_score for early-abort scoring in fit_triples (see autofit_NS_module): check lines
+are scored strongest first and fits that can't make the process's top_k or reach min_score hits are dropped.
+
+-pair_prune=True drops trans_1/trans_2 peak pairs that can't come from physical constants with trans_3 in its window
+(batch_fit_module.admissible_pairs) before the triples are enumerated; triples_gen counts the pruned triples.
+pair_prune="sweep" also combines each pair only with the trans_3 peaks inside its own trans_3 interval.
+
+-The fit_triples processes send their best result lines to isotopologue_fit on a result queue and the sorted_*_cat and
+best100 files are written in memory from them (triples_results_module), with no sort -r or cat | sort.
+
+-Result lines also go to the columnar result store results%s.bin in the isotopologue's folder (triples_store_module).
+
+-dedup_tol > 0 scores each set of constants (A, B and C to within dedup_tol MHz) once per process and counts the repeats,
+written to fit_multiplicity_<isotope>.txt (see autofit_NS_module).
+
+-Rerunning an isotopologue in its existing folder only fits the triples that aren't in its evaluated%s.bin index yet and
+merges them with the earlier results (see autofit_NS_module).
+
+-hit_sigma and stop_hits turn on the anytime search (triples_hits_module): hits are written to hits%s.txt as they're
+found and the search stops once stop_hits of them agree.
+
+-The search's progress is shown on the terminal and written to status.json in the isotopologue's folder
+(triples_progress_module).
+
+-fit_triples gets its triples from triples_enum_module.best_first_triples (lazy, ascending scaled_diff) instead of sorting the
+full list of combinations and going through all_combo_list%s.txt.
+
+-Check transitions are scored with triples_scoring_module.score_fits (searchsorted nearest-peak lookup) instead of walking
+a quarter of the peak list for each one.
+
+-Processes no longer get an equal slice of a shuffled peak window each.  The driver enumerates every triple once in global
+scaled_diff order and hands them out in chunks through a queue (triples_queue_module); each fit_triples process pulls its
+next chunk as soon as it's free.
+
+-engine "lib" (isotopologue_fit) fits the triples with SPFIT run from libcalpgm.so in a helper child of each fit_triples
+process, on the .par and .lin text in memory (program_call_module.library_runs), with the same timeout as SPFIT.EXE;
+SPFIT.EXE where the library can't be loaded, or once it keeps hanging or crashing.
+
+-run_SPCAT and cat_reader go through prediction_cache_module: a .var and .int that were already predicted aren't run
+through SPCAT again, and each catalog is parsed once.
+
+-triple_selection and dependence_test get the dependences from one derivative table (line_derivatives_module), six SPCAT
+runs for all the candidate triples, and the candidate pool is the 20 strongest lines instead of 10.
+Those six runs only predict the J, frequency and intensity range of the lines being scored (prediction_limits).
+
 
 """
 def int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="25.8", temperature="298", flag="default"):#generates SPCAT input file
@@ -96,29 +163,15 @@ def var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag):#generates SPCAT input file
     fh_var.close()
 
 def run_SPCAT(): 
-    a = subprocess.Popen("SPCAT default", stdout=subprocess.PIPE, shell=False)
-    a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen
+    prediction_cache_module.run_spcat("default",lambda: program_call_module.check_program("SPCAT default",["default.cat"])) # Raises ProgramError if SPCAT hangs or writes no .cat; not run again for a .var/.int it has predicted
  
 def cat_reader(freq_high,freq_low,flag): #reads output from SPCAT
 
-    if flag == "default":
-        fh = open("default.cat")
-
-    if flag == "refit":
-        fh = open("refit.cat")
-
     linelist = []
-    for line in fh:
-        if line[8:9]==".": 
-            freq = line[3:13]
-            inten = line[22:29]
-            qnum_up = line[55:61]
-            qnum_low = line[67:73]
-            uncert = line[13:21]
-            if float(freq)> freq_low and float(freq)<freq_high:#<<<<<<<<<<<<<<<<<<<<
-                linelist.append((inten,freq, qnum_up, qnum_low,uncert))
+    for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog(flag): # flag is the file name, parsed once per catalog
+        if value > freq_low and value < freq_high:#<<<<<<<<<<<<<<<<<<<<
+            linelist.append((inten,freq, qnum_up, qnum_low,uncert))
     linelist.sort()
-    fh.close()
     return linelist
     
 def trans_freq_reader(trans_1, trans_2, trans_3):
@@ -287,7 +340,7 @@ def final_uncerts(trans_1_center,trans_2_center,trans_3_center,peak_1_uncertaint
     return trans_1,trans_2,trans_3,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty
 
 
-def triples_gen(trans_1_uncert,trans_2_uncert,trans_3_uncert,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3):
+def triples_gen(trans_1_uncert,trans_2_uncert,trans_3_uncert,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,pair_prune=False,pair_constants=None):
 
     trans_1_center = float(trans_1[1])
     trans_2_center = float(trans_2[1])
@@ -326,6 +379,10 @@ def triples_gen(trans_1_uncert,trans_2_uncert,trans_3_uncert,peak_1_uncertainty,
                 if abs(float(trans_3_center)-float(freq_p))< peak_3_uncertainty:
                     trans_3_peaks.append((freq_p, inten_p))
             num_of_triples = len(trans_1_peaks)*len(trans_2_peaks)*len(trans_3_peaks) #this tells you how many entries there will be in the all_combo_list
+            if pair_prune and num_of_triples != 0: # Only what best_first_triples will enumerate after the pair pruning or sweep
+                if pair_constants == None:
+                    pair_constants = (A,B,C)
+                num_of_triples = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_constants[0],pair_constants[1],pair_constants[2],DJ,DJK,DK,dJ,dK,temperature)[2]
                                     
             # Leave in for now.
             if isotopomer_count == 0:
@@ -378,12 +435,14 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
         triple_style = 'Manual selection'
 
     if triple_style == 'Automatic scoring':
-        total_check_num = 10 # This is the number of peaks used to generate possible triples, ordered by intensity. 10 = 120 possibilities, 15 = 455 possibilities.
+        total_check_num = min(len(full_list),line_derivatives_module.TRIPLE_POOL) # This is the number of peaks used to generate possible triples, ordered by intensity. 10 = 120 possibilities, 20 = 1140 possibilities.
         triples_scores = []
         scaled_triples_scores = []
         max_dependence = 0
         max_RMS = 0
         max_intensity = 0
+        table = derivative_table(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),temperature,u_A,u_B,u_C,main_flow,full_list[0:total_check_num]) # Six SPCAT runs for all the triples
+        pool_dependences = line_derivatives_module.pool_dependences(table,full_list[0:total_check_num])
 
         for i in range(0,total_check_num-2):
             for j in range(i+1,total_check_num-1):
@@ -392,7 +451,7 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
                     trans_1 = full_list[i]
                     trans_2 = full_list[j]
                     trans_3 = full_list[k]
-                    dependence = abs(dependence_test(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),trans_1,trans_2,trans_3,temperature,freq_high,freq_low,u_A,u_B,u_C,main_flow))
+                    dependence = abs(pool_dependences[(i,j,k)])
                     worst_RMS = max(float(trans_1[4]),float(trans_2[4]),float(trans_3[4]))
                     RMS_ratio = (worst_RMS/min(float(trans_1[4]),float(trans_2[4]),float(trans_3[4])))
                     RMS_function = RMS_ratio*worst_RMS
@@ -430,7 +489,7 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
 
         msg = "Choose a triples combination.  The second number is the triples score, ranging from 0 to 100 with 100 being the best possible.  The third number is the highest uncertainty in MHz from the triple."
         title = "Microwave Fitting Program"
-        choice = choicebox(msg,title,triples_choice_list)
+        choice = choicebox(msg,title,line_derivatives_module.best_choices(triples_choice_list)) # Only the best TRIPLE_CHOICES of the pool's triples
         clean_choice = choice[2:-1].split(",")
 
         highest_uncert = float(clean_choice[2])
@@ -482,50 +541,23 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
     
     return highest_uncert,trans_1,trans_2,trans_3
 
-def dependence_test(A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
-    int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
-
-    var_writer(A+(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A-(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    dv1A = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2A = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3A = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-
-    var_writer(A,B+(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A,B-(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
+def derivative_table(A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,lines): # line_derivatives_module.derivative_table of lines on default.var/.int; leaves default.cat at A, B, C
+    (J_min,J_max,inten,freq) = prediction_cache_module.prediction_limits(lines,line_derivatives_module.STEP) # Only what lines need
+    int_writer(u_A,u_B,u_C, J_min=J_min, J_max=J_max, inten=inten,Q_rot="300000",freq=freq, temperature=T, flag = "default")
 
-    dv1B = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2B = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3B = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-
-    var_writer(A,B,C+(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A,B,C-(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    dv1C = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2C = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3C = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
+    def predict(A,B,C):
+        var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
+        run_SPCAT()
+        return cat_reader(1000000, 0, flag="default")
 
-    var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")	# This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
-    run_SPCAT()
+    table = line_derivatives_module.derivative_table(predict,A,B,C)
+    int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
+    predict(A,B,C) # This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
+    return table
 
-    matrix = numpy.array([(dv1A,dv1B,dv1C),(dv2A,dv2B,dv2C),(dv3A,dv3B,dv3C)])
-    return numpy.linalg.det(matrix)
+def dependence_test(A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
+    table = derivative_table(A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,[trans_1,trans_2,trans_3])
+    return line_derivatives_module.dependences(table,[(trans_1,trans_2,trans_3)])[0]
 
 def calcabc(dmatrix):
         
@@ -780,127 +812,96 @@ def isotopomers(expt_A,expt_B,expt_C,atoms_to_vary,a,b,c,mass,atom_list): # Uses
     return output_consts
 
 
-def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK):
-    
-    all_combo_file = "all_combo_list%s.txt"%(str(file_num)) 
-    
-    all_combo_list_file  = open(all_combo_file,"a")
-    
-    temp_list_a = []
-    temp_list_b = []
-    temp_list_c = []
-
-    peak_list_1 = peaklist[0:int(len(peaklist)/4)]#splits peaks into 4 parts to speed up processing
-    peak_list_2 = peaklist[int(len(peaklist)/4):int(len(peaklist)/2)]
-    peak_list_3 = peaklist[int(len(peaklist)/2):int(len(peaklist)*0.75)]
-    peak_list_4 = peaklist[int(len(peaklist)*0.75):len(peaklist)]
-
-    p_1 = float(peak_list_1[0][0])
-    p_2 = float(peak_list_1[-1][0])
-    p_3 = float(peak_list_2[0][0])
-    p_4 = float(peak_list_2[-1][0])
-    p_5 = float(peak_list_3[0][0])
-    p_6 = float(peak_list_3[-1][0])
-    p_7 = float(peak_list_4[0][0])
-    p_8 = float(peak_list_4[-1][0])
-
-
-    pred_ratio = pow(10,max(float(trans_1[0]),float(trans_2[0]),float(trans_3[0]))-min(float(trans_1[0]),float(trans_2[0]),float(trans_3[0])))
-
-    for freq_1,inten_1 in list_a:
-      temp_diff = abs(float(trans_1[1])-float(freq_1))
-      temp_list_a.append((freq_1,inten_1,temp_diff))
-
-    for freq_2,inten_2 in list_b:
-      temp_diff = abs(float(trans_2[1])-float(freq_2))
-      temp_list_b.append((freq_2,inten_2,temp_diff))
-
-    for freq_3,inten_3 in list_c:
-      temp_diff = abs(float(trans_3[1])-float(freq_3))
-      temp_list_c.append((freq_3,inten_3,temp_diff))
-
-    unsorted_full_list = []
-
-    for freq_1,inten_1,diff_1 in temp_list_a:
-        for freq_2,inten_2,diff_2 in temp_list_b:
-            for freq_3,inten_3,diff_3 in temp_list_c:
-                real_ratio = max(float(inten_1),float(inten_2),float(inten_3))/min(float(inten_1),float(inten_2),float(inten_3))
-                avg_diff = (diff_1+diff_2+diff_3)/3
-                scaled_diff = avg_diff*(abs(real_ratio-pred_ratio)+1) # Freq. difference scaled by deviation of intensity ratio from predicted
-                unsorted_full_list.append((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff))
-
-    sorted_full_list = sorted(unsorted_full_list, key=lambda entry: entry[6])
-
-    for freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,total_diff in sorted_full_list:
-        all_combo_list_file.write(str(freq_1)+","+str(inten_1)+","+str(freq_2)+","+str(inten_2)+","+str(freq_3)+","+str(inten_3)+", \n")
-
-    #for freq_1,inten_1,diff_1 in sorted_list_a:#generates all combinations of three peaks from three peaklists
-    #    for freq_2,inten_2,diff_2 in sorted_list_b:
-    #        for freq_3,inten_3,diff_3 in sorted_list_c:
-    #            all_combo_list_file.write(str(freq_1)+","+str(inten_1)+","+str(freq_2)+","+str(inten_2)+","+str(freq_3)+","+str(inten_3)+", \n")
-    
-    all_combo_list_file.close()
-    
-    all_combo_list_file = open(all_combo_file)
+def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK,engine="spfit",batch_model=None,task_queue=None,confirm_omc=2.0,top_k=0,min_score=0,result_queue=None,dedup_tol=0.0,hit_sigma=0.0,progress=None,active=None,pin_cpus=False,in_flight=1,ram_dir=None):
     
+    if peaklist is None: # Mapped from the job directory (triples_store_module.save_peaks), not copied into every process
+        (peak_freqs,peak_intens) = triples_store_module.attach_peaks()
+    else:
+        (peak_freqs,peak_intens) = triples_scoring_module.sorted_peaks(peaklist) # Sorted peak arrays for the nearest-peak lookups in scoring
+    theor_inten = [10**float(entry[0]) for entry in top_17] # Predicted intensities of the check transitions, for the intensity penalty
+    check_order = triples_scoring_module.check_order(theor_inten) # Strongest check transition first, for early-abort scoring
+    best_penalized = [] # Negated avg w/ inten penalty of this process's top_k fits so far (max-heap), for early-abort scoring
+    result_heaps = triples_results_module.new_heaps() # Best result lines of this process for each ranking, sent to the driver at the end
+    output_lines = [] # Result lines for final_output%s.txt since the last flush
+    store_records = [] # Records for results%s.bin, written together with output_lines
+    evaluated_triples = [] # Frequencies of every triple fitted, for the evaluated%s.bin index (incremental reruns)
+    hit_stats = triples_hits_module.new_stats() # Running statistics of this process's fits, for flagging hits (hit_sigma)
+    progress_done = 0 # Triples done and best avg w/ inten penalty, written to the driver's shared progress counters
+    progress_best = float('inf')
+    multiplicity = triples_results_module.Multiplicity() # Constants fitted so far and their counts, with dedup_tol set
+    if pin_cpus:
+        triples_workers_module.pin_cpu(file_num)
+    library = engine == "lib" and program_call_module.library_available() # SPFIT from libcalpgm.so in a helper child of this process; SPFIT.EXE where that can't be loaded
+    if library:
+        in_flight = 1 # One fit at a time, in memory
+        ram_dir = "off"
+    sandbox = triples_sandbox_module.open_sandbox(file_num,ram_dir) # This process's SPFIT files go on the RAM disk if there is one (None: in the job folder)
+    spfit = triples_sandbox_module.spfit_program() # The job folder's one SPFIT, shared by all the processes
+
+
+    def flush(): # Appends what was fitted since the last flush to this process's output files
+        fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
+        fh_final.write("".join(output_lines))
+        fh_final.close()
+        triples_store_module.append_results(file_num,store_records)
+        triples_store_module.append_evaluated(file_num,evaluated_triples)
+        if dedup_tol > 0:
+            multiplicity.save(file_num)
+        del output_lines[:]
+        del store_records[:]
+        del evaluated_triples[:]
+
+    flush_count = 100000
+    if task_queue != None: # Triples handed out by the driver in global scaled_diff order (already screened if engine is "batch")
+        sorted_triples = triples_queue_module.queue_triples(task_queue,file_num,active,in_flight > 1,flush) # Every fit of a chunk goes to disk before the chunk is checkpointed
+    else:
+        sorted_triples = triples_enum_module.best_first_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3) # Lazy, in ascending scaled_diff order; fitting starts right away
+
+    if engine == "batch" and task_queue == None: # Only triples that survive the batched solve get an SPFIT run.
+        sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=confirm_omc,peaks=(peak_freqs,peak_intens)) # peaklist is None if the peaks are mapped
+
+    cascade_fits = 0 # Screen vs SPFIT comparison for the cascade report (engine "batch")
+    cascade_disagreements = 0
+    cascade_const_dev = 0.0
+
     triples_counter = 0
-    output_file = ""
-    regular_counter = 0
     #error_counter = 0
 
-    theor_inten_list = []
-    for x in range(len(top_17)):
-        temp_inten = 10**float(top_17[x][0])
-        theor_inten_list.append(temp_inten)
-
-    theor_inten_ratio = (max(theor_inten_list)/min(theor_inten_list))
-    theor_inten_avg = (sum(theor_inten_list)/len(theor_inten_list))
-    theor_inten_unitless_stdev = numpy.std(theor_inten_list)/theor_inten_avg
 
 
-    for all_combo_line in all_combo_list_file:
-        all_combo_line = all_combo_line.split(",")
-        peaks_triple= [(all_combo_line[0],all_combo_line[1]),(all_combo_line[2],all_combo_line[3]),(all_combo_line[4],all_combo_line[5])]
-        
-
-        input_file = ""
-        input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
-        input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
-        input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
-        input_file += "           10000  %s 1.0E+004 \n" % A
-        input_file += "           20000  %s 1.0E+004 \n" % B
-        input_file += "           30000  %s 1.0E+004 \n" % C
-        input_file += "             200  %s 1.0E-025 \n" % DJ
-        input_file += "            1100  %s 1.0E-025 \n" % DJK
-        input_file += "            2000  %s 1.0E-025 \n" % DK
-        input_file += "           40100  %s 1.0E-025 \n" % dJ
-        input_file += "           41000  %s 1.0E-025 \n" % dK
-        fh_par = open("default%s.par"%(str(file_num)),'w')
-        fh_par.write(input_file)
-        fh_par.close()
-
-        input_file = ""#the next part adds in the three peaks to be fit
-        input_file += trans_1[2][0:2]+' '+trans_1[2][2:4]+' '+trans_1[2][4:6]+' '+\
-                      trans_1[3][0:2]+' '+trans_1[3][2:4]+' '+trans_1[3][4:6]+'                      '+peaks_triple[0][0]+' 0.50 1.0000\n' 
-        input_file += trans_2[2][0:2]+' '+trans_2[2][2:4]+' '+trans_2[2][4:6]+' '+\
-                      trans_2[3][0:2]+' '+trans_2[3][2:4]+' '+trans_2[3][4:6]+'                      '+peaks_triple[1][0]+' 0.50 1.0000\n' 
-        input_file += trans_3[2][0:2]+' '+trans_3[2][2:4]+' '+trans_3[2][4:6]+' '+\
-                      trans_3[3][0:2]+' '+trans_3[3][2:4]+' '+trans_3[3][4:6]+'                      '+peaks_triple[2][0]+' 0.50 1.0000\n'
-        counter = 0
-        for line in top_17:#the hack that adds in the check transitions but doesn't use them in the fit
-            input_file += line[2][0:2]+' '+line[2][2:4]+' '+line[2][4:6]+' '+\
-                      line[3][0:2]+' '+line[3][2:4]+' '+line[3][4:6]+'                      '+'%s.0'%(str(counter))+' 0.00 1.0000\n'
-            counter += 1
-        fh_lin = open("default%s.lin"%(str(file_num)), "w")
-        fh_lin.write(input_file)
-        fh_lin.close()        
-        a = subprocess.Popen("SPFIT%s default%s"%(str(file_num),str(file_num)), stdout=subprocess.PIPE, shell=False)
-        a.stdout.read()#used to let SPFIT finish
+    input_file = "" # The .par is the same for every triple; write_inputs writes it with each triple's .lin
+    input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
+    input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
+    input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
+    input_file += "           10000  %s 1.0E+004 \n" % A
+    input_file += "           20000  %s 1.0E+004 \n" % B
+    input_file += "           30000  %s 1.0E+004 \n" % C
+    input_file += "             200  %s 1.0E-025 \n" % DJ
+    input_file += "            1100  %s 1.0E-025 \n" % DJK
+    input_file += "            2000  %s 1.0E-025 \n" % DK
+    input_file += "           40100  %s 1.0E-025 \n" % dJ
+    input_file += "           41000  %s 1.0E-025 \n" % dK
+    write_inputs = lambda triple,base: program_call_module.write_triple_inputs(base,input_file,triple,trans_1,trans_2,trans_3,top_17)
+    if in_flight > 1 and task_queue == None: # Pipelined runs take the triples in chunks; here the whole search is one
+        sorted_triples = [sorted_triples]
+    if library:
+        spfit_results = program_call_module.library_runs(sorted_triples,input_file,lambda triple: program_call_module.triple_lin(triple,trans_1,trans_2,trans_3,top_17),\
+                                                             fallback=lambda rest: program_call_module.spfit_runs(rest,write_inputs,file_num,program=spfit,folder=sandbox)) # SPFIT.EXE if the library keeps hanging or crashing
+    else:
+        spfit_results = program_call_module.spfit_runs(sorted_triples,write_inputs,file_num,in_flight,program=spfit,folder=sandbox)
+    for (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff),spfit_output,failure in spfit_results:
+        evaluated_triples.append((float(freq_1),float(freq_2),float(freq_3)))
+        progress_done += 1
+        if progress_done <= triples_progress_module.REPORT_EVERY or progress_done % triples_progress_module.REPORT_EVERY == 0: # Each of the first ones too, so the driver sees the process has started and a calibration run (triples_timing_module) counts exactly
+            triples_progress_module.report(progress,file_num,progress_done,progress_best)
+        if failure != None: # Hung or crashed on the retry too; not marked evaluated, so a rerun in this folder tries it again
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),failure)
+            evaluated_triples.pop()
+            continue
 
         const_list = []
 
-        fh_var = open("default%s.var"%(str(file_num)))
-        for line in fh_var:
+        for line in program_call_module.read_output(spfit_output,"var"):
             if line[8:13] == "10000":
                 temp_A = float(line[15:37])
                 const_list.append("%.3f" %temp_A)
@@ -910,15 +911,11 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
             if line[8:13] == "30000":
                 temp_C = float(line[15:37])
                 const_list.append("%.3f" %temp_C)
-        fh_var.close()
 
-        fh_fit = open("default%s.fit"%(str(file_num)))
-        file_list = []
-        for line in fh_fit:
-                file_list.append(line)
-        fh_fit.close()
+        file_list = program_call_module.read_output(spfit_output,"fit")
 
         freq_list = []
+        rms_fit = None
         for x in range(len(file_list)):
             if file_list[-x][11:14] == "RMS":
                 rms_fit = float(file_list[-x][22:32]) #note - assumes RMS fit error is less than 1 GHz.  Change 22 to 21 if this is a problem.
@@ -926,6 +923,10 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 freq_list.append(file_list[-x][60:71])
             if file_list[-x][40:64]=="EXP.FREQ.  -  CALC.FREQ.":
                 break
+        if len(const_list) < 3 or rms_fit == None: # SPFIT exited normally but didn't fit
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),"SPFIT%s wrote no A, B, C or RMS"%(str(file_num)))
+            evaluated_triples.pop()
+            continue
         read_fit = (const_list[0],const_list[1], const_list[2],freq_list)
         triples_counter +=1
         constants = read_fit[0:3]
@@ -934,74 +935,48 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
         A_1 = float(constants[0])
         B_1 = float(constants[1])
         C_1 = float(constants[2])
-        omc_list = []
-        
-        for x in range(len(top_17)): #matches peaks in the top 17 to peaks in experimental peak list <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-            real_omc = 1.0
-            current_peak = float(freq_17[x])
-            if current_peak>p_1 and current_peak<p_2:#conditionals to find proper portion of experimental peak list to loop through
-                peaks_section = peak_list_1
-                peak = p_2
-                regular_counter +=1
-            elif current_peak>p_3 and current_peak<p_4:
-                peaks_section = peak_list_2
-                peak = p_4
-                regular_counter +=1
-            elif current_peak>p_5 and current_peak<p_6:
-                peaks_section = peak_list_3
-                peak = p_6
-                regular_counter +=1
-            elif current_peak>p_7 and current_peak<p_8:
-                peaks_section = peak_list_4
-                peak = p_8
-                regular_counter +=1
-            elif current_peak>p_8 or current_peak<p_1:
-                peaks_section = peaklist
-                peak = p_8
-                #error_counter +=1
-                real_omc = 0.0# this is the omc if you throw out peaks that go over the edge of the spectrum
-            else:
-                peaks_section = peaklist
-                peak = p_8
-                regular_counter +=1
-            old_omc = 100000.0
-            for peak_freq,peak_inten in peaks_section: #find nearest peak in actual spectrum to the given top 20 peak
-                omc = abs(current_peak-float(peak_freq))
-                omc_low = abs(current_peak-float(peak))
-                if omc>old_omc:
-                    omc_low = old_omc
-                    omc_inten = temp_inten                    
-                    break
-                old_omc = omc
-                temp_inten = peak_inten
-            if real_omc == 1.0:
-                real_omc = omc_low
-            omc_list.append((omc_low, real_omc, omc_inten))
-        omc_avg = [float(omc) for omc, real_omc, omc_inten in omc_list]
-        real_omc_avg = [float(real_omc) for omc, real_omc, omc_inten in omc_list]
-        omc_inten_scoring = [float(omc_inten) for omc, real_omc, omc_inten in omc_list]
-        score = str(len([omc for omc in omc_avg if omc<2.0])) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
-        avg = (sum(omc_avg)/len(omc_avg))+rms_fit
-        real_avg = (sum(real_omc_avg)/len(real_omc_avg))+rms_fit
-
-        omc_inten_ratio = (max(omc_inten_scoring)/min(omc_inten_scoring))
-        omc_inten_avg = (sum(omc_inten_scoring)/len(omc_inten_scoring))
-        omc_inten_unitless_stdev = numpy.std(omc_inten_scoring)/omc_inten_avg
-
-        score_inten_penalty = 1
-
-        if (omc_inten_ratio <= 0.5*theor_inten_ratio) or (omc_inten_ratio >= 1.5*theor_inten_ratio):
-            score_inten_penalty += 1
-
-        if (omc_inten_unitless_stdev <= 0.5*theor_inten_unitless_stdev) or (omc_inten_unitless_stdev >= 1.5*theor_inten_unitless_stdev):
-            score_inten_penalty += 1
-        
-        penalized_avg = avg*score_inten_penalty
+        if engine == "batch":
+            (disagree,const_dev) = batch_fit_module.cascade_compare((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3),(A_1,B_1,C_1),freq_17,batch_model,peak_freqs,confirm_omc=confirm_omc)
+            cascade_fits += 1
+            cascade_disagreements += int(disagree)
+            cascade_const_dev += const_dev
+        if dedup_tol > 0: # Constants this process has already scored (to within dedup_tol) are only counted
+            constants_key = triples_scoring_module.constants_key(A_1,B_1,C_1,dedup_tol)
+            if multiplicity.repeat(constants_key):
+                continue
+            multiplicity.record(constants_key) # Before early abort, so the duplicates of a dropped fit are only counted too
+        if top_k > 0 or min_score > 0: # Strongest check lines first; fits that can't make this process's top_k or reach min_score are dropped
+            cutoff = float('inf')
+            if top_k > 0 and len(best_penalized) == top_k:
+                cutoff = -best_penalized[0]
+            scores = triples_scoring_module.score_fit_ordered(freq_17,rms_fit,peak_freqs,peak_intens,theor_inten,check_order,cutoff,min_score)
+            if scores == None:
+                continue
+        else:
+            scores = triples_scoring_module.score_fits(numpy.array([freq_17],dtype=float),rms_fit,peak_freqs,peak_intens,theor_inten) #matches the check transitions to the nearest experimental peaks and scores the fit
+        score = str(scores['score'][0]) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
+        avg = float(scores['avg'][0])
+        real_avg = float(scores['real_avg'][0])
+        penalized_avg = float(scores['penalized_avg'][0])
 
         if float(A_1)>=float(B_1) and float(B_1)>=float(C_1) and float(C_1)>0:
             if int(score)<10: #makes sorting work properly later
                 score = '0'+score  
-            output_file += 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            result_line = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            output_lines.append(result_line)
+            triples_results_module.add_result(result_heaps,result_line,(avg,real_avg,penalized_avg))
+            peak_index = triples_scoring_module.nearest_peaks([float(freq_1),float(freq_2),float(freq_3)],peak_freqs)[1]
+            store_records.append((peak_index[0],peak_index[1],peak_index[2],A_1,B_1,C_1,rms_fit,int(score),avg,real_avg,penalized_avg))
+            progress_best = min(progress_best,penalized_avg)
+            if dedup_tol > 0:
+                multiplicity.keep_line(constants_key,result_line)
+            if hit_sigma > 0: # Anytime search: a fit far below this process's bulk of fits goes to hits%s.txt right away
+                triples_hits_module.check_hit(file_num,hit_stats,avg,result_line,hit_sigma)
+            if top_k > 0:
+                if len(best_penalized) < top_k:
+                    heapq.heappush(best_penalized,-penalized_avg)
+                else:
+                    heapq.heappushpop(best_penalized,-penalized_avg)
 
             if real_avg <= 0.2: #appends good finds (RMS < 0.2 MHz, ignoring peaks over edge) to interim file for each processor
                 interim_output = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
@@ -1009,19 +984,18 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 fh_interim_good.write(interim_output)
                 fh_interim_good.close()
 
-            if triples_counter == 100000: #appends to file after every 100000 triples
-                fh_final = open("final_output%s.txt"%(str(file_num)), "a")
-                fh_final.write(output_file)
-                fh_final.close()
-                triples_counter = 0
-                output_file = ""
-    fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
-    #print 'out of %s peaks there were %s peaks that werent in the experimental spectrum'%(regular_counter, error_counter) 
-    fh_final.write(output_file)
-    fh_final.close()
-    os.system("sort -r 'final_output%s.txt'>sorted_final_out%s.txt"%(str(file_num),str(file_num)))#sorts output by score
+        if task_queue == None and triples_counter >= flush_count: #appends to file after every 100000 triples; queued chunks are only written when they're done (queue_triples), so a resume never finds half a chunk
+            flush()
+            triples_counter = 0
+    triples_sandbox_module.close_sandbox(sandbox)
+    flush()
+    if engine == "batch":
+        batch_fit_module.write_cascade_stats(file_num,cascade_fits,cascade_disagreements,cascade_const_dev)
+    triples_progress_module.report(progress,file_num,progress_done,progress_best)
+    if result_queue != None: # Best lines of this process, merged by the driver
+        result_queue.put(result_heaps)
     
-def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten_high,inten_low,temperature,Jmax,peaklist,freq_low,freq_high,trans_1,trans_2,trans_3,filter_level,atoms_to_vary,a,b,c,mass,atom_list,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,check_peaks_list):
+def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten_high,inten_low,temperature,Jmax,peaklist,freq_low,freq_high,trans_1,trans_2,trans_3,filter_level,atoms_to_vary,a,b,c,mass,atom_list,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,check_peaks_list,engine="spfit",confirm_omc=2.0,keep_fraction=None,audit_every=0,top_k=0,min_score=0,pair_prune=False,dedup_tol=0.0,hit_sigma=0.0,stop_hits=0,adaptive_workers=False,pin_cpus=False,in_flight=1,ram_dir=None):
 
     main_flow = 'Isotopologues'
 
@@ -1030,12 +1004,7 @@ def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten
 
     freq_uncertainty = 0.0
 
-    for number in range(processors):
-        y = subprocess.Popen("cp SPFIT.EXE %s\SPFIT%s.EXE"%(job_name,number), stdout=subprocess.PIPE, shell=True) # Ditto here with try/except.
-        y.stdout.read()     
-
-    y = subprocess.Popen("cp SPCAT.EXE %s\SPCAT.EXE"%(job_name), stdout=subprocess.PIPE, shell=True) # Ditto here with try/except.
-    y.stdout.read() 
+    triples_sandbox_module.copy_programs(job_name) # One SPFIT and SPCAT, shared by all the processes
     
     os.chdir(job_name)
     
@@ -1063,12 +1032,7 @@ def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten
         a = subprocess.Popen("mkdir %s"%isotope_ID)
         a.wait()
 
-        for number in range(processors):
-            y = subprocess.Popen("cp SPFIT%s.EXE %s\SPFIT%s.EXE"%(number,isotope_ID,number), stdout=subprocess.PIPE, shell=True)
-            y.stdout.read()     
-
-        y = subprocess.Popen("cp SPCAT.EXE %s\SPCAT.EXE"%(isotope_ID), stdout=subprocess.PIPE, shell=True)
-        y.stdout.read() 
+        triples_sandbox_module.copy_programs(isotope_ID) # One SPFIT and SPCAT, shared by all the processes
 
         os.chdir(isotope_ID)
 
@@ -1100,7 +1064,7 @@ def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten
                 trans_2_uncert = float(trans_2[4])
                 trans_3_uncert = float(trans_3[4])
 
-        (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(trans_1_uncert,trans_2_uncert,trans_3_uncert,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3)
+        (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(trans_1_uncert,trans_2_uncert,trans_3_uncert,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,pair_prune,(curr_A,curr_B,curr_C))
 
         top_peaks = check_peaks_list
     
@@ -1111,6 +1075,13 @@ def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten
             else:
                 top_peaks_3cut.append(entry)
 
+        evaluated_records = triples_store_module.start_search(triples_store_module.search_identity(trans_1,trans_2,trans_3,top_peaks_3cut,(A,B,C,DJ,DJK,DK,dJ,dK,curr_A,curr_B,curr_C),engine)) # Triples fitted by an earlier search of the same transitions, checks, constants and engine in this folder, skipped this time; any other search's outputs are moved to previous_search<n>
+        program_call_module.clear_skipped() # Tried again this time
+        triples_hits_module.clear_hits() # So an earlier search's hits can't stop this one
+        batch_fit_module.clear_cascade_stats() # Counted from 0 again too
+        if evaluated_records:
+            triples_checkpoint_module.start_rerun()
+
         job_file = ""
         str(top_peaks_3cut)
         str(trans_1)
@@ -1122,139 +1093,60 @@ def isotopologue_fit(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,processors,inten
         
         job_file += "Job Name %s \n Isotope ID %s \n u_A: %s \n u_B: %s \n u_C: %s \n A: %s \n B: %s \n \
 C: %s \n DJ: %s \n DJK: %s \n DK: %s \n dJ: %s \n dK: %s \n processors: %s \n freq_high: %s \n freq_low: %s \n \
-inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s "%(job_name,isotope_ID,u_A,u_B,u_C,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
-            str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3))
+inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s \n engine: %s \n confirm_omc: %s \n keep_fraction: %s \n audit_every: %s \n top_k: %s \n min_score: %s \n pair_prune: %s \n dedup_tol: %s \n hit_sigma: %s \n stop_hits: %s \n adaptive_workers: %s \n pin_cpus: %s \n in_flight: %s \n ram_dir: %s "%(job_name,isotope_ID,u_A,u_B,u_C,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
+            str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3),engine,str(confirm_omc),str(keep_fraction),str(audit_every),str(top_k),str(min_score),str(pair_prune),str(dedup_tol),str(hit_sigma),str(stop_hits),str(adaptive_workers),str(pin_cpus),str(in_flight),str(ram_dir))
         Job_fh = open("input_data_%s_%s.txt"%(job_name,isotope_ID),"w")
         Job_fh.write(job_file) 
         Job_fh.close()
-    
-        flag123 = 0
-        flag132 = 0
-        flag213 = 0
-        flag231 = 0
-        flag312 = 0
-        flag321 = 0
-
-        if (len(trans_1_peaks) >= len(trans_2_peaks)) and (len(trans_1_peaks) >= len(trans_3_peaks)):
-            list_a_peaks = trans_1_peaks
-            if len(trans_2_peaks) >= len(trans_3_peaks):
-                list_b_peaks = trans_2_peaks
-                list_c_peaks = trans_3_peaks
-                flag123 = 1
-            elif len(trans_3_peaks) >= len(trans_2_peaks):
-                list_b_peaks = trans_3_peaks
-                list_c_peaks = trans_2_peaks
-                flag132 = 1
-        elif (len(trans_2_peaks) >= len(trans_1_peaks)) and (len(trans_2_peaks) >= len(trans_3_peaks)):
-            list_a_peaks = trans_2_peaks
-            if len(trans_1_peaks) >= len(trans_3_peaks):
-                list_b_peaks = trans_1_peaks
-                list_c_peaks = trans_3_peaks
-                flag213 = 1
-            elif len(trans_3_peaks) >= len(trans_1_peaks):
-                list_b_peaks = trans_3_peaks
-                list_c_peaks = trans_1_peaks
-                flag231 = 1
-        elif (len(trans_3_peaks) >= len(trans_1_peaks)) and (len(trans_3_peaks) >= len(trans_2_peaks)):
-            list_a_peaks = trans_3_peaks
-            if len(trans_1_peaks) >= len(trans_2_peaks):
-                list_b_peaks = trans_1_peaks
-                list_c_peaks = trans_2_peaks
-                flag312 = 1
-            elif len(trans_2_peaks) >= len(trans_1_peaks):
-                list_b_peaks = trans_2_peaks
-                list_c_peaks = trans_1_peaks
-                flag321 = 1
-
-        random.shuffle(list_c_peaks)  # Shuffle so that each processor gets a range of values for the third peak, not processor 0 getting only the lowest frequencies.  
-
-        list_c_list = []
-        for num in range(processors):
-            processors = float(processors)
-            num = float(num)
-            x = int((num)*(len(list_c_peaks)/processors))
-            y = int(len(list_c_peaks)*((num+1)/processors))
-            list_c_list.append(list_c_peaks[x:y])
-        list_c_list.append("marker")
-
-        if flag123 == 1:
-            trans_1_peaks = list_a_peaks
-            trans_2_peaks = list_b_peaks
-            trans_3_peaks = list_c_list
-        if flag213 == 1:
-            trans_1_peaks = list_b_peaks
-            trans_2_peaks = list_a_peaks
-            trans_3_peaks = list_c_list
-        if flag312 == 1:
-            trans_1_peaks = list_b_peaks
-            trans_2_peaks = list_c_list
-            trans_3_peaks = list_a_peaks
-        if flag132 == 1:
-            trans_1_peaks = list_a_peaks
-            trans_2_peaks = list_c_list
-            trans_3_peaks = list_b_peaks
-        if flag231 == 1:
-            trans_1_peaks = list_c_list
-            trans_2_peaks = list_a_peaks
-            trans_3_peaks = list_b_peaks
-        if flag321 == 1:
-            trans_1_peaks = list_c_list
-            trans_2_peaks = list_b_peaks
-            trans_3_peaks = list_a_peaks
+
+        batch_model = None
+        if engine == "batch": # Built around the predicted isotopologue constants, which are where its fits should land.
+            batch_model = batch_fit_module.linear_model(trans_1,trans_2,trans_3,top_peaks_3cut,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,temperature)
+
+        (pair_mask,pair_window) = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,temperature)[0:2] # The same pairs triples_gen counted
+
+        sorted_triples = triples_enum_module.best_first_triples(trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_mask=pair_mask,pair_window=pair_window) # Every triple in global scaled_diff order, handed out in chunks to whichever process is free
+        if evaluated_records: # Incremental rerun: only the triples the earlier searches here didn't fit (e.g. the new outer shell of wider windows)
+            sorted_triples = triples_store_module.skip_evaluated(sorted_triples,triples_store_module.load_evaluated(evaluated_records))
+        screen_stats = {}
+        if engine == "batch":
+            sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=confirm_omc,keep_fraction=keep_fraction,stats=screen_stats,audit_every=audit_every)
 
         processors = int(processors)
+        task_queue = multiprocessing.Queue(processors*4)
+        result_queue = multiprocessing.Queue()
+        progress = triples_progress_module.new_counters(processors) # Shared per-process counters, published by reporter
+        (active,controller) = triples_workers_module.adaptive(processors,progress,adaptive_workers) # Limit on the processes taking chunks, moved by controller
+        timing_key = triples_timing_module.timing_key(engine,processors)
+        reporter = triples_progress_module.ProgressReporter(progress,num_of_triples,seconds_per_triple=triples_timing_module.stored_seconds(timing_key),timing_key=timing_key,controller=controller)
+        triples_store_module.save_peaks(peaklist) # What the peak indices in results%s.bin point into
+        result_heaps = triples_results_module.new_heaps()
+        if evaluated_records: # The fits of the earlier searches are only in the final_output files
+            result_heaps = triples_results_module.read_results()
+
+        workers = []
         for num in range(processors):
-            if trans_1_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks[num]
-                trans_y_peaks = trans_2_peaks
-                trans_z_peaks = trans_3_peaks
-        
-            if trans_2_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks
-                trans_y_peaks = trans_2_peaks[num]
-                trans_z_peaks = trans_3_peaks
-
-            if trans_3_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks
-                trans_y_peaks = trans_2_peaks
-                trans_z_peaks = trans_3_peaks[num]
-        
-            vars()["p%s"%str(num)] = Process(target=fit_triples, args=(trans_x_peaks,trans_y_peaks,trans_z_peaks,trans_1,trans_2,trans_3,top_peaks_3cut,peaklist,num,A,B,C,DJ,DJK,DK,dJ,dK))
+            vars()["p%s"%str(num)] = Process(target=fit_triples, args=([],[],[],trans_1,trans_2,trans_3,top_peaks_3cut,None,num,A,B,C,DJ,DJK,DK,dJ,dK,engine,batch_model,task_queue,confirm_omc,top_k,min_score,result_queue,dedup_tol,hit_sigma,progress,active,pin_cpus,in_flight,ram_dir))
+            workers.append(vars()["p%s"%str(num)])
 
         for num in range(processors):
             vars()["p%s"%str(num)].start()
-        for num in range(processors):
-            vars()["p%s"%str(num)].join()
-        
-        a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 4 -n > sorted_omc_cat_%s.txt'%(isotope_ID), shell=True)
-        a.wait()
 
-        a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 6 -n > sorted_inten_omc_cat_%s.txt'%(isotope_ID), shell=True)
-        a.wait()
+        status = triples_queue_module.feed_queue(task_queue,sorted_triples,processors,workers,stop_hits=stop_hits,reporter=reporter,controller=controller,stats=screen_stats)
+        result_heaps = triples_results_module.collect_heaps(result_queue,workers,result_heaps,reporter=reporter)
 
-        f = open('sorted_inten_omc_cat_%s.txt'%(isotope_ID),'r')
-        fits = []
-
-        for i in range(100):
-            r = f.readline()
-
-            if i < 10:
-                number = '0'+str(i)
-            else:
-                number = i
-
-            temp = str(number) + ' ' + r
-            fits.append(temp)
-
-        f.close()
-
-        OMC_char_buffer = ""
-        for i in (fits):
-            OMC_char_buffer += i+''
+        for num in range(processors):
+            vars()["p%s"%str(num)].join()
+        reporter.finish(status)
 
-        f100=open('best100_%s.txt'%(isotope_ID),'w')
-        f100.write(OMC_char_buffer)
-        f100.close()
+        if engine == "batch":
+            print(batch_fit_module.cascade_report(screen_stats,confirm_omc,keep_fraction))
+        
+        triples_results_module.write_results(result_heaps,"_%s"%(isotope_ID))
+        if program_call_module.skipped_count() > 0:
+            print(program_call_module.skipped_message())
+        if dedup_tol > 0:
+            triples_results_module.write_multiplicity(dedup_tol,"_%s"%(isotope_ID))
 
         isotopomer_count += 1
         os.chdir(os.pardir)
@@ -0,0 +1,82 @@
+import numpy
+import itertools
+
+""""
+Line derivative table for the dependence test
+
+Please comment any changes you make to the code here:
+
+line derivatives module:
+-dependence_test ran SPCAT seven times for every triple it scored (A, B and C each shifted by +-2 MHz, then the
+initial constants again), and triple_selection scores all 120 triples of the 10 strongest lines, so that was about 840
+SPCAT runs before the search could start (and the same again in the fitting GUI).  The shifted predictions are the same
+for every triple, only the three lines looked up in them change.  derivative_table runs the six shifted predictions
+once and keeps d(freq)/d(A,B,C) of every predicted line, and dependences takes the 3x3 determinants of any number of
+triples from it in one numpy.linalg.det call.  That makes a much bigger candidate pool for triple_selection cheap.
+
+-The bigger pool is only for scoring.  prog_A's and the isotopologue module's triple_selection show the user a
+choicebox, and 1140 triples is far too long a list to pick from, so best_choices keeps the TRIPLE_CHOICES best scored
+ones (as many as the old 10 line pool gave).  The fitting GUIs pick the best triple themselves and still see them all.
+
+-The numbers are the ones dependence_test gave: the same central difference over the same shifts, and a line SPCAT
+didn't predict counts as frequency 0 like trans_freq_reader's did.
+
+-The callers' derivative_table only has SPCAT predict the J and frequency range (and intensities) of the lines it's
+asked about (prediction_cache_module.prediction_limits), then predicts the full range once more at the initial constants
+for whatever reads default.cat next.  derivative_table here no longer makes that last run itself.
+
+"""
+
+STEP = 2.0 # MHz that A, B and C are shifted by
+TRIPLE_POOL = 20 # Strongest lines triple_selection makes its candidate triples from (1140 triples; it was 10, 120 triples)
+TRIPLE_CHOICES = 120 # Best scored triples triple_selection's choicebox lists
+
+def line_key(line): # Quantum numbers of a cat_reader line (or fitting transition), (qnum_up, qnum_low)
+    return (line[2],line[3])
+
+def line_freqs(lines): # {line_key: frequency} of cat_reader lines; a line listed twice keeps its last frequency, like trans_freq_reader
+    freqs = {}
+    for line in lines:
+        freqs[line_key(line)] = float(line[1])
+    return freqs
+
+def derivative_table(predict,A,B,C,step=STEP):
+
+    """ d(freq)/d(A,B,C) of every line predicted near A, B, C, as {line_key: (dA, dB, dC)}.  predict(A,B,C) runs SPCAT
+    at those constants and returns its lines as cat_reader does; it's called for the six shifted sets of constants.  The
+    .cat is left at the last of them, so callers that need it at A, B, C run that themselves."""
+
+    high = []
+    low = []
+    for k in range(3):
+        shifted = [A,B,C]
+        shifted[k] = [A,B,C][k]+step
+        high.append(line_freqs(predict(shifted[0],shifted[1],shifted[2])))
+        shifted[k] = [A,B,C][k]-step
+        low.append(line_freqs(predict(shifted[0],shifted[1],shifted[2])))
+
+    keys = set()
+    for freqs in high+low:
+        keys.update(freqs)
+    table = {}
+    for key in keys:
+        table[key] = tuple([(high[k].get(key,0.0)-low[k].get(key,0.0))/(2*step) for k in range(3)])
+    return table
+
+def dependences(table,triples):
+
+    """ Linear dependence of each triple (three lines or fitting transitions): the determinant of the matrix of their
+    d(freq)/d(A,B,C) rows in table.  All of them in one numpy.linalg.det call; a numpy array in the order of triples."""
+
+    if len(triples) == 0:
+        return numpy.zeros(0)
+    matrices = numpy.array([[table.get(line_key(line),(0.0,0.0,0.0)) for line in triple] for triple in triples])
+    return numpy.linalg.det(matrices)
+
+def pool_dependences(table,lines): # {(i,j,k): dependence} for every triple i < j < k of lines, the triples triple_selection scores
+    combos = list(itertools.combinations(range(len(lines)),3))
+    values = dependences(table,[(lines[i],lines[j],lines[k]) for (i,j,k) in combos])
+    return dict(zip(combos,values))
+
+def best_choices(choice_list,count=TRIPLE_CHOICES): # The count best entries of triple_selection's triples_choice_list, best first (entry[0] is 1 - score/100)
+    return sorted(choice_list,key=lambda entry: entry[0])[0:count]
@@ -0,0 +1,141 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+""""
+SPCAT prediction cache
+
+Please comment any changes you make to the code here:
+
+prediction cache module:
+-SPCAT keeps being run on the same input: dependence_test ends by re-running the initial constants it started from,
+triple_selection calls dependence_test over and over with perturbations that overlap, and the fitting GUIs re-run it on
+every redraw whether anything changed or not.  run_spcat looks the .var and .int up first, by an md5 of their text
+(prediction_key), and on a hit writes the .cat SPCAT made for them last time instead of running it again.  Everything
+that reads the .cat afterwards sees the same file as before.
+
+-Predictions are kept in memory, MEMORY_SIZE of them, the least recently used going first.  With use_disk(folder) they
+are also written to folder as <key>.cat, so they outlive the process and are shared by every job pointed at the same
+folder.  The .out SPCAT writes isn't kept; nothing reads it.
+
+-catalog(name) is the parsed .cat (every line the cat_readers look at), and the last CATALOG_SIZE of them are kept, so
+the same catalog isn't parsed again either.  They're keyed by the .cat text itself, so a .cat that didn't come through
+run_spcat is still read right.
+
+-prediction_limits gives the narrowest .int limits that still predict a given set of lines: J_min and J_max from their
+quantum numbers (SPCAT's J range bounds both states), the frequency limit just above the highest of them, with room for
+how far shifted constants can move it, and the intensity cutoff a little under the weakest (SPCAT's cutoff isn't exactly
+the .cat intensity).  A caller that only looks a few lines up in the .cat (the dependence test, the batch model) then
+has SPCAT predict and write, and cat_reader parse, only about that much.
+
+"""
+
+MEMORY_SIZE = 256 # Predictions kept in memory
+CATALOG_SIZE = 16 # Parsed catalogs kept in memory
+FREQ_MARGIN = 100.0 # MHz above the highest line prediction_limits is asked for, on top of what the shift can move it
+INTEN_MARGIN = 1.0 # Decades under the weakest line prediction_limits is asked for
+
+disk_folder = None # Set by use_disk; predictions are only kept in memory without it
+
+_predictions = OrderedDict() # key: .cat text, least recently used first
+_catalogs = OrderedDict() # md5 of the .cat text: catalog rows
+
+def _bytes(text):
+    if isinstance(text,bytes):
+        return text
+    return text.encode("latin-1")
+
+def _read(file_name):
+    fh = open(file_name)
+    text = fh.read()
+    fh.close()
+    return text
+
+def _write(file_name,text):
+    fh = open(file_name,"w")
+    fh.write(text)
+    fh.close()
+
+def _remember(cache,key,value,size):
+    cache[key] = value
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+def use_disk(folder): # Keeps the predictions in folder too (None for memory only)
+    global disk_folder
+    if folder != None and not os.path.isdir(folder):
+        os.makedirs(folder)
+    disk_folder = folder
+
+def prediction_key(var,int_file):
+    return hashlib.md5(_bytes(var)+b"\0"+_bytes(int_file)).hexdigest()
+
+def lookup(key): # .cat text stored for key, None if it isn't
+    if key in _predictions:
+        cat = _predictions.pop(key)
+        _predictions[key] = cat # Now the most recently used
+        return cat
+    if disk_folder != None and os.path.isfile(os.path.join(disk_folder,key+".cat")):
+        cat = _read(os.path.join(disk_folder,key+".cat"))
+        _remember(_predictions,key,cat,MEMORY_SIZE)
+        return cat
+    return None
+
+def store(key,cat):
+    _remember(_predictions,key,cat,MEMORY_SIZE)
+    if disk_folder != None:
+        temp_name = os.path.join(disk_folder,"%s.%s.tmp"%(key,os.getpid()))
+        try:
+            _write(temp_name,cat)
+            os.rename(temp_name,os.path.join(disk_folder,key+".cat")) # Another process may be storing the same one; either copy will do
+        except OSError:
+            pass
+
+def run_spcat(name,run):
+
+    """ Makes name.cat for name.var and name.int: from the cache if the same .var and .int were predicted before,
+    otherwise with run() (the caller's SPCAT call), whose .cat is then stored."""
+
+    key = prediction_key(_read(name+".var"),_read(name+".int"))
+    cat = lookup(key)
+    if cat != None:
+        _write(name+".cat",cat)
+        return
+    if os.path.isfile(name+".cat"): # So a run that fails can't leave the last .cat behind to be stored under this key
+        os.remove(name+".cat")
+    run()
+    if os.path.isfile(name+".cat"):
+        store(key,_read(name+".cat"))
+
+def catalog(name):
+
+    """ Lines of name.cat as (freq, freq text, inten, qnum_up, qnum_low, uncert) with freq a float, the fields the
+    cat_readers take from each line with a frequency in it.  Parsed once per catalog."""
+
+    text = _read(name+".cat")
+    key = hashlib.md5(_bytes(text)).hexdigest()
+    if key in _catalogs:
+        rows = _catalogs.pop(key)
+        _catalogs[key] = rows
+        return rows
+    rows = []
+    for line in text.splitlines():
+        if line[8:9]==".":
+            rows.append((float(line[3:13]),line[3:13],line[22:29],line[55:61],line[67:73],line[13:21]))
+    _remember(_catalogs,key,rows,CATALOG_SIZE)
+    return rows
+
+def prediction_limits(lines,shift=0.0,intensity=True):
+
+    """ (J_min, J_max, inten, freq) strings for int_writer that still predict lines (cat_reader lines or fitting
+    transitions) with A, B or C moved by up to shift MHz, which moves a line of upper J by at most J(J+1) times shift.
+    freq is in GHz like int_writer's.  intensity=False leaves inten None, for when the lines' intensities came from
+    other dipoles or temperature than the .int that will be written."""
+
+    J_values = [int(qnum[0:2]) for line in lines for qnum in (line[2],line[3])]
+    J_max = max(J_values)
+    freq = max([float(line[1]) for line in lines]) + shift*J_max*(J_max+1) + FREQ_MARGIN
+    inten = None
+    if intensity:
+        inten = "%.1f"%(min([float(line[0]) for line in lines]) - INTEN_MARGIN)
+    return "%02d"%(min(J_values)),"%02d"%(J_max),inten,"%.3f"%(freq/1000.0)
@@ -4,16 +4,31 @@ from easygui import *
 import sys
 import time
 import multiprocessing
-import timeit
 from multiprocessing import Process
 import re
 import numpy
+import heapq
 import random
 import string
 import math
 from collections import OrderedDict
 import shutil
 from scipy.interpolate import *
+import batch_fit_module
+import triples_enum_module
+import triples_queue_module
+import triples_checkpoint_module
+import triples_scoring_module
+import triples_results_module
+import triples_hits_module
+import triples_progress_module
+import triples_store_module
+import triples_timing_module
+import program_call_module
+import prediction_cache_module
+import line_derivatives_module
+import triples_workers_module
+import triples_sandbox_module
 
 """"
 Python Triples Fitter
@@ -24,6 +39,90 @@ based on previous work by the Pate Lab at UVa
 
 Please comment any changes you make to the code here:
 
+version 16:
+-Added a batched triples solver (batch_fit_module.py), selected with "engine: batch" in the input file.  SPCAT is run once
+per job to build a linear + curvature model of the fitting and check transitions, every triple is then solved in blocks in
+NumPy, and only the triples whose predicted check transitions land on experimental peaks go through SPFIT.  The default
+engine ("spfit") fits every triple with SPFIT like before.
+-fit_triples no longer builds and sorts the full list of combinations or writes/reads all_combo_list%s.txt.  Triples come
+from triples_enum_module.best_first_triples, a generator that yields them in ascending scaled_diff order with memory that
+only scales with the window sizes, so the first fits start immediately.
+-The triples are no longer split between processes by shuffling and slicing the largest window.  The driver enumerates all
+of them once in global scaled_diff order and hands them out in small chunks through a queue (triples_queue_module), so
+every process keeps pulling work until the end and the most promising triples are fit in the first minutes of a run.
+-Checkpoints, pause and resume (triples_checkpoint_module): every finished chunk of triples is recorded in the job folder
+along with the best results so far.  "python triples_checkpoint_module.py pause job_folder" pauses a running job, and the new
+"Resume a job" choice on the first dialog picks a paused or crashed job up again, skipping the chunks that are done.
+-Fits are scored with triples_scoring_module (nearest peaks by numpy.searchsorted on the sorted peak list) instead of
+walking a quarter of the peak list for every check transition; match_to_peaklist uses the same lookup.
+-The batch engine's screen can be tuned from the input file: "confirm_omc:" (median check omc in MHz a triple needs to go
+on to SPFIT), "keep_fraction:" (send the best fraction of each block instead) and "audit_every:" (fit every n-th rejected
+triple anyway).  Each search writes cascade_report.txt with how many triples the screen rejected and how often it
+disagreed with SPFIT.
+-Early-abort scoring, turned on with "top_k:" and/or "min_score:" in the input file: check lines are scored strongest first
+and a fit is dropped (not written to the output) as soon as it can't make its process's top_k by avg w/ inten penalty, or
+can't reach min_score lines within 2 MHz.
+-"pair_prune: True" in the input file prunes the triples before they're enumerated: a first-order model of the fitting
+transitions (batch_fit_module.admissible_pairs) drops every trans_1/trans_2 peak pair that can't come from constants with
+A >= B >= C > 0 that also put trans_3 inside its window.  The triples count triples_gen reports is the pruned one.
+-"pair_prune: sweep" is the pair-line sweep search mode: on top of the pruning, each trans_1/trans_2 pair is only combined
+with the trans_3 peaks inside the interval its line of constants can put trans_3 in (batch_fit_module.trans_3_windows),
+found by binary search instead of going through the whole trans_3 window.
+-Results are no longer put in order with sort -r and cat | sort (a Unix sort over every result line of the search): each
+fit_triples process keeps heaps of its best lines and the driver merges them (triples_results_module).  The sorted_*_cat
+files hold the best 10000 lines of their ranking, and sorted_real_omc_cat ranks by avg w/out peaks over edge.
+-Each fit is also appended to a columnar result store, results%s.bin in the job folder, with results_peaks.npy for its
+peak indices (triples_store_module: load_results, top_results by any column, filter_results by column ranges).
+-"dedup_tol:" in the input file (MHz, off by default) scores a fit only if its process hasn't already scored one with the
+same A, B and C to within dedup_tol; the repeats are counted instead of written again, and fit_multiplicity.txt lists
+every set of constants with the number of triples that converged on it.
+-Rerunning a job in the same folder (e.g. with wider windows) only fits the triples the earlier searches there didn't:
+fit_triples keeps an index of every triple it fitted (evaluated%s.bin, triples_store_module), the new search skips those
+and its results are merged with the old ones in the sorted files and best100.txt.  Giving the job name of an existing
+folder asks whether to rerun in it (the job name dialog used to insist on a new folder, so the index was always empty).
+-Anytime search: "hit_sigma:" in the input file (e.g. 4) makes every process keep running statistics of its fits and
+write a fit that far below the rest (log10 of average omc) to hits%s.txt as soon as it's found, with its z and the
+number of fits expected to do that well by chance (triples_hits_module).  "stop_hits:" stops the search once that many
+hits agree on the constants, and the results so far are merged as usual.  interim_good_output (0.2 MHz) is still written.
+-The progress bar works again, on Windows too: update_progress() (commented out, it relied on globals the processes don't
+share) is gone, and the fit_triples processes write their counts to shared counters that the driver reports from
+(triples_progress_module): triples done, rate per process and in total, ETA and best avg w/ inten penalty, on the
+terminal and in status.json in the job folder.
+-time_estimate() is gone.  It timed 25 SPCAT runs at startup and divided by the number of cores, which wasn't what a
+triple costs, so the "roughly X hours" in triples_gen was often way off.  triples_gen now uses the seconds per triple
+this machine got with the same number of processes (triples_timing_module, kept in ~/.autofit_timing.json), and the first
+time there's none it times the SPFIT fit_triples on a few of the actual triples in a scratch folder.  Every search that
+finishes updates the stored value, and the progress ETA starts from it.
+-SPFIT and SPCAT calls have a timeout (program_call_module): fit_triples skips a triple whose SPFIT run hangs or crashes
+twice instead of stalling its process or reading the previous triple's output, lists it in skipped%s.txt and the final
+message says how many were skipped.  A failed SPCAT stops with ProgramError, and a failed refit in refine_fits asks
+whether to try again.
+-"adaptive_workers: True" in the input file makes processors the most processes to use: the search starts with as many
+as there are CPUs and moves the number that take triples up or down, one at a time, towards the best measured throughput
+until it settles (triples_workers_module).  "pin_cpus: True" pins each process to its own CPU.
+-The peak list isn't passed to the fit_triples processes any more: the driver's save_peaks also writes its sorted
+frequency and intensity columns to peak_columns.npy, and each process maps that file read-only (triples_store_module).
+-"in_flight: N" in the input file has each fit_triples process keep N SPFIT runs going at once, on their own
+default%s_%s files, so the next triples' input files are written and the last fit is read and scored while SPFIT runs
+(program_call_module.spfit_runs).  1, the default, is the old one-run-at-a-time loop.
+-Each fit_triples process writes its SPFIT files in a folder of its own on a RAM disk (/dev/shm, or "ram_dir: folder";
+"ram_dir: off" keeps them in the job folder), and the job folder gets one SPFIT.EXE that every process runs instead of an
+SPFIT%s.EXE copy for each (triples_sandbox_module).  refine_fits runs that one too.
+-"engine: lib" fits the triples like "spfit", but with SPFIT run from libcalpgm.so ("make lib" in calpgm/src, with
+calpgm_lib.py next to these scripts) in a helper child of each fit_triples process, on the .par and .lin text in memory:
+no files, no process per triple (program_call_module.library_runs).  The helper has SPFIT.EXE's timeout and a crash only
+takes it down.  Where the library can't be loaded, or once it keeps hanging or crashing, it falls back on SPFIT.EXE.
+-SPCAT isn't run again for a .var and .int it has already predicted (prediction_cache_module): run_SPCAT and
+run_SPCAT_refit write the stored .cat instead, and cat_reader parses each catalog once.  "spcat_cache: folder" also keeps
+the predictions in folder for later runs.
+-triple_selection takes the dependence of every candidate triple from one derivative table (derivative_table,
+line_derivatives_module): six SPCAT runs in all instead of seven per triple, with the determinants done in one numpy
+call, and the pool is the 20 strongest lines (1140 triples) instead of 10.  dependence_test uses the same table.
+The choicebox still only lists the best 120 of them (line_derivatives_module.best_choices).
+-The six shifted SPCAT runs behind that table only predict the J range, frequencies and intensities of the lines being
+scored (prediction_cache_module.prediction_limits) instead of J 0-20 up to 100 GHz; the full range is predicted once
+more at the initial constants afterwards, for what reads default.cat next.
+
 version 15c:
 -Added a progress bar. Notes are made in the comments above the definition for the bar, update_progress().
 NOTE: CURRENTLY THE PROGRESS BAR IS BROKEN IN WINDOWS! WORKS IN LINUX THOUGH!!!
@@ -218,21 +317,6 @@ def int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000"
     fh_int.write(input_file)
     fh_int.close()
 
-def time_estimate():
-    s = """\
-    int_writer(1,1,1, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="100.0", temperature=2, flag = "default")
-    var_writer(3000,2000,1000,2E-4,2E-4,2E-4,2E-4,2E-4,'Normal species',flag="uncert")
-    run_SPCAT()
-    """
-
-    outtime = timeit.timeit(stmt=s, number=25, setup="from __main__ import int_writer,var_writer,run_SPCAT")
-    scale_factor_one_proc = outtime / 25.0 # Rought estimated time in seconds for a single triple on one core.
-    cores_detected = multiprocessing.cpu_count()
-    scale_factor = scale_factor_one_proc / cores_detected # Rough estimated time in seconds for a single triple, divided by number of processors.
-
-    return scale_factor
-
-
 def var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag):#generates SPCAT input file
 
     if main_flow == 'Normal species':
@@ -382,33 +466,18 @@ def peakpicker(spectrum,thresh_l,thresh_h):#Code taken from Cristobal's peak-pic
     return peakpicks, freq_low, freq_high
 
 def run_SPCAT(): 
-    a = subprocess.Popen("SPCAT default", stdout=subprocess.PIPE, shell=False)
-    a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen
+    prediction_cache_module.run_spcat("default",lambda: program_call_module.check_program("SPCAT default",["default.cat"])) # Raises ProgramError if SPCAT hangs or writes no .cat; not run again for a .var/.int it has predicted
  
 def run_SPCAT_refit(): 
-    a = subprocess.Popen("SPCAT refit", stdout=subprocess.PIPE, shell=False)
-    a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen
+    prediction_cache_module.run_spcat("refit",lambda: program_call_module.check_program("SPCAT refit",["refit.cat"])) # Raises ProgramError if SPCAT hangs or writes no .cat
 
 def cat_reader(freq_high,freq_low,flag): #reads output from SPCAT
 
-    if flag == "default":
-        fh = open("default.cat")
-
-    if flag == "refit":
-        fh = open("refit.cat")
-
     linelist = []
-    for line in fh:
-        if line[8:9]==".": 
-            freq = line[3:13]
-            inten = line[22:29]
-            qnum_up = line[55:61]
-            qnum_low = line[67:73]
-            uncert = line[13:21]
-            if float(freq)> freq_low and float(freq)<freq_high:#<<<<<<<<<<<<<<<<<<<<
-                linelist.append((inten,freq, qnum_up, qnum_low,uncert))
+    for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog(flag): # flag is the file name, parsed once per catalog
+        if value > freq_low and value < freq_high:#<<<<<<<<<<<<<<<<<<<<
+            linelist.append((inten,freq, qnum_up, qnum_low,uncert))
     linelist.sort()
-    fh.close()
     return linelist
     
 def trans_freq_reader(trans_1, trans_2, trans_3):
@@ -441,55 +510,19 @@ def trans_freq_refit_reader(peaklist):
 
 def match_to_peaklist(pred_trans,peaklist):
 
-    peak_list_1 = peaklist[0:int(len(peaklist)/4)]#splits peaks into 4 parts to speed up processing
-    peak_list_2 = peaklist[int(len(peaklist)/4):int(len(peaklist)/2)]
-    peak_list_3 = peaklist[int(len(peaklist)/2):int(len(peaklist)*0.75)]
-    peak_list_4 = peaklist[int(len(peaklist)*0.75):len(peaklist)]
-
-    p_1 = float(peak_list_1[0][0])
-    p_2 = float(peak_list_1[-1][0])
-    p_3 = float(peak_list_2[0][0])
-    p_4 = float(peak_list_2[-1][0])
-    p_5 = float(peak_list_3[0][0])
-    p_6 = float(peak_list_3[-1][0])
-    p_7 = float(peak_list_4[0][0])
-    p_8 = float(peak_list_4[-1][0])
-
+    (peak_freqs,peak_intens) = triples_scoring_module.sorted_peaks(peaklist)
     best_match_freqs=[]
 
     threshold = float(enterbox(msg="Enter the OMC threshold in MHz.  Predicted transitions that are not at least this close to an experimental peak will not contribute to the fit."))
 
-    for x in range(len(pred_trans)): #matches predicted peaks to peaks in experimental peak list <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+    (omc,nearest) = triples_scoring_module.nearest_peaks([float(trans[0]) for trans in pred_trans],peak_freqs) #matches predicted peaks to peaks in experimental peak list
+
+    for x in range(len(pred_trans)):
         weight = '0.50'
-        current_peak = float(pred_trans[x][0])
-        
-        if current_peak>p_1 and current_peak<p_2:#conditionals to find proper portion of experimental peak list to loop through
-            peaks_section = peak_list_1
-            peak = p_2
-        elif current_peak>p_3 and current_peak<p_4:
-            peaks_section = peak_list_2
-            peak = p_4
-        elif current_peak>p_5 and current_peak<p_6:
-            peaks_section = peak_list_3
-            peak = p_6
-        elif current_peak>p_7 and current_peak<p_8:
-            peaks_section = peak_list_4
-            peak = p_8
-        else:
-            peaks_section = peaklist
-            peak = p_8
-        
-        old_omc = 100000.0
-        for peak_freq,peak_inten in peaks_section: #find nearest peak in actual spectrum to the given predicted peak
-            omc = abs(current_peak-float(peak_freq))
-            if omc <= old_omc:
-                temp_freq = peak_freq
-                old_omc = omc
-
-        if old_omc > threshold: # If the best match is too far off, we don't want to have a bad line in the fit file.  Threshold (in MHz) is a user-determined parameter.
+        if omc[x] > threshold: # If the best match is too far off, we don't want to have a bad line in the fit file.  Threshold (in MHz) is a user-determined parameter.
             weight = '0.00'
 
-        best_match_freqs.append((temp_freq,pred_trans[x][1],pred_trans[x][2],weight))
+        best_match_freqs.append((peak_freqs[nearest[x]],pred_trans[x][1],pred_trans[x][2],weight))
 
     return best_match_freqs
 
@@ -647,7 +680,7 @@ def final_uncerts(trans_1_center,trans_2_center,trans_3_center,peak_1_uncertaint
     return trans_1,trans_2,trans_3,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty
 
 
-def triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,scale_factor):
+def triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,processors,pair_prune=False,pair_constants=None,check_peaks=[]):
 
     user_flag = 0
     est_unc_flag = 0
@@ -706,25 +739,28 @@ def triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,fre
                 if abs(float(trans_3_center)-float(freq_p))< peak_3_uncertainty:
                     trans_3_peaks.append((freq_p, inten_p))
             num_of_triples = len(trans_1_peaks)*len(trans_2_peaks)*len(trans_3_peaks) #this tells you how many entries there will be in the all_combo_list
+            if pair_prune and num_of_triples != 0: # Only what best_first_triples will enumerate after the pair pruning or sweep
+                if pair_constants == None:
+                    pair_constants = (A,B,C)
+                num_of_triples = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_constants[0],pair_constants[1],pair_constants[2],DJ,DJK,DK,dJ,dK,temperature)[2]
             
-            global tot
-            tot = int(num_of_triples) # Progress bar counter
-
-            estimated_time = float(num_of_triples) * scale_factor
-
-            if estimated_time <= 90:
-                time_string = str(int(estimated_time)) + " seconds"
-            elif estimated_time > 90 and estimated_time <= 5400:
-                time_min = math.ceil(estimated_time / 60.0)
-                time_string = str(int(time_min)) + " minutes"
-            elif estimated_time > 5400 and estimated_time <= 129600:
-                time_hours = math.ceil(estimated_time / 3600.0)
-                time_string = str(int(time_hours)) + " hours"
-            elif estimated_time > 129600:
-                time_days = math.ceil(estimated_time / 86400.0)
-                time_string = str(int(time_days)) + " days"
-
             if isotopomer_count == 0:
+                timing_key = triples_timing_module.timing_key("spfit",processors)
+                seconds_per_triple = triples_timing_module.stored_seconds(timing_key)
+                if seconds_per_triple == None and num_of_triples != 0: # First search on this machine with this many processes: time a few of these triples
+                    # Scored against the check transitions the search will use if they're known already (check_peaks, from the input file).  Otherwise
+                    # they're only picked after this estimate, so it uses the default choice, the 10 strongest predicted lines less the fitting ones;
+                    # picking an arbitrary set instead makes the estimate off by about the ratio of the numbers of check lines.
+                    if check_peaks == []:
+                        check_peaks = full_list[0:10]
+                    calibration_peaks = [entry for entry in check_peaks if (entry[2],entry[3]) not in [(trans[2],trans[3]) for trans in (trans_1,trans_2,trans_3)]]
+                    seconds_per_triple = triples_timing_module.calibrate(fit_triples,lambda num,task_queue,progress: ([],[],[],trans_1,trans_2,trans_3,calibration_peaks,peaklist,num,A,B,C,DJ,DJK,DK,dJ,dK,\
+                                                                        "spfit",None,task_queue,2.0,0,0,None,0.0,0.0,progress),triples_enum_module.best_first_triples(trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3),processors,timing_key)
+                if seconds_per_triple == None:
+                    seconds_per_triple = 0.0
+
+                time_string = triples_timing_module.format_estimate(float(num_of_triples)*seconds_per_triple)
+
                 decision = buttonbox(msg='There are %s triples in this calculation, which will take roughly %s. Would you like to continue, try new uncertainty, or quit?'%(str(num_of_triples),time_string), choices=('Continue','Quit','new uncertainty'))
             
             if decision == 'Quit':
@@ -740,8 +776,9 @@ def triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,fre
 
 def refine_fits(job_name,isotope_ID,u_A,u_B,u_C,Jmax,freq_high,temperature,fits,DJ,DJK,DK,dJ,dK,peaklist,main_flow):
 
-    a = subprocess.Popen("mkdir refits")
-    a.wait()
+    if not os.path.isdir("refits"): # Already there in a rerun
+        a = subprocess.Popen("mkdir refits")
+        a.wait()
 
     if isotope_ID == "NS only":
         f2=open('input_data_%s.txt'%(job_name),'r')
@@ -838,8 +875,12 @@ def refine_fits(job_name,isotope_ID,u_A,u_B,u_C,Jmax,freq_high,temperature,fits,
             best_matches = match_to_peaklist(updated_trans,peaklist) # Assigns closest experimental peak frequencies to transitions
             lin_writer_refit(best_matches)
 
-            a = subprocess.Popen("spfit0 refit", stdout=subprocess.PIPE, shell=False)
-            a.stdout.read()#used to let SPFIT finish
+            failure = program_call_module.run_program([triples_sandbox_module.spfit_program(),"refit"],["refit.var","refit.fit"])
+            if failure != None:
+                fit_decision = buttonbox(msg='SPFIT failed on this fit (%s).  Would you like to try again or give up on this result?'%(failure), choices=('Try Again','Give Up On This Result'))
+                if fit_decision != 'Try Again':
+                    fitting_done = 1
+                continue
 
             SPFIT_results = open("refit.fit",'r')
             codebox(msg='SPFIT has finished.',text=SPFIT_results)
@@ -894,12 +935,14 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
         triple_style = 'Manual selection'
 
     if triple_style == 'Automatic scoring':
-        total_check_num = 10 # This is the number of peaks used to generate possible triples, ordered by intensity. 10 = 120 possibilities, 15 = 455 possibilities.
+        total_check_num = min(len(full_list),line_derivatives_module.TRIPLE_POOL) # This is the number of peaks used to generate possible triples, ordered by intensity. 10 = 120 possibilities, 20 = 1140 possibilities.
         triples_scores = []
         scaled_triples_scores = []
         max_dependence = 0
         max_RMS = 0
         max_intensity = 0
+        table = derivative_table(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),temperature,u_A,u_B,u_C,main_flow,full_list[0:total_check_num]) # Six SPCAT runs for all the triples
+        pool_dependences = line_derivatives_module.pool_dependences(table,full_list[0:total_check_num])
 
         for i in range(0,total_check_num-2):
             for j in range(i+1,total_check_num-1):
@@ -908,7 +951,7 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
                     trans_1 = full_list[i]
                     trans_2 = full_list[j]
                     trans_3 = full_list[k]
-                    dependence = abs(dependence_test(float(A),float(B),float(C),float(DJ),float(DJK),float(DK),float(dJ),float(dK),trans_1,trans_2,trans_3,temperature,freq_high,freq_low,u_A,u_B,u_C,main_flow))
+                    dependence = abs(pool_dependences[(i,j,k)])
                     worst_RMS = max(float(trans_1[4]),float(trans_2[4]),float(trans_3[4]))
                     RMS_ratio = (worst_RMS/min(float(trans_1[4]),float(trans_2[4]),float(trans_3[4])))
                     RMS_function = RMS_ratio*worst_RMS
@@ -946,7 +989,7 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
 
         msg = "Choose a triples combination.  The second number is the triples score, ranging from 0 to 100 with 100 being the best possible.  The third number is the highest uncertainty in MHz from the triple."
         title = "Microwave Fitting Program"
-        choice = choicebox(msg,title,triples_choice_list)
+        choice = choicebox(msg,title,line_derivatives_module.best_choices(triples_choice_list)) # Only the best TRIPLE_CHOICES of the pool's triples
         clean_choice = choice[2:-1].split(",")
 
         highest_uncert = float(clean_choice[2])
@@ -998,50 +1041,23 @@ def triple_selection(full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,freq_high,freq_
     
     return highest_uncert,trans_1,trans_2,trans_3
 
-def dependence_test(A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
-    int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
-
-    var_writer(A+(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A-(2),B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    dv1A = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2A = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3A = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
+def derivative_table(A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,lines): # line_derivatives_module.derivative_table of lines on default.var/.int; leaves default.cat at A, B, C
+    (J_min,J_max,inten,freq) = prediction_cache_module.prediction_limits(lines,line_derivatives_module.STEP) # Only what lines need
+    int_writer(u_A,u_B,u_C, J_min=J_min, J_max=J_max, inten=inten,Q_rot="300000",freq=freq, temperature=T, flag = "default")
 
-    var_writer(A,B+(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A,B-(2),C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
+    def predict(A,B,C):
+        var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
+        run_SPCAT()
+        return cat_reader(1000000, 0, flag="default")
 
-    dv1B = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2B = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3B = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-
-    var_writer(A,B,C+(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    high_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    var_writer(A,B,C-(2),DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")
-    run_SPCAT()
-    low_peak_freq = trans_freq_reader(trans_1, trans_2, trans_3)
-
-    dv1C = (float(high_peak_freq[0])-float(low_peak_freq[0]))/4
-    dv2C = (float(high_peak_freq[1])-float(low_peak_freq[1]))/4
-    dv3C = (float(high_peak_freq[2])-float(low_peak_freq[2]))/4
-
-    var_writer(A,B,C,DJ,DJK,DK,dJ,dK,main_flow,flag="uncert")	# This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
-    run_SPCAT()
+    table = line_derivatives_module.derivative_table(predict,A,B,C)
+    int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="100.0", temperature=T, flag = "default")
+    predict(A,B,C) # This re-runs SPCAT at the initial constants so that other things that read from default.cat are correct after this function is executed.
+    return table
 
-    matrix = numpy.array([(dv1A,dv1B,dv1C),(dv2A,dv2B,dv2C),(dv3A,dv3B,dv3C)])
-    return numpy.linalg.det(matrix)
+def dependence_test(A,B,C,DJ,DJK,DK,dJ,dK,trans_1,trans_2,trans_3,T,freq_high, freq_low,u_A,u_B,u_C,main_flow):
+    table = derivative_table(A,B,C,DJ,DJK,DK,dJ,dK,T,u_A,u_B,u_C,main_flow,[trans_1,trans_2,trans_3])
+    return line_derivatives_module.dependences(table,[(trans_1,trans_2,trans_3)])[0]
 
 def calcabc(dmatrix):
         
@@ -1409,120 +1425,97 @@ def isotopomers(expt_A,expt_B,expt_C): # Uses a file of coordinates (Gaussian ou
 
 
 
-def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK):
-    
-    all_combo_file = "all_combo_list%s.txt"%(str(file_num)) 
-    
-    all_combo_list_file  = open(all_combo_file,"a")
-    
-    temp_list_a = []
-    temp_list_b = []
-    temp_list_c = []
-
-    peak_list_1 = peaklist[0:int(len(peaklist)/4)]#splits peaks into 4 parts to speed up processing
-    peak_list_2 = peaklist[int(len(peaklist)/4):int(len(peaklist)/2)]
-    peak_list_3 = peaklist[int(len(peaklist)/2):int(len(peaklist)*0.75)]
-    peak_list_4 = peaklist[int(len(peaklist)*0.75):len(peaklist)]
-
-    p_1 = float(peak_list_1[0][0])
-    p_2 = float(peak_list_1[-1][0])
-    p_3 = float(peak_list_2[0][0])
-    p_4 = float(peak_list_2[-1][0])
-    p_5 = float(peak_list_3[0][0])
-    p_6 = float(peak_list_3[-1][0])
-    p_7 = float(peak_list_4[0][0])
-    p_8 = float(peak_list_4[-1][0])
-
-
-    pred_ratio = pow(10,max(float(trans_1[0]),float(trans_2[0]),float(trans_3[0]))-min(float(trans_1[0]),float(trans_2[0]),float(trans_3[0])))
-
-    for freq_1,inten_1 in list_a:
-      temp_diff = abs(float(trans_1[1])-float(freq_1))
-      temp_list_a.append((freq_1,inten_1,temp_diff))
-
-    for freq_2,inten_2 in list_b:
-      temp_diff = abs(float(trans_2[1])-float(freq_2))
-      temp_list_b.append((freq_2,inten_2,temp_diff))
-
-    for freq_3,inten_3 in list_c:
-      temp_diff = abs(float(trans_3[1])-float(freq_3))
-      temp_list_c.append((freq_3,inten_3,temp_diff))
-
-    unsorted_full_list = []
-
-    for freq_1,inten_1,diff_1 in temp_list_a:
-        for freq_2,inten_2,diff_2 in temp_list_b:
-            for freq_3,inten_3,diff_3 in temp_list_c:
-                real_ratio = max(float(inten_1),float(inten_2),float(inten_3))/min(float(inten_1),float(inten_2),float(inten_3))
-                avg_diff = (diff_1+diff_2+diff_3)/3
-                scaled_diff = avg_diff*(abs(real_ratio-pred_ratio)+1) # Freq. difference scaled by deviation of intensity ratio from predicted
-                unsorted_full_list.append((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff))
-
-    sorted_full_list = sorted(unsorted_full_list, key=lambda entry: entry[6])
-
-    for freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,total_diff in sorted_full_list:
-        all_combo_list_file.write(str(freq_1)+","+str(inten_1)+","+str(freq_2)+","+str(inten_2)+","+str(freq_3)+","+str(inten_3)+", \n")
-
-    #for freq_1,inten_1,diff_1 in sorted_list_a:#generates all combinations of three peaks from three peaklists
-    #    for freq_2,inten_2,diff_2 in sorted_list_b:
-    #        for freq_3,inten_3,diff_3 in sorted_list_c:
-    #            all_combo_list_file.write(str(freq_1)+","+str(inten_1)+","+str(freq_2)+","+str(inten_2)+","+str(freq_3)+","+str(inten_3)+", \n")
-    
-    all_combo_list_file.close()
-    
-    all_combo_list_file = open(all_combo_file)
+def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,file_num,A,B,C,DJ,DJK,DK,dJ,dK,engine="spfit",batch_model=None,task_queue=None,confirm_omc=2.0,top_k=0,min_score=0,result_queue=None,dedup_tol=0.0,hit_sigma=0.0,progress=None,active=None,pin_cpus=False,in_flight=1,ram_dir=None):
     
+    if peaklist is None: # Mapped from the job directory (triples_store_module.save_peaks), not copied into every process
+        (peak_freqs,peak_intens) = triples_store_module.attach_peaks()
+    else:
+        (peak_freqs,peak_intens) = triples_scoring_module.sorted_peaks(peaklist) # Sorted peak arrays for the nearest-peak lookups in scoring
+    theor_inten = [10**float(entry[0]) for entry in top_17] # Predicted intensities of the check transitions, for the intensity penalty
+    check_order = triples_scoring_module.check_order(theor_inten) # Strongest check transition first, for early-abort scoring
+    best_penalized = [] # Negated avg w/ inten penalty of this process's top_k fits so far (max-heap), for early-abort scoring
+    result_heaps = triples_results_module.new_heaps() # Best result lines of this process for each ranking, sent to the driver at the end
+    output_lines = [] # Result lines for final_output%s.txt since the last flush
+    store_records = [] # Records for results%s.bin, written together with output_lines
+    evaluated_triples = [] # Frequencies of every triple fitted, for the evaluated%s.bin index (incremental reruns)
+    hit_stats = triples_hits_module.new_stats() # Running statistics of this process's fits, for flagging hits (hit_sigma)
+    progress_done = 0 # Triples done and best avg w/ inten penalty, written to the driver's shared progress counters
+    progress_best = float('inf')
+    multiplicity = triples_results_module.Multiplicity() # Constants fitted so far and their counts, with dedup_tol set
+    if pin_cpus:
+        triples_workers_module.pin_cpu(file_num)
+    library = engine == "lib" and program_call_module.library_available() # SPFIT from libcalpgm.so in a helper child of this process; SPFIT.EXE where that can't be loaded
+    if library:
+        in_flight = 1 # One fit at a time, in memory
+        ram_dir = "off"
+    sandbox = triples_sandbox_module.open_sandbox(file_num,ram_dir) # This process's SPFIT files go on the RAM disk if there is one (None: in the job folder)
+    spfit = triples_sandbox_module.spfit_program() # The job folder's one SPFIT, shared by all the processes
+
+
+    def flush(): # Appends what was fitted since the last flush to this process's output files
+        fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
+        fh_final.write("".join(output_lines))
+        fh_final.close()
+        triples_store_module.append_results(file_num,store_records)
+        triples_store_module.append_evaluated(file_num,evaluated_triples)
+        if dedup_tol > 0:
+            multiplicity.save(file_num)
+        del output_lines[:]
+        del store_records[:]
+        del evaluated_triples[:]
+
+    flush_count = 100000
+    if task_queue != None: # Triples handed out by the driver in global scaled_diff order (already screened if engine is "batch")
+        sorted_triples = triples_queue_module.queue_triples(task_queue,file_num,active,in_flight > 1,flush) # Every fit of a chunk goes to disk before the chunk is checkpointed
+    else:
+        sorted_triples = triples_enum_module.best_first_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3) # Lazy, in ascending scaled_diff order; fitting starts right away
+
+    if engine == "batch" and task_queue == None: # Only triples that survive the batched solve get an SPFIT run.
+        sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=confirm_omc,peaks=(peak_freqs,peak_intens)) # peaklist is None if the peaks are mapped
+
+    cascade_fits = 0 # Screen vs SPFIT comparison for the cascade report (engine "batch")
+    cascade_disagreements = 0
+    cascade_const_dev = 0.0
+
     final_omc = []
     triples_counter = 0
-    output_file = ""
-    regular_counter = 0
     #error_counter = 0
 
 
 
-    for all_combo_line in all_combo_list_file:
-        all_combo_line = all_combo_line.split(",")
-        peaks_triple= [(all_combo_line[0],all_combo_line[1]),(all_combo_line[2],all_combo_line[3]),(all_combo_line[4],all_combo_line[5])]
-        
-
-        input_file = ""
-        input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
-        input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
-        input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
-        input_file += "           10000  %s 1.0E+004 \n" % A
-        input_file += "           20000  %s 1.0E+004 \n" % B
-        input_file += "           30000  %s 1.0E+004 \n" % C
-        input_file += "             200  %s 1.0E-025 \n" % DJ
-        input_file += "            1100  %s 1.0E-025 \n" % DJK
-        input_file += "            2000  %s 1.0E-025 \n" % DK
-        input_file += "           40100  %s 1.0E-025 \n" % dJ
-        input_file += "           41000  %s 1.0E-025 \n" % dK
-        fh_par = open("default%s.par"%(str(file_num)),'w')
-        fh_par.write(input_file)
-        fh_par.close()
-
-        input_file = ""#the next part adds in the three peaks to be fit
-        input_file += trans_1[2][0:2]+' '+trans_1[2][2:4]+' '+trans_1[2][4:6]+' '+\
-                      trans_1[3][0:2]+' '+trans_1[3][2:4]+' '+trans_1[3][4:6]+'                      '+peaks_triple[0][0]+' 0.50 1.0000\n' 
-        input_file += trans_2[2][0:2]+' '+trans_2[2][2:4]+' '+trans_2[2][4:6]+' '+\
-                      trans_2[3][0:2]+' '+trans_2[3][2:4]+' '+trans_2[3][4:6]+'                      '+peaks_triple[1][0]+' 0.50 1.0000\n' 
-        input_file += trans_3[2][0:2]+' '+trans_3[2][2:4]+' '+trans_3[2][4:6]+' '+\
-                      trans_3[3][0:2]+' '+trans_3[3][2:4]+' '+trans_3[3][4:6]+'                      '+peaks_triple[2][0]+' 0.50 1.0000\n'
-        counter = 0
-        for line in top_17:#the hack that adds in the check transitions but doesn't use them in the fit
-            input_file += line[2][0:2]+' '+line[2][2:4]+' '+line[2][4:6]+' '+\
-                      line[3][0:2]+' '+line[3][2:4]+' '+line[3][4:6]+'                      '+'%s.0'%(str(counter))+' 0.00 1.0000\n'
-            counter += 1
-        fh_lin = open("default%s.lin"%(str(file_num)), "w")
-        fh_lin.write(input_file)
-        fh_lin.close()        
-        a = subprocess.Popen("SPFIT%s default%s"%(str(file_num),str(file_num)), stdout=subprocess.PIPE, shell=False)
-        a.stdout.read()#used to let SPFIT finish
+    input_file = "" # The .par is the same for every triple; write_inputs writes it with each triple's .lin
+    input_file += "anisole                                         Wed Mar Thu Jun 03 17:45:45 2010\n"
+    input_file += "   8  500   5    0    0.0000E+000    1.0000E+005    1.0000E+000 1.0000000000\n" # don't choose more than 497 check transitions or it will crash.
+    input_file +="a   1  1  0  50  0  1  1  1  1  -1   0\n"
+    input_file += "           10000  %s 1.0E+004 \n" % A
+    input_file += "           20000  %s 1.0E+004 \n" % B
+    input_file += "           30000  %s 1.0E+004 \n" % C
+    input_file += "             200  %s 1.0E-025 \n" % DJ
+    input_file += "            1100  %s 1.0E-025 \n" % DJK
+    input_file += "            2000  %s 1.0E-025 \n" % DK
+    input_file += "           40100  %s 1.0E-025 \n" % dJ
+    input_file += "           41000  %s 1.0E-025 \n" % dK
+    write_inputs = lambda triple,base: program_call_module.write_triple_inputs(base,input_file,triple,trans_1,trans_2,trans_3,top_17)
+    if in_flight > 1 and task_queue == None: # Pipelined runs take the triples in chunks; here the whole search is one
+        sorted_triples = [sorted_triples]
+    if library:
+        spfit_results = program_call_module.library_runs(sorted_triples,input_file,lambda triple: program_call_module.triple_lin(triple,trans_1,trans_2,trans_3,top_17),\
+                                                             fallback=lambda rest: program_call_module.spfit_runs(rest,write_inputs,file_num,program=spfit,folder=sandbox)) # SPFIT.EXE if the library keeps hanging or crashing
+    else:
+        spfit_results = program_call_module.spfit_runs(sorted_triples,write_inputs,file_num,in_flight,program=spfit,folder=sandbox)
+    for (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff),spfit_output,failure in spfit_results:
+        evaluated_triples.append((float(freq_1),float(freq_2),float(freq_3)))
+        progress_done += 1
+        if progress_done <= triples_progress_module.REPORT_EVERY or progress_done % triples_progress_module.REPORT_EVERY == 0: # Each of the first ones too, so the driver sees the process has started and a calibration run (triples_timing_module) counts exactly
+            triples_progress_module.report(progress,file_num,progress_done,progress_best)
+        if failure != None: # Hung or crashed on the retry too; not marked evaluated, so a rerun in this folder tries it again
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),failure)
+            evaluated_triples.pop()
+            continue
 
         const_list = []
 
-        fh_var = open("default%s.var"%(str(file_num)))
-        for line in fh_var:
+        for line in program_call_module.read_output(spfit_output,"var"):
             if line.split()[0] == "10000":
                 temp_A = float(line.split()[1])
                 const_list.append("%.3f" %temp_A)
@@ -1533,12 +1526,10 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 temp_C = float(line.split()[1])
                 const_list.append("%.3f" %temp_C)
 
-        fh_fit = open("default%s.fit"%(str(file_num)))
-        file_list = []
-        for line in fh_fit:
-                file_list.append(line)
+        file_list = program_call_module.read_output(spfit_output,"fit")
 
         freq_list = []
+        rms_fit = None
         for x in range(len(file_list)):
             if file_list[-x][11:14] == "RMS":
                 rms_fit = float(file_list[-x][22:32]) #note - assumes RMS fit error is less than 1 GHz.  Change 22 to 21 if this is a problem.
@@ -1546,11 +1537,12 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 freq_list.append(file_list[-x][60:71])
             if file_list[-x][40:64]=="EXP.FREQ.  -  CALC.FREQ.":
                 break
+        if len(const_list) < 3 or rms_fit == None: # SPFIT exited normally but didn't fit
+            program_call_module.write_skipped(file_num,(freq_1,freq_2,freq_3),"SPFIT%s wrote no A, B, C or RMS"%(str(file_num)))
+            evaluated_triples.pop()
+            continue
         read_fit = (const_list[0],const_list[1], const_list[2],freq_list)
         triples_counter +=1
-        #global cur
-        #cur += 1
-        #update_progress(triples_counter) # Call progress bar
 
         constants = read_fit[0:3]
         freq_17 = read_fit[3]
@@ -1558,86 +1550,48 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
         A_1 = float(constants[0])
         B_1 = float(constants[1])
         C_1 = float(constants[2])
-        omc_list = []
-        
-        theor_inten_list = []
-        for x in range(len(top_17)):
-            temp_inten = 10**float(top_17[x][0])
-            theor_inten_list.append(temp_inten)
-
-        theor_inten_ratio = (max(theor_inten_list)/min(theor_inten_list))
-        theor_inten_avg = (sum(theor_inten_list)/len(theor_inten_list))
-        theor_inten_unitless_stdev = numpy.std(theor_inten_list)/theor_inten_avg
-
-        for x in range(len(top_17)): #matches peaks in the top 17 to peaks in experimental peak list <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-            qnum_up = top_17[x][2]
-            qnum_low = top_17[x][3]
-            real_omc = 1.0
-            current_peak = float(freq_17[x])
-            if current_peak>p_1 and current_peak<p_2:#conditionals to find proper portion of experimental peak list to loop through
-                peaks_section = peak_list_1
-                peak = p_2
-                regular_counter +=1
-            elif current_peak>p_3 and current_peak<p_4:
-                peaks_section = peak_list_2
-                peak = p_4
-                regular_counter +=1
-            elif current_peak>p_5 and current_peak<p_6:
-                peaks_section = peak_list_3
-                peak = p_6
-                regular_counter +=1
-            elif current_peak>p_7 and current_peak<p_8:
-                peaks_section = peak_list_4
-                peak = p_8
-                regular_counter +=1
-            elif current_peak>p_8 or current_peak<p_1:
-                peaks_section = peaklist
-                peak = p_8
-                #error_counter +=1
-                real_omc = 0.0# this is the omc if you throw out peaks that go over the edge of the spectrum
-            else:
-                peaks_section = peaklist
-                peak = p_8
-                regular_counter +=1
-            old_omc = 100000.0
-            omc_inten = 100000.0
-            for peak_freq,peak_inten in peaks_section: #find nearest peak in actual spectrum to the given top 20 peak
-                omc = abs(current_peak-float(peak_freq))
-                omc_low = abs(current_peak-float(peak))
-                if omc>old_omc:
-                    omc_low = old_omc
-                    omc_inten = temp_inten                    
-                    break
-                old_omc = omc
-                temp_inten = peak_inten
-            if real_omc == 1.0:
-                real_omc = omc_low
-            omc_list.append((omc_low, real_omc, omc_inten))# current_peak,qnum_up,qnum_low)) you can add in this extra output, but its slower
-        omc_avg = [float(omc) for omc, real_omc, omc_inten in omc_list]
-        real_omc_avg = [float(real_omc) for omc, real_omc, omc_inten in omc_list]
-        omc_inten_scoring = [float(omc_inten) for omc, real_omc, omc_inten in omc_list]
-        score = str(len([omc for omc in omc_avg if omc<2.0])) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
-        avg = (sum(omc_avg)/len(omc_avg))+rms_fit
-        real_avg = (sum(real_omc_avg)/len(real_omc_avg))+rms_fit
-
-        omc_inten_ratio = (max(omc_inten_scoring)/min(omc_inten_scoring))
-        omc_inten_avg = (sum(omc_inten_scoring)/len(omc_inten_scoring))
-        omc_inten_unitless_stdev = numpy.std(omc_inten_scoring)/omc_inten_avg
-
-        score_inten_penalty = 1
-
-        if (omc_inten_ratio <= 0.5*theor_inten_ratio) or (omc_inten_ratio >= 1.5*theor_inten_ratio):
-            score_inten_penalty += 1
-
-        if (omc_inten_unitless_stdev <= 0.5*theor_inten_unitless_stdev) or (omc_inten_unitless_stdev >= 1.5*theor_inten_unitless_stdev):
-            score_inten_penalty += 1
-        
-        penalized_avg = avg*score_inten_penalty
+        if engine == "batch":
+            (disagree,const_dev) = batch_fit_module.cascade_compare((freq_1,inten_1,freq_2,inten_2,freq_3,inten_3),(A_1,B_1,C_1),freq_17,batch_model,peak_freqs,confirm_omc=confirm_omc)
+            cascade_fits += 1
+            cascade_disagreements += int(disagree)
+            cascade_const_dev += const_dev
+        if dedup_tol > 0: # Constants this process has already scored (to within dedup_tol) are only counted
+            constants_key = triples_scoring_module.constants_key(A_1,B_1,C_1,dedup_tol)
+            if multiplicity.repeat(constants_key):
+                continue
+            multiplicity.record(constants_key) # Before early abort, so the duplicates of a dropped fit are only counted too
+        if top_k > 0 or min_score > 0: # Strongest check lines first; fits that can't make this process's top_k or reach min_score are dropped
+            cutoff = float('inf')
+            if top_k > 0 and len(best_penalized) == top_k:
+                cutoff = -best_penalized[0]
+            scores = triples_scoring_module.score_fit_ordered(freq_17,rms_fit,peak_freqs,peak_intens,theor_inten,check_order,cutoff,min_score)
+            if scores == None:
+                continue
+        else:
+            scores = triples_scoring_module.score_fits(numpy.array([freq_17],dtype=float),rms_fit,peak_freqs,peak_intens,theor_inten) #matches the check transitions to the nearest experimental peaks and scores the fit
+        score = str(scores['score'][0]) #scores the accuracy of the fit, currently based on a peak being within 2 MHz which may be too coarse
+        avg = float(scores['avg'][0])
+        real_avg = float(scores['real_avg'][0])
+        penalized_avg = float(scores['penalized_avg'][0])
 
         if float(A_1)>=float(B_1) and float(B_1)>=float(C_1) and float(C_1)>0:
             if int(score)<10: #makes sorting work properly later
                 score = '0'+score  
-            output_file += 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            result_line = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
+            output_lines.append(result_line)
+            triples_results_module.add_result(result_heaps,result_line,(avg,real_avg,penalized_avg))
+            peak_index = triples_scoring_module.nearest_peaks([float(freq_1),float(freq_2),float(freq_3)],peak_freqs)[1]
+            store_records.append((peak_index[0],peak_index[1],peak_index[2],A_1,B_1,C_1,rms_fit,int(score),avg,real_avg,penalized_avg))
+            progress_best = min(progress_best,penalized_avg)
+            if dedup_tol > 0:
+                multiplicity.keep_line(constants_key,result_line)
+            if hit_sigma > 0: # Anytime search: a fit far below this process's bulk of fits goes to hits%s.txt right away
+                triples_hits_module.check_hit(file_num,hit_stats,avg,result_line,hit_sigma)
+            if top_k > 0:
+                if len(best_penalized) < top_k:
+                    heapq.heappush(best_penalized,-penalized_avg)
+                else:
+                    heapq.heappushpop(best_penalized,-penalized_avg)
 
             if real_avg <= 0.2: #appends good finds (RMS < 0.2 MHz, ignoring peaks over edge) to interim file for each processor
                 interim_output = 'score = '+' '+score+' '+"Const = "+str(A_1)+' '+str(B_1)+' '+str(C_1)+' '+"average omc = "+str(avg)+'  '+"avg w/out peaks over edge = "+str(real_avg)+' '+"avg w/ inten penalty = "+str(penalized_avg)+"\n"
@@ -1645,42 +1599,18 @@ def fit_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,top_17,peaklist,fil
                 fh_interim_good.write(interim_output)
                 fh_interim_good.close()
 
-            if triples_counter == 100000: #appends to file after every 100000 triples
-                fh_final = open("final_output%s.txt"%(str(file_num)), "a")
-                fh_final.write(output_file)
-                fh_final.close()
-                triples_counter = 0
-                output_file = ""
-    fh_final = open("final_output%s.txt"%(str(file_num)), "a")#writes separate file for each processor
-    #print 'out of %s peaks there were %s peaks that werent in the experimental spectrum'%(regular_counter, error_counter) 
-    fh_final.write(output_file)
-    fh_final.close()
-    os.system("sort -r 'final_output%s.txt'>sorted_final_out%s.txt"%(str(file_num),str(file_num)))#sorts output by score
-"""
-def update_progress(progress):
-    global count
-    if count == 0:
-        global t1
-        t1 = time.time()
-    count += 1
-    if count == 100:
-        global veloc
-        global t2
-        t2 = time.time()
-        veloc = count/(t2-t1)
-        count = 0
-    sys.stdout.write('\r'+str(progress*processors)+'/'+str(tot)+' :: ' + '[{0}] {1}%'.format('#'*((progress*processors)/(int(tot)/10)),str(int((progress*processors)/float(tot)*100)))+' :: '+str(int(veloc*processors))+' Hz ::') # using print() prints new lines
-    sys.stdout.flush()
-"""
+        if task_queue == None and triples_counter >= flush_count: #appends to file after every 100000 triples; queued chunks are only written when they're done (queue_triples), so a resume never finds half a chunk
+            flush()
+            triples_counter = 0
+    triples_sandbox_module.close_sandbox(sandbox)
+    flush()
+    if engine == "batch":
+        batch_fit_module.write_cascade_stats(file_num,cascade_fits,cascade_disagreements,cascade_const_dev)
+    triples_progress_module.report(progress,file_num,progress_done,progress_best)
+    if result_queue != None: # Best lines of this process, merged by the driver
+        result_queue.put(result_heaps)
+
 if __name__ == '__main__': #multiprocessing imports script as module
-    
-    ## The following block sets the parameters for the progress bar during autofit run
-    #tot = 0
-    #t1 = time.time()
-    #t2 = time.time()
-    #veloc = 0
-    #count = 0
-    #cur = 0
 
     u_A = "0.0"#<<<<<<<<<<<<<set default value here
     u_B = "1.0"#<<<<<<<<<<<<<set default value here
@@ -1700,11 +1630,92 @@ if __name__ == '__main__': #multiprocessing imports script as module
     inten_low = float('4E-004')
     temperature="2"
     Jmax="20"     
+    engine = "spfit"#<<<<<<<<<<<<<set default value here, "spfit" fits every triple with SPFIT, "batch" screens them with batch_fit_module first, "lib" runs SPFIT from libcalpgm.so in a helper process (same timeout as SPFIT.EXE, which takes over if it keeps failing)
+    confirm_omc = 2.0#<<<<<<<<<<<<<batch screen: median check omc (MHz) a triple needs to go on to SPFIT
+    keep_fraction = None#<<<<<<<<<<<<<batch screen: set to e.g. 0.05 to send the best 5% of each block to SPFIT instead of using confirm_omc
+    audit_every = 0#<<<<<<<<<<<<<batch screen: fit every n-th rejected triple anyway to count the screen's misses (0 = off)
+    top_k = 0#<<<<<<<<<<<<<early-abort scoring: only keep fits that can still make each process's top_k (0 = score and keep every fit)
+    min_score = 0#<<<<<<<<<<<<<early-abort scoring: drop fits with fewer check lines than this within 2 MHz
+    hit_sigma = 0.0#<<<<<<<<<<<<<anytime search: fits this many standard deviations below the rest (log10 average omc) go to hits.txt as they're found, 0 is off
+    stop_hits = 0#<<<<<<<<<<<<<stop the search once this many hits agree on the constants, 0 never stops
+    dedup_tol = 0.0#<<<<<<<<<<<<<MHz; fits whose A, B and C agree to within this are scored once and counted (fit_multiplicity.txt), 0 is off
+    adaptive_workers = False#<<<<<<<<<<<<<True treats processors as the most processes to use and finds the number with the best throughput while it runs
+    pin_cpus = False#<<<<<<<<<<<<<True pins each process to its own CPU
+    in_flight = 1#<<<<<<<<<<<<<SPFIT runs each process keeps going at once; above 1 the next fits' files are written and the last one read while SPFIT runs
+    ram_dir = None#<<<<<<<<<<<<<Folder on a RAM disk for the SPFIT files of each process (/dev/shm if there is one); "off" keeps them in the job folder
+    spcat_cache = None#<<<<<<<<<<<<<Folder SPCAT predictions are also kept in, so later runs reuse them too (None keeps them in memory for this run only)
+    pair_prune = False#<<<<<<<<<<<<<True skips trans_1/trans_2 peak pairs that can't give A >= B >= C > 0 with trans_3 in its window; "sweep" also only pairs each with the trans_3 peaks its line can reach
         
 
-    main_flow = buttonbox(msg='Are you searching for a normal species spectrum or singly-substituted isotopologues (already have NS experimental constants)?', choices=('Normal species','Isotopologues'))
+    main_flow = buttonbox(msg='Are you searching for a normal species spectrum or singly-substituted isotopologues (already have NS experimental constants)?', choices=('Normal species','Isotopologues','Resume a job'))
+
+    if main_flow == 'Resume a job': # Picks up a paused or crashed run from the checkpoint files in its folder (see triples_checkpoint_module)
+        os.chdir(diropenbox(msg="Choose the folder of the job (or isotopologue) to resume"))
+        (info,peaklist) = triples_checkpoint_module.read_checkpoint_info()
+        triples_checkpoint_module.clear_pause()
+        triples_checkpoint_module.rewind_outputs()
+        done_chunks = triples_checkpoint_module.completed_chunks()
+        suffix = info['output_suffix']
+        processors = info['processors']
+
+        batch_model = None
+        if info['engine'] == "batch":
+            batch_model = batch_fit_module.linear_model(info['trans_1'],info['trans_2'],info['trans_3'],info['check_peaks'],info['model_A'],info['model_B'],info['model_C'],info['DJ'],info['DJK'],info['DK'],info['dJ'],info['dK'],info['temperature'])
+
+        (pair_mask,pair_window) = batch_fit_module.pair_filter(info.get('pair_prune',False),info['trans_1_peaks'],info['trans_2_peaks'],info['trans_3_peaks'],info['trans_1'],info['trans_2'],info['trans_3'],\
+                                                               info['model_A'],info['model_B'],info['model_C'],info['DJ'],info['DJK'],info['DK'],info['dJ'],info['dK'],info['temperature'])[0:2]
+
+        sorted_triples = triples_enum_module.best_first_triples(info['trans_1_peaks'],info['trans_2_peaks'],info['trans_3_peaks'],info['trans_1'],info['trans_2'],info['trans_3'],pair_mask=pair_mask,pair_window=pair_window)
+        if info.get('evaluated_records'): # Incremental rerun: only the triples the earlier searches here didn't fit (e.g. the new outer shell of wider windows)
+            sorted_triples = triples_store_module.skip_evaluated(sorted_triples,triples_store_module.load_evaluated(info.get('evaluated_records')))
+        screen_stats = {}
+        if info['engine'] == "batch":
+            sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=info.get('confirm_omc',2.0),keep_fraction=info.get('keep_fraction'),\
+                                                           stats=screen_stats,audit_every=info.get('audit_every',0))
+
+        task_queue = multiprocessing.Queue(processors*4)
+        result_queue = multiprocessing.Queue()
+        progress = triples_progress_module.new_counters(processors) # Shared per-process counters, published by reporter
+        (active,controller) = triples_workers_module.adaptive(processors,progress,info.get('adaptive_workers',False)) # Limit on the processes taking chunks, moved by controller
+        timing_key = triples_timing_module.timing_key(info['engine'],processors)
+        reporter = triples_progress_module.ProgressReporter(progress,info['num_of_triples'],len(done_chunks)*info['chunk_size'],seconds_per_triple=triples_timing_module.stored_seconds(timing_key),timing_key=timing_key,controller=controller)
+        triples_store_module.save_peaks(peaklist) # What the peak indices in results%s.bin point into
+        result_heaps = triples_results_module.read_results() # Fits of the chunks done before the resume are only in the final_output files
+
+        workers = []
+        for num in range(processors):
+            vars()["p%s"%str(num)] = Process(target=fit_triples, args=([],[],[],info['trans_1'],info['trans_2'],info['trans_3'],info['check_peaks'],None,num,info['A'],info['B'],info['C'],\
+                                             info['DJ'],info['DJK'],info['DK'],info['dJ'],info['dK'],info['engine'],batch_model,task_queue,info.get('confirm_omc',2.0),\
+                                             info.get('top_k',0),info.get('min_score',0),result_queue,info.get('dedup_tol',0.0),info.get('hit_sigma',0.0),progress,active,info.get('pin_cpus',False),info.get('in_flight',1),info.get('ram_dir',None)))
+            workers.append(vars()["p%s"%str(num)])
 
-    scale_factor = time_estimate()
+        for num in range(processors):
+            vars()["p%s"%str(num)].start()
+
+        status = triples_queue_module.feed_queue(task_queue,sorted_triples,processors,workers,info['chunk_size'],done_chunks,stop_hits=info.get('stop_hits',0),reporter=reporter,controller=controller,stats=screen_stats)
+        result_heaps = triples_results_module.collect_heaps(result_queue,workers,result_heaps,reporter=reporter)
+
+        for num in range(processors):
+            vars()["p%s"%str(num)].join()
+        reporter.finish(status)
+
+        if status == "Paused":
+            batch_fit_module.save_screen_stats(screen_stats) # Added to the resumed run's counts in its cascade report
+            msgbox(msg='The job has been paused again.')
+            quit()
+
+        if info['engine'] == "batch":
+            print(batch_fit_module.cascade_report(screen_stats,info.get('confirm_omc',2.0),info.get('keep_fraction')))
+
+        fits = triples_results_module.write_results(result_heaps,suffix)
+        if info.get('dedup_tol',0.0) > 0:
+            triples_results_module.write_multiplicity(info['dedup_tol'],suffix)
+
+        finished = 'Fitting routine has finished.'
+        if status == "Stopped":
+            finished = '%s hits agree on the constants (hits*.txt), so the search was stopped early.'%(info['stop_hits'])
+        codebox(msg=finished+'  These are the best 100 results, saved in best100%s.txt.  '%(suffix)+program_call_module.skipped_message(),text=fits)
+        quit()
 
 
     x = subprocess.Popen("ls", stdout=subprocess.PIPE, shell=True)
@@ -1721,7 +1732,7 @@ if __name__ == '__main__': #multiprocessing imports script as module
     file_flag = 1
     
     while file_flag==1:
-        filename = multenterbox("Choose a folder name for the calculation. If the folder already exists, this dialogue will reset.","",["Job Name"] )
+        filename = multenterbox("Choose a folder name for the calculation.  An existing job folder can be picked for a rerun.","",["Job Name"] )
         job_name = filename[0]
         marker1 = 0
         for file1 in x:
@@ -1729,9 +1740,14 @@ if __name__ == '__main__': #multiprocessing imports script as module
                 marker1 = 1
         if marker1 ==0:
             file_flag =0
+        elif os.path.isdir(job_name): # Incremental rerun: start_search skips the triples an identical earlier search in it already fitted
+            rerun = buttonbox(msg='The folder %s already exists.  Rerun the search in it?  If the transitions, check transitions, constants and engine are the same as its last search, only the triples that search did not fit are fitted; otherwise its results are moved to a previous_search folder inside it first.'%(job_name), choices=('Rerun in this folder','Choose another name'))
+            if rerun == 'Rerun in this folder':
+                file_flag =0
         
-    a = subprocess.Popen("mkdir %s"%job_name)
-    a.wait()
+    if not os.path.isdir(job_name):
+        a = subprocess.Popen("mkdir %s"%job_name)
+        a.wait()
 
     fitting_peaks_flag =0
     
@@ -1784,6 +1800,41 @@ if __name__ == '__main__': #multiprocessing imports script as module
                     Jmax = float(line.split()[1])
                 if line.split()[0] == "freq_uncertainty:":
                     freq_uncertainty = float(line.split()[1])                    
+                if line.split()[0] == "engine:":
+                    engine = line.split()[1]
+                    if engine == "lib" and not program_call_module.library_available():
+                        print "engine lib: libcalpgm.so could not be loaded, SPFIT.EXE is used instead"
+                if line.split()[0] == "confirm_omc:":
+                    confirm_omc = float(line.split()[1])
+                if line.split()[0] == "keep_fraction:" and line.split()[1] != "None":
+                    keep_fraction = float(line.split()[1])
+                if line.split()[0] == "audit_every:":
+                    audit_every = int(line.split()[1])
+                if line.split()[0] == "top_k:":
+                    top_k = int(line.split()[1])
+                if line.split()[0] == "min_score:":
+                    min_score = int(line.split()[1])
+                if line.split()[0] == "hit_sigma:":
+                    hit_sigma = float(line.split()[1])
+                if line.split()[0] == "stop_hits:":
+                    stop_hits = int(line.split()[1])
+                if line.split()[0] == "dedup_tol:":
+                    dedup_tol = float(line.split()[1])
+                if line.split()[0] == "adaptive_workers:":
+                    adaptive_workers = (line.split()[1] == "True")
+                if line.split()[0] == "pin_cpus:":
+                    pin_cpus = (line.split()[1] == "True")
+                if line.split()[0] == "in_flight:":
+                    in_flight = int(line.split()[1])
+                if line.split()[0] == "ram_dir:":
+                    ram_dir = line.split()[1]
+                if line.split()[0] == "spcat_cache:":
+                    spcat_cache = line.split()[1]
+                if line.split()[0] == "pair_prune:":
+                    if line.split()[1] == "sweep":
+                        pair_prune = "sweep"
+                    else:
+                        pair_prune = (line.split()[1] == "True")
                 if line.split()[0] == "trans_1:" or line.split()[0] == "trans_2:" or line.split()[0] == "trans_3:":
                     fitting_peaks_flag = 0
                     clean = line[12:53]
@@ -1801,6 +1852,8 @@ if __name__ == '__main__': #multiprocessing imports script as module
                 if line.split()[0] == "Check":
                     fitting_peaks_flag = 1
                                     
+    prediction_cache_module.use_disk(spcat_cache)
+
     if file_decision_flag ==0:
         if main_flow == 'Isotopologues':
             msg = "Enter constants for the normal species isotopologue in MHz. If left blank, they will be set to default values (in parentheses). The inputs will be sent directly to SPCAT, so remember to input -DJ, -DJK, etc. "
@@ -1857,12 +1910,7 @@ if __name__ == '__main__': #multiprocessing imports script as module
     spectrum_2kHz = cubic_spline(fh,0.002) # Interpolates experimental spectrum to a 2 kHz resolution with a cubic spline.  Gives better peak-pick values.
     (peaklist, freq_low, freq_high) = peakpicker(spectrum_2kHz,inten_low,inten_high) # Calls slightly modified version of Cristobal's routine to pick peaks instead of forcing user to do so.
     
-    for number in range(processors):
-        y = subprocess.Popen("cp SPFIT.EXE %s\SPFIT%s.EXE"%(job_name,number), stdout=subprocess.PIPE, shell=True)
-        y.stdout.read()     
-
-    y = subprocess.Popen("cp SPCAT.EXE %s\SPCAT.EXE"%(job_name), stdout=subprocess.PIPE, shell=True)
-    y.stdout.read() 
+    triples_sandbox_module.copy_programs(job_name) # One SPFIT and SPCAT, shared by all the processes
     
     os.chdir(job_name)
     
@@ -1905,7 +1953,7 @@ if __name__ == '__main__': #multiprocessing imports script as module
         peak_3_uncertainty = 0
         decision = ""
 
-        (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,scale_factor)
+        (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,processors,pair_prune,check_peaks=check_peaks_list)
 
         if check_peaks_list == []:                                        
             int_writer(u_A,u_B,u_C, J_max=Jmax,freq=str((freq_high*.001)), temperature=temperature,flag="default")
@@ -1937,6 +1985,13 @@ if __name__ == '__main__': #multiprocessing imports script as module
 
         print num_of_triples
 
+        evaluated_records = triples_store_module.start_search(triples_store_module.search_identity(trans_1,trans_2,trans_3,top_peaks_3cut,(A,B,C,DJ,DJK,DK,dJ,dK),engine)) # Triples fitted by an earlier search of the same transitions, checks, constants and engine in this folder, skipped this time; any other search's outputs are moved to previous_search<n>
+        program_call_module.clear_skipped() # Tried again this time
+        triples_hits_module.clear_hits() # So an earlier search's hits can't stop this one
+        batch_fit_module.clear_cascade_stats() # Counted from 0 again too
+        if evaluated_records:
+            triples_checkpoint_module.start_rerun()
+
         job_file = ""
         str(top_peaks_3cut)
         str(trans_1)
@@ -1948,92 +2003,73 @@ if __name__ == '__main__': #multiprocessing imports script as module
             
         job_file += "Job Name %s \n u_A: %s \n u_B: %s \n u_C: %s \n A: %s \n B: %s \n \
     C: %s \n DJ: %s \n DJK: %s \n DK: %s \n dJ: %s \n dK: %s \n processors: %s \n freq_high: %s \n freq_low: %s \n \
-    inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s "%(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
-        str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3))
+    inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s \n engine: %s \n confirm_omc: %s \n keep_fraction: %s \n audit_every: %s \n top_k: %s \n min_score: %s \n pair_prune: %s \n dedup_tol: %s \n hit_sigma: %s \n stop_hits: %s \n adaptive_workers: %s \n pin_cpus: %s \n in_flight: %s \n ram_dir: %s "%(job_name,u_A,u_B,u_C,A,B,C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
+        str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3),engine,str(confirm_omc),str(keep_fraction),str(audit_every),str(top_k),str(min_score),str(pair_prune),str(dedup_tol),str(hit_sigma),str(stop_hits),str(adaptive_workers),str(pin_cpus),str(in_flight),str(ram_dir))
         Job_fh = open("input_data_%s.txt"%(job_name),"w")
         Job_fh.write(job_file) 
         Job_fh.close()
 
-        new_list = []
+        triples_checkpoint_module.write_checkpoint_info({'program':"prog_A",'job_name':job_name,'output_suffix':"",'A':A,'B':B,'C':C,'model_A':A,'model_B':B,'model_C':C,\
+            'DJ':DJ,'DJK':DJK,'DK':DK,'dJ':dJ,'dK':dK,'temperature':temperature,'processors':int(processors),'engine':engine,'confirm_omc':confirm_omc,'keep_fraction':keep_fraction,'audit_every':audit_every,'top_k':top_k,'min_score':min_score,'pair_prune':pair_prune,'dedup_tol':dedup_tol,'hit_sigma':hit_sigma,'stop_hits':stop_hits,'adaptive_workers':adaptive_workers,'pin_cpus':pin_cpus,'in_flight':in_flight,'ram_dir':ram_dir,'evaluated_records':evaluated_records,'chunk_size':50,'num_of_triples':num_of_triples,\
+            'trans_1':trans_1,'trans_2':trans_2,'trans_3':trans_3,'check_peaks':top_peaks_3cut,'trans_1_peaks':triples_checkpoint_module.string_peaks(trans_1_peaks),\
+            'trans_2_peaks':triples_checkpoint_module.string_peaks(trans_2_peaks),'trans_3_peaks':triples_checkpoint_module.string_peaks(trans_3_peaks)},peaklist)
 
-        new_list = [(len(trans_1_peaks),"trans_1_peaks"),(len(trans_2_peaks),"trans_2_peaks"),(len(trans_3_peaks),"trans_3_peaks")]
-        new_list.sort()
-            
-        list_key = []
-        list_a_peaks = [vars()[new_list[0][1]],new_list[0][1]]
-        list_b_peaks = [vars()[new_list[1][1]],new_list[1][1]]
-        list_c_peaks = vars()[new_list[2][1]]
+        batch_model = None
+        if engine == "batch": # Linear model for the batched solver, built once here instead of in every process.
+            batch_model = batch_fit_module.linear_model(trans_1,trans_2,trans_3,top_peaks_3cut,A,B,C,DJ,DJK,DK,dJ,dK,temperature)
 
-        random.shuffle(list_c_peaks)  # Shuffle so that each processor gets a range of values for the third peak, not processor 0 getting only the lowest frequencies.  
+        (pair_mask,pair_window) = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,A,B,C,DJ,DJK,DK,dJ,dK,temperature)[0:2] # The same pairs triples_gen counted
 
-        list_c_list = []
-        for num in range(processors):
-            processors = float(processors)
-            num = float(num)
-            x = int((num)*(len(list_c_peaks)/processors))
-            y = int(len(list_c_peaks)*((num+1)/processors))
-            list_c_list.append(list_c_peaks[x:y])
-        list_c_list.append("marker")
-        vars()[new_list[0][1]] = list_a_peaks[0]
-        vars()[new_list[1][1]] = list_b_peaks[0]
-        vars()[new_list[2][1]] = list_c_list
+        sorted_triples = triples_enum_module.best_first_triples(trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_mask=pair_mask,pair_window=pair_window) # Every triple in global scaled_diff order, handed out in chunks to whichever process is free
+        if evaluated_records: # Incremental rerun: only the triples the earlier searches here didn't fit (e.g. the new outer shell of wider windows)
+            sorted_triples = triples_store_module.skip_evaluated(sorted_triples,triples_store_module.load_evaluated(evaluated_records))
+        screen_stats = {}
+        if engine == "batch":
+            sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=confirm_omc,keep_fraction=keep_fraction,stats=screen_stats,audit_every=audit_every)
 
         processors = int(processors)
+        task_queue = multiprocessing.Queue(processors*4)
+        result_queue = multiprocessing.Queue()
+        progress = triples_progress_module.new_counters(processors) # Shared per-process counters, published by reporter
+        (active,controller) = triples_workers_module.adaptive(processors,progress,adaptive_workers) # Limit on the processes taking chunks, moved by controller
+        timing_key = triples_timing_module.timing_key(engine,processors)
+        reporter = triples_progress_module.ProgressReporter(progress,num_of_triples,seconds_per_triple=triples_timing_module.stored_seconds(timing_key),timing_key=timing_key,controller=controller)
+        triples_store_module.save_peaks(peaklist) # What the peak indices in results%s.bin point into
+        result_heaps = triples_results_module.new_heaps()
+        if evaluated_records: # The fits of the earlier searches are only in the final_output files
+            result_heaps = triples_results_module.read_results()
+
+        workers = []
         for num in range(processors):
-
-            if trans_1_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks[num]
-                trans_y_peaks = trans_2_peaks
-                trans_z_peaks = trans_3_peaks
-            
-            if trans_2_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks
-                trans_y_peaks = trans_2_peaks[num]
-                trans_z_peaks = trans_3_peaks
-
-            if trans_3_peaks[-1]=="marker":
-                trans_x_peaks = trans_1_peaks
-                trans_y_peaks = trans_2_peaks
-                trans_z_peaks = trans_3_peaks[num]
-            
-            vars()["p%s"%str(num)] = Process(target=fit_triples, args=(trans_x_peaks,trans_y_peaks,trans_z_peaks,trans_1,trans_2,trans_3,top_peaks_3cut,peaklist,num,A,B,C,DJ,DJK,DK,dJ,dK))
+            vars()["p%s"%str(num)] = Process(target=fit_triples, args=([],[],[],trans_1,trans_2,trans_3,top_peaks_3cut,None,num,A,B,C,DJ,DJK,DK,dJ,dK,engine,batch_model,task_queue,confirm_omc,top_k,min_score,result_queue,dedup_tol,hit_sigma,progress,active,pin_cpus,in_flight,ram_dir))
+            workers.append(vars()["p%s"%str(num)])
 
         for num in range(processors):
             vars()["p%s"%str(num)].start()
-        for num in range(processors):
-            vars()["p%s"%str(num)].join()
-            
-        a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 4 -n > sorted_omc_cat.txt', shell=True)
-        a.wait()
-    
-        a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 6 -n > sorted_inten_omc_cat.txt', shell=True)
-        a.wait()
-
-        f = open('sorted_inten_omc_cat.txt','r')
-        fits = []
 
-        for i in range(100):
-            r = f.readline()
+        status = triples_queue_module.feed_queue(task_queue,sorted_triples,processors,workers,stop_hits=stop_hits,reporter=reporter,controller=controller,stats=screen_stats)
+        result_heaps = triples_results_module.collect_heaps(result_queue,workers,result_heaps,reporter=reporter)
 
-            if i < 10:
-                number = '0'+str(i)
-            else:
-                number = i
-
-            temp = str(number) + ' ' + r
-            fits.append(temp)
-
-        f.close()
+        for num in range(processors):
+            vars()["p%s"%str(num)].join()
+        reporter.finish(status)
 
-        OMC_char_buffer = ""
-        for i in (fits):
-            OMC_char_buffer += i+''
+        if status == "Paused":
+            batch_fit_module.save_screen_stats(screen_stats) # Added to the resumed run's counts in its cascade report
+            msgbox(msg='The job has been paused.  Run prog_A again and choose "Resume a job" to pick it up from where it stopped.')
+            quit()
 
-        f100=open('best100.txt','w')
-        f100.write(OMC_char_buffer)
-        f100.close()
+        if engine == "batch":
+            print(batch_fit_module.cascade_report(screen_stats,confirm_omc,keep_fraction))
+            
+        fits = triples_results_module.write_results(result_heaps)
+        if dedup_tol > 0:
+            triples_results_module.write_multiplicity(dedup_tol)
 
-        codebox(msg='Fitting routine has finished.  These are the best 100 results, saved in best100.txt.',text=fits)
+        finished = 'Fitting routine has finished.'
+        if status == "Stopped":
+            finished = '%s hits agree on the constants (hits*.txt), so the search was stopped early.'%(stop_hits)
+        codebox(msg=finished+'  These are the best 100 results, saved in best100.txt.  '+program_call_module.skipped_message(),text=fits)
 
         refine_fit_decision = buttonbox(msg='Would you like to further refine any of the recent results by allowing distortions to vary?', choices=('Yes!',"No, I'm done!"))
         if refine_fit_decision == "No, I'm done!":
@@ -2114,15 +2150,11 @@ if __name__ == '__main__': #multiprocessing imports script as module
             curr_B = isotopologue[2]
             curr_C = isotopologue[3]
 
-            a = subprocess.Popen("mkdir %s"%isotope_ID)
-            a.wait()
+            if not os.path.isdir(isotope_ID): # Already there in a rerun
+                a = subprocess.Popen("mkdir %s"%isotope_ID)
+                a.wait()
 
-            for number in range(processors):
-                y = subprocess.Popen("cp SPFIT%s.EXE %s\SPFIT%s.EXE"%(number,isotope_ID,number), stdout=subprocess.PIPE, shell=True)
-                y.stdout.read()     
-
-            y = subprocess.Popen("cp SPCAT.EXE %s\SPCAT.EXE"%(isotope_ID), stdout=subprocess.PIPE, shell=True)
-            y.stdout.read() 
+            triples_sandbox_module.copy_programs(isotope_ID) # One SPFIT and SPCAT, shared by all the processes
 
             os.chdir(isotope_ID)
 
@@ -2165,7 +2197,7 @@ if __name__ == '__main__': #multiprocessing imports script as module
                 peak_3_uncertainty = 0
                 decision = ""
 
-            (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,scale_factor)
+            (trans_1,trans_2,trans_3,trans_1_peaks,trans_2_peaks,trans_3_peaks,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,num_of_triples,decision) = triples_gen(window_decision,trans_1_uncert,trans_2_uncert,trans_3_uncert,freq_uncertainty,peak_1_uncertainty,peak_2_uncertainty,peak_3_uncertainty,peaklist,freq_low,freq_high,isotopomer_count,decision,full_list,A,B,C,DJ,DJK,DK,dJ,dK,temperature,u_A,u_B,u_C,main_flow,trans_1,trans_2,trans_3,processors,pair_prune,(curr_A,curr_B,curr_C),check_peaks=check_peaks_list)
 
             if check_peaks_list == []:            
                 int_writer(u_A,u_B,u_C, J_max=Jmax,freq=str((freq_high*.001)), temperature=temperature,flag="default")
@@ -2231,6 +2263,13 @@ if __name__ == '__main__': #multiprocessing imports script as module
 
             print num_of_triples
 
+            evaluated_records = triples_store_module.start_search(triples_store_module.search_identity(trans_1,trans_2,trans_3,top_peaks_3cut,(A,B,C,DJ,DJK,DK,dJ,dK,curr_A,curr_B,curr_C),engine)) # Triples fitted by an earlier search of the same transitions, checks, constants and engine in this folder, skipped this time; any other search's outputs are moved to previous_search<n>
+            program_call_module.clear_skipped() # Tried again this time
+            triples_hits_module.clear_hits() # So an earlier search's hits can't stop this one
+            batch_fit_module.clear_cascade_stats() # Counted from 0 again too
+            if evaluated_records:
+                triples_checkpoint_module.start_rerun()
+
             job_file = ""
             str(top_peaks_3cut)
             str(trans_1)
@@ -2242,67 +2281,68 @@ if __name__ == '__main__': #multiprocessing imports script as module
         
             job_file += "Job Name %s \n Isotope ID %s \n u_A: %s \n u_B: %s \n u_C: %s \n A: %s \n B: %s \n \
 C: %s \n DJ: %s \n DJK: %s \n DK: %s \n dJ: %s \n dK: %s \n processors: %s \n freq_high: %s \n freq_low: %s \n \
-inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s "%(job_name,isotope_ID,u_A,u_B,u_C,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
-            str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3))
+inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s \n number of triples: %s \n Check peaks:\n%s \n trans_1: %s \n trans_2: %s \n trans_3: %s \n engine: %s \n confirm_omc: %s \n keep_fraction: %s \n audit_every: %s \n top_k: %s \n min_score: %s \n pair_prune: %s \n dedup_tol: %s \n hit_sigma: %s \n stop_hits: %s \n adaptive_workers: %s \n pin_cpus: %s \n in_flight: %s \n ram_dir: %s "%(job_name,isotope_ID,u_A,u_B,u_C,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,str(processors),str(freq_high),\
+            str(freq_low),str(inten_high),str(inten_low),str(temperature),str(Jmax),str(freq_uncertainty),str(num_of_triples),fitting_peaks_str,str(trans_1),str(trans_2),str(trans_3),engine,str(confirm_omc),str(keep_fraction),str(audit_every),str(top_k),str(min_score),str(pair_prune),str(dedup_tol),str(hit_sigma),str(stop_hits),str(adaptive_workers),str(pin_cpus),str(in_flight),str(ram_dir))
             Job_fh = open("input_data_%s_%s.txt"%(job_name,isotope_ID),"w")
             Job_fh.write(job_file) 
             Job_fh.close()
 
-            new_list = []
+            triples_checkpoint_module.write_checkpoint_info({'program':"prog_A",'job_name':job_name,'output_suffix':"_%s"%(isotope_ID),'A':A,'B':B,'C':C,'model_A':curr_A,'model_B':curr_B,'model_C':curr_C,\
+                'DJ':DJ,'DJK':DJK,'DK':DK,'dJ':dJ,'dK':dK,'temperature':temperature,'processors':int(processors),'engine':engine,'confirm_omc':confirm_omc,'keep_fraction':keep_fraction,'audit_every':audit_every,'top_k':top_k,'min_score':min_score,'pair_prune':pair_prune,'dedup_tol':dedup_tol,'hit_sigma':hit_sigma,'stop_hits':stop_hits,'adaptive_workers':adaptive_workers,'pin_cpus':pin_cpus,'in_flight':in_flight,'ram_dir':ram_dir,'evaluated_records':evaluated_records,'chunk_size':50,'num_of_triples':num_of_triples,\
+                'trans_1':trans_1,'trans_2':trans_2,'trans_3':trans_3,'check_peaks':top_peaks_3cut,'trans_1_peaks':triples_checkpoint_module.string_peaks(trans_1_peaks),\
+                'trans_2_peaks':triples_checkpoint_module.string_peaks(trans_2_peaks),'trans_3_peaks':triples_checkpoint_module.string_peaks(trans_3_peaks)},peaklist)
 
-            new_list = [(len(trans_1_peaks),"trans_1_peaks"),(len(trans_2_peaks),"trans_2_peaks"),(len(trans_3_peaks),"trans_3_peaks")]
-            new_list.sort()
-    
-            list_key = []
+            batch_model = None
+            if engine == "batch": # Built around the predicted isotopologue constants, which are where its fits should land.
+                batch_model = batch_fit_module.linear_model(trans_1,trans_2,trans_3,top_peaks_3cut,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,temperature)
 
-            list_a_peaks = [vars()[new_list[0][1]],new_list[0][1]]
-            list_b_peaks = [vars()[new_list[1][1]],new_list[1][1]]
-            list_c_peaks = vars()[new_list[2][1]]
+            (pair_mask,pair_window) = batch_fit_module.pair_filter(pair_prune,trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,curr_A,curr_B,curr_C,DJ,DJK,DK,dJ,dK,temperature)[0:2] # The same pairs triples_gen counted
 
-            random.shuffle(list_c_peaks)  # Shuffle so that each processor gets a range of values for the third peak, not processor 0 getting only the lowest frequencies.  
+            sorted_triples = triples_enum_module.best_first_triples(trans_1_peaks,trans_2_peaks,trans_3_peaks,trans_1,trans_2,trans_3,pair_mask=pair_mask,pair_window=pair_window) # Every triple in global scaled_diff order, handed out in chunks to whichever process is free
+            if evaluated_records: # Incremental rerun: only the triples the earlier searches here didn't fit (e.g. the new outer shell of wider windows)
+                sorted_triples = triples_store_module.skip_evaluated(sorted_triples,triples_store_module.load_evaluated(evaluated_records))
+            screen_stats = {}
+            if engine == "batch":
+                sorted_triples = batch_fit_module.batch_screen(sorted_triples,batch_model,peaklist,confirm_omc=confirm_omc,keep_fraction=keep_fraction,stats=screen_stats,audit_every=audit_every)
 
-            list_c_list = []
-            for num in range(processors):
-                processors = float(processors)
-                num = float(num)
-                x = int((num)*(len(list_c_peaks)/processors))
-                y = int(len(list_c_peaks)*((num+1)/processors))
-                list_c_list.append(list_c_peaks[x:y])
-            list_c_list.append("marker")
-            vars()[new_list[0][1]] = list_a_peaks[0]
-            vars()[new_list[1][1]] = list_b_peaks[0]
-            vars()[new_list[2][1]] = list_c_list
-    
-    
             processors = int(processors)
+            task_queue = multiprocessing.Queue(processors*4)
+            result_queue = multiprocessing.Queue()
+            progress = triples_progress_module.new_counters(processors) # Shared per-process counters, published by reporter
+            (active,controller) = triples_workers_module.adaptive(processors,progress,adaptive_workers) # Limit on the processes taking chunks, moved by controller
+            timing_key = triples_timing_module.timing_key(engine,processors)
+            reporter = triples_progress_module.ProgressReporter(progress,num_of_triples,seconds_per_triple=triples_timing_module.stored_seconds(timing_key),timing_key=timing_key,controller=controller)
+            triples_store_module.save_peaks(peaklist) # What the peak indices in results%s.bin point into
+            result_heaps = triples_results_module.new_heaps()
+            if evaluated_records: # The fits of the earlier searches are only in the final_output files
+                result_heaps = triples_results_module.read_results()
+
+            workers = []
             for num in range(processors):
-                if trans_1_peaks[-1]=="marker":
-                    trans_x_peaks = trans_1_peaks[num]
-                    trans_y_peaks = trans_2_peaks
-                    trans_z_peaks = trans_3_peaks
-        
-                if trans_2_peaks[-1]=="marker":
-                    trans_x_peaks = trans_1_peaks
-                    trans_y_peaks = trans_2_peaks[num]
-                    trans_z_peaks = trans_3_peaks
-
-                if trans_3_peaks[-1]=="marker":
-                    trans_x_peaks = trans_1_peaks
-                    trans_y_peaks = trans_2_peaks
-                    trans_z_peaks = trans_3_peaks[num]
-        
-                vars()["p%s"%str(num)] = Process(target=fit_triples, args=(trans_x_peaks,trans_y_peaks,trans_z_peaks,trans_1,trans_2,trans_3,top_peaks_3cut,peaklist,num,A,B,C,DJ,DJK,DK,dJ,dK))
+                vars()["p%s"%str(num)] = Process(target=fit_triples, args=([],[],[],trans_1,trans_2,trans_3,top_peaks_3cut,None,num,A,B,C,DJ,DJK,DK,dJ,dK,engine,batch_model,task_queue,confirm_omc,top_k,min_score,result_queue,dedup_tol,hit_sigma,progress,active,pin_cpus,in_flight,ram_dir))
+                workers.append(vars()["p%s"%str(num)])
 
             for num in range(processors):
                 vars()["p%s"%str(num)].start()
+
+            status = triples_queue_module.feed_queue(task_queue,sorted_triples,processors,workers,stop_hits=stop_hits,reporter=reporter,controller=controller,stats=screen_stats)
+            result_heaps = triples_results_module.collect_heaps(result_queue,workers,result_heaps,reporter=reporter)
+
             for num in range(processors):
                 vars()["p%s"%str(num)].join()
-        
-            a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 4 -n > sorted_omc_cat_%s.txt'%(isotope_ID), shell=True)
-            a.wait()
+            reporter.finish(status)
 
-            a = subprocess.Popen('cat sorted_final_out*.txt |sort -t "=" -k 6 -n > sorted_inten_omc_cat_%s.txt'%(isotope_ID), shell=True)
-            a.wait()
+            if status == "Paused":
+                batch_fit_module.save_screen_stats(screen_stats) # Added to the resumed run's counts in its cascade report
+                msgbox(msg='The search for %s has been paused.  Run prog_A again and choose "Resume a job" on the %s folder to finish it; isotopologues after it were not started.'%(isotope_ID,isotope_ID))
+                quit()
+
+            if engine == "batch":
+                print(batch_fit_module.cascade_report(screen_stats,confirm_omc,keep_fraction))
+        
+            triples_results_module.write_results(result_heaps,"_%s"%(isotope_ID))
+            if dedup_tol > 0:
+                triples_results_module.write_multiplicity(dedup_tol,"_%s"%(isotope_ID))
 
             isotopomer_count += 1
             os.chdir(os.pardir)
@@ -2337,7 +2377,7 @@ inten_high: %s \n inten_low: %s \n Temp: %s \n Jmax: %s \n freq_uncertainty: %s
             f100.write(OMC_char_buffer)
             f100.close()
 
-            codebox(msg='Fitting routine has finished.  These are the best 100 results for %s, saved in best100_%s.txt.'%(isotope_ID,isotope_ID),text=fits)
+            codebox(msg='Fitting routine has finished.  These are the best 100 results for %s, saved in best100_%s.txt.  '%(isotope_ID,isotope_ID)+program_call_module.skipped_message(),text=fits)
 
             refine_fit_decision = buttonbox(msg='Would you like to further refine any of the recent results by allowing distortions to vary?', choices=('Yes!',"No, I'm done with this isotopologue!"))
             if refine_fit_decision == "No, I'm done with this isotopologue!":
@@ -0,0 +1,409 @@
+import os
+import glob
+import time
+import threading
+import subprocess
+import itertools
+import multiprocessing
+try:
+    import calpgm_lib # SPFIT in this process (engine "lib"); calpgm_lib.py and libcalpgm.so ("make lib" in calpgm/src) go next to the scripts
+except ImportError:
+    calpgm_lib = None
+
+""""
+SPFIT/SPCAT calls with a timeout
+
+Please comment any changes you make to the code here:
+
+program call module:
+-Every SPFIT and SPCAT call used to be Popen(...) followed by a.stdout.read(), which waits as long as the program runs.
+One triple that makes SPFIT hang stalled its fit_triples process for the rest of the search, and a crashed run left the
+previous triple's .var and .fit behind to be read as if they were this triple's.  run_program sends the program's
+screen output to os.devnull (SPCAT prints everything to the screen otherwise, which is why stdout was read) and waits for
+it, and a watchdog thread kills it after timeout seconds.  The outputs are removed before the call and have to be there
+after it, so what's read is always from this run.  A failed call is tried retries more times.
+
+-The watchdog is one daemon thread per process (started on the first call, and again in a child process, where the
+parent's thread doesn't exist), so a call costs two attribute writes rather than a thread of its own.
+
+-fit_triples skips a triple whose SPFIT run still fails (or whose output can't be read) instead of stopping, and writes
+it to skipped%s.txt with the reason.  Skipped triples aren't added to the evaluated%s.bin index, so rerunning the job in
+its folder tries them again; the drivers report how many were skipped (skipped_count).
+
+-SPCAT runs in the drivers (run_SPCAT, run_SPCAT_refit, batch_fit_module.run_SPCAT_batch) raise ProgramError instead,
+since nothing after them makes sense without the prediction.
+
+-fit_triples' SPFIT runs go through spfit_runs.  With in_flight above 1 (pipelined) each process keeps that many SPFIT
+runs going at once, each on its own default<file_num>_<slot> files, so writing the next triples' input and reading and
+scoring the last one's output happen while SPFIT runs instead of in between runs.  The results still come back in
+triple order, and a queue chunk is finished before the next is taken, so the chunk checkpoints mean the same.  The
+watchdog keeps one deadline per program for this.  write_triple_inputs is the .par/.lin writing the three fit_triples
+used to do inline; the .par is now built once per process.
+
+-Engine "lib" runs SPFIT inside the fit_triples process instead (library_runs), from libcalpgm.so through calpgm_lib.py
+(calpgm/calpgm_backend; both go next to the scripts, like SPFIT.EXE), on the .par and .lin text in memory.  No file is
+written and no process started for a triple.  Where the library isn't there (Windows), fit_triples uses SPFIT.EXE.
+
+-The library runs in a helper child of each fit_triples process (LibraryHelper), which is started once and gets the
+.lin of each triple through a pipe.  The watchdog kills it like an SPFIT.EXE run once SPFIT_TIMEOUT has passed, and a
+fit that crashes takes down only the helper, not the fit_triples process; either way the helper is started again for the
+next try.  After LIBRARY_FAILURES triples in a row have failed like that, library_runs hands that triple and the rest
+to SPFIT.EXE (its fallback).
+
+"""
+
+SPFIT_TIMEOUT = 60.0 # Seconds; a fit of three lines normally takes milliseconds
+SPCAT_TIMEOUT = 600.0 # Seconds; a prediction up to a high Jmax can take a while
+RETRIES = 1 # Extra tries after a call that timed out or didn't write its outputs
+WATCHDOG_TICK = 0.25 # Seconds between the watchdog's checks
+SKIPPED_FILE = "skipped%s.txt"
+LIBRARY_FAILURES = 3 # Triples in a row the library can hang or crash on before library_runs goes over to SPFIT.EXE
+
+class ProgramError(Exception):
+    pass
+
+class Watchdog:
+
+    """ Kills the programs it's watching once their deadlines have passed.  One per process, see watchdog()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deadlines = {} # Process: time it gets killed at
+        self.killed = set()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self,process,timeout):
+        self.lock.acquire()
+        self.deadlines[process] = time.time()+timeout
+        self.killed.discard(process)
+        self.lock.release()
+
+    def clear(self,process): # Stops watching process; returns whether it was killed
+        self.lock.acquire()
+        self.deadlines.pop(process,None)
+        killed = process in self.killed
+        self.killed.discard(process)
+        self.lock.release()
+        return killed
+
+    def run(self):
+        while True:
+            time.sleep(WATCHDOG_TICK)
+            self.lock.acquire()
+            now = time.time()
+            for process in [key for key in self.deadlines if now > self.deadlines[key]]:
+                try:
+                    process.kill()
+                except OSError: # Exited just now
+                    pass
+                self.killed.add(process)
+                del self.deadlines[process]
+            self.lock.release()
+
+_watchdog = None
+_watchdog_pid = None
+
+def watchdog(): # This process's Watchdog
+    global _watchdog,_watchdog_pid
+    if _watchdog == None or _watchdog_pid != os.getpid():
+        _watchdog = Watchdog()
+        _watchdog_pid = os.getpid()
+    return _watchdog
+
+def remove_outputs(outputs):
+    for filename in outputs:
+        if os.path.exists(filename):
+            try:
+                os.remove(filename)
+            except OSError: # Still held by a program that was just killed (Windows); it will be missing or fail below
+                pass
+
+def command_text(command): # command as it would be typed, for the failure messages
+    if isinstance(command,list):
+        return " ".join(command)
+    return command
+
+def run_program(command,outputs=(),timeout=None,retries=None,cwd=None):
+
+    """ Runs command (e.g. "SPFIT0 default0", or a list of the program and its arguments) in cwd (the current folder by
+    default) and waits for it to finish, for at most timeout seconds.  outputs are the files it has to write; they're
+    removed first so a failed run can't leave old ones behind.  Tries retries more times after a failure (SPFIT_TIMEOUT
+    and RETRIES if not given).  Returns None if it worked, otherwise why it didn't."""
+
+    if timeout == None:
+        timeout = SPFIT_TIMEOUT
+    if retries == None:
+        retries = RETRIES
+    failure = None
+    for attempt in range(retries+1):
+        remove_outputs(outputs)
+        devnull = open(os.devnull,"w")
+        a = subprocess.Popen(command, stdout=devnull, shell=False, cwd=cwd)
+        dog = watchdog()
+        dog.watch(a,timeout)
+        a.wait() # Returns when the program exits or is killed
+        killed = dog.clear(a)
+        devnull.close()
+        if killed:
+            failure = "%s timed out after %s s"%(command_text(command),timeout)
+            continue
+        missing = [filename for filename in outputs if not os.path.exists(filename)]
+        if missing != []:
+            failure = "%s exited with code %s without writing %s"%(command_text(command),a.returncode," ".join(missing))
+            continue
+        return None
+    return failure
+
+def spfit_command(program,file_num,name): # SPFIT<file_num> like before if program isn't given, otherwise program by its path
+    if program == None:
+        return "SPFIT%s %s"%(str(file_num),name)
+    return [program,name]
+
+def spfit_runs(triples,write_inputs,file_num,in_flight=1,timeout=None,program=None,folder=None):
+
+    """ Runs SPFIT once for each triple and yields (triple, base, failure) in the order of triples, failure as from
+    run_program and base the path (without extension) to read the .var and .fit from.  write_inputs(triple,base) writes
+    base.par and base.lin.  program is the SPFIT to run (triples_sandbox_module.spfit_program), SPFIT<file_num> if not
+    given, and folder the one it runs in (a sandbox, triples_sandbox_module.open_sandbox), the current one if not given.
+    With in_flight 1 each run is on default<file_num> and starts when the caller asks for the next result.  With more,
+    triples is a sequence of chunks (lists of triples) and up to in_flight runs go on at once, each on its own files
+    default<file_num>_<slot>, while the caller reads the results; every run of a chunk is finished and yielded before the
+    next chunk is taken."""
+
+    if timeout == None:
+        timeout = SPFIT_TIMEOUT
+    if in_flight <= 1:
+        name = "default%s"%(str(file_num))
+        base = os.path.join(folder or "",name)
+        for triple in triples:
+            write_inputs(triple,base)
+            yield triple,base,run_program(spfit_command(program,file_num,name),[base+".var",base+".fit"],timeout,cwd=folder)
+        return
+    for chunk in triples:
+        for result in pipelined(chunk,write_inputs,file_num,in_flight,timeout,program,folder):
+            yield result
+
+def pipelined(triples,write_inputs,file_num,in_flight,timeout,program=None,folder=None):
+
+    """ spfit_runs for one chunk with in_flight > 1.  There are in_flight+1 file sets, so in_flight runs go on while the
+    caller reads the one that was yielded last; its files are only reused once the caller asks for the next result."""
+
+    dog = watchdog()
+    free_slots = list(range(in_flight+1))
+    running = [] # [triple, slot, process, devnull] in the order they were started
+    triples = iter(triples)
+    more = True
+    while True:
+        while more and len(running) < in_flight:
+            try:
+                triple = next(triples)
+            except StopIteration:
+                more = False
+                break
+            slot = free_slots.pop(0)
+            base = os.path.join(folder or "","default%s_%s"%(str(file_num),str(slot)))
+            remove_outputs([base+".var",base+".fit"])
+            write_inputs(triple,base)
+            devnull = open(os.devnull,"w")
+            process = subprocess.Popen(spfit_command(program,file_num,"default%s_%s"%(str(file_num),str(slot))), stdout=devnull, shell=False, cwd=folder)
+            dog.watch(process,timeout)
+            running.append([triple,slot,process,devnull])
+        if running == []:
+            return
+        (triple,slot,process,devnull) = running.pop(0)
+        process.wait()
+        killed = dog.clear(process)
+        devnull.close()
+        command = spfit_command(program,file_num,"default%s_%s"%(str(file_num),str(slot)))
+        base = os.path.join(folder or "","default%s_%s"%(str(file_num),str(slot)))
+        outputs = [base+".var",base+".fit"]
+        missing = [filename for filename in outputs if not os.path.exists(filename)]
+        failure = None
+        if killed:
+            failure = "%s timed out after %s s"%(command_text(command),timeout)
+        elif missing != []:
+            failure = "%s exited with code %s without writing %s"%(command_text(command),process.returncode," ".join(missing))
+        if failure != None and RETRIES > 0: # The retries on their own, as in run_program
+            failure = run_program(command,outputs,timeout,RETRIES-1,folder)
+        yield triple,base,failure
+        free_slots.append(slot)
+
+def write_triple_inputs(base,par_file,triple,trans_1,trans_2,trans_3,top_17): # par_file as base.par and triple_lin as base.lin
+    fh_par = open(base+".par",'w')
+    fh_par.write(par_file)
+    fh_par.close()
+    fh_lin = open(base+".lin", "w")
+    fh_lin.write(triple_lin(triple,trans_1,trans_2,trans_3,top_17))
+    fh_lin.close()
+
+def triple_lin(triple,trans_1,trans_2,trans_3,top_17):
+
+    """ fit_triples' SPFIT .lin for triple (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,...): its three lines assigned
+    to trans_1-3, and the top_17 check transitions (which don't take part in the fit)."""
+
+    peaks_triple= [(str(triple[0]),str(triple[1])),(str(triple[2]),str(triple[3])),(str(triple[4]),str(triple[5]))]
+    input_file = ""#the next part adds in the three peaks to be fit
+    input_file += trans_1[2][0:2]+' '+trans_1[2][2:4]+' '+trans_1[2][4:6]+' '+\
+                  trans_1[3][0:2]+' '+trans_1[3][2:4]+' '+trans_1[3][4:6]+'                      '+peaks_triple[0][0]+' 0.50 1.0000\n'
+    input_file += trans_2[2][0:2]+' '+trans_2[2][2:4]+' '+trans_2[2][4:6]+' '+\
+                  trans_2[3][0:2]+' '+trans_2[3][2:4]+' '+trans_2[3][4:6]+'                      '+peaks_triple[1][0]+' 0.50 1.0000\n'
+    input_file += trans_3[2][0:2]+' '+trans_3[2][2:4]+' '+trans_3[2][4:6]+' '+\
+                  trans_3[3][0:2]+' '+trans_3[3][2:4]+' '+trans_3[3][4:6]+'                      '+peaks_triple[2][0]+' 0.50 1.0000\n'
+    counter = 0
+    for line in top_17:#the hack that adds in the check transitions but doesn't use them in the fit
+        input_file += line[2][0:2]+' '+line[2][2:4]+' '+line[2][4:6]+' '+\
+                  line[3][0:2]+' '+line[3][2:4]+' '+line[3][4:6]+'                      '+'%s.0'%(str(counter))+' 0.00 1.0000\n'
+        counter += 1
+    return input_file
+
+def library_available(): # Whether engine "lib" can run SPFIT in this process here
+    return calpgm_lib != None and calpgm_lib.available()
+
+def library_helper(conn,par_file): # The helper child's loop: fits each .lin it's sent with par_file and sends back (worked, (var,fit) or error)
+    while True:
+        try:
+            lin = conn.recv()
+        except EOFError:
+            return
+        if lin == None:
+            return
+        try:
+            conn.send((True,calpgm_lib.fit(par_file,lin)))
+        except calpgm_lib.CalpgmLibError as error:
+            conn.send((False,error.args[0]))
+
+class LibraryHelper:
+
+    """ Child process running SPFIT from the library for the fit_triples process that made it, started on the first fit
+    and again after one that hung or crashed.  The watchdog kills it (kill) like a program."""
+
+    def __init__(self,par_file):
+        self.par_file = par_file
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        (self.conn,child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=library_helper,args=(child_conn,self.par_file))
+        self.process.daemon = True # Goes with the fit_triples process
+        self.process.start()
+        child_conn.close() # So a helper that dies is seen as the end of the pipe
+
+    def kill(self):
+        self.process.terminate()
+
+    def reset(self): # After the helper was killed or died
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def stop(self):
+        if self.process == None:
+            return
+        try:
+            self.conn.send(None)
+        except (IOError,OSError):
+            pass
+        self.reset()
+
+    def fit(self,lin,timeout):
+
+        """ Fits lin.  Returns (output,failure,broken): output {"var": text, "fit": text} or None, failure None or why
+        the fit didn't work, and broken whether that was the helper hanging or crashing rather than SPFIT turning the fit
+        down."""
+
+        if self.process == None:
+            self.start()
+        dog = watchdog()
+        dog.watch(self,timeout)
+        try:
+            self.conn.send(lin)
+            reply = self.conn.recv()
+        except (EOFError,IOError,OSError):
+            reply = None
+        killed = dog.clear(self)
+        if killed or reply == None:
+            self.reset()
+        if reply == None:
+            if killed:
+                return None,"SPFIT (%s) timed out after %s s"%(calpgm_lib.LIBRARY_NAME,timeout),True
+            return None,"SPFIT (%s) crashed"%(calpgm_lib.LIBRARY_NAME),True
+        (worked,result) = reply
+        if not worked:
+            return None,"SPFIT (%s) %s"%(calpgm_lib.LIBRARY_NAME,result),False
+        return {"var":result[0],"fit":result[1]},None,False
+
+def library_runs(triples,par_file,lin_text,fallback=None,timeout=None,retries=None):
+
+    """ spfit_runs with SPFIT run from libcalpgm.so (engine "lib") in a LibraryHelper child: yields (triple, output,
+    failure) in the order of triples, output being {"var": text, "fit": text} for read_output.  par_file is the .par
+    text and lin_text(triple) gives the .lin text.  A fit that hangs for timeout seconds (SPFIT_TIMEOUT) or crashes is
+    tried retries (RETRIES) more times.  Once LIBRARY_FAILURES triples in a row have failed that way, that triple and the
+    rest go to fallback(triples) (e.g. spfit_runs with SPFIT.EXE), if it's given."""
+
+    if timeout == None:
+        timeout = SPFIT_TIMEOUT
+    if retries == None:
+        retries = RETRIES
+    helper = LibraryHelper(par_file)
+    failures = 0
+    triples = iter(triples)
+    try:
+        for triple in triples:
+            for attempt in range(retries+1):
+                (output,failure,broken) = helper.fit(lin_text(triple),timeout)
+                if not broken:
+                    break
+            if not broken:
+                failures = 0
+            else:
+                failures += 1
+                if failures >= LIBRARY_FAILURES and fallback != None:
+                    print("SPFIT (%s) hung or crashed on %s triples in a row; the SPFIT program fits the rest."%(calpgm_lib.LIBRARY_NAME,failures))
+                    helper.stop()
+                    for result in fallback(itertools.chain([triple],triples)):
+                        yield result
+                    return
+            yield triple,output,failure
+    finally:
+        helper.stop()
+
+def read_output(output,extension): # Lines of the .var or .fit (extension) of a spfit_runs or library_runs result
+    if isinstance(output,dict):
+        return output[extension].splitlines(True)
+    fh = open(output+"."+extension)
+    lines = fh.readlines()
+    fh.close()
+    return lines
+
+def check_program(command,outputs=(),timeout=None,retries=None): # run_program for calls nothing can go on without, SPCAT_TIMEOUT by default
+    if timeout == None:
+        timeout = SPCAT_TIMEOUT
+    failure = run_program(command,outputs,timeout,retries)
+    if failure != None:
+        raise ProgramError(failure)
+
+def write_skipped(file_num,triple,reason): # Appends a triple fit_triples had to skip, with the reason, to skipped%s.txt
+    fh = open(SKIPPED_FILE%(str(file_num)),"a")
+    fh.write("%s %s %s :: %s\n"%(triple[0],triple[1],triple[2],reason))
+    fh.close()
+
+def skipped_count(job_dir="."): # Triples skipped by the search in job_dir
+    count = 0
+    for filename in glob.glob(os.path.join(job_dir,SKIPPED_FILE%("*"))):
+        fh = open(filename)
+        count += len([line for line in fh if line.strip() != ""])
+        fh.close()
+    return count
+
+def clear_skipped(job_dir="."): # A new search (or rerun) in job_dir tries the skipped triples again
+    for filename in glob.glob(os.path.join(job_dir,SKIPPED_FILE%("*"))):
+        os.remove(filename)
+
+def skipped_message(job_dir="."): # Sentence for the drivers' final report, "" if nothing was skipped
+    count = skipped_count(job_dir)
+    if count == 0:
+        return ""
+    return "%s triples were skipped because SPFIT failed on them (listed in skipped*.txt; rerunning the job in this folder tries them again)."%(count)
@@ -11,6 +11,8 @@ import math
 from collections import OrderedDict
 import shutil
 from scipy.interpolate import *
+import triples_scoring_module
+import prediction_cache_module
 
 """"
 Python Triples Fitter
@@ -29,6 +31,11 @@ constants to vary (list passed by GUI), and run SPFIT.  Creates files refit.fit,
 If the user accepts the fit, these should be copied and moved into a "refits" directory, but in the interest of having all user
 interaction go through the GUI, that functionality has been commented out here.
 
+-match_to_peaklist uses the sorted-array nearest peak lookup in triples_scoring_module instead of walking the peak list.
+
+-run_SPCAT_refit and cat_reader go through prediction_cache_module, so a refit.var/.int that was already predicted isn't
+run through SPCAT again.
+
 
 """
 def int_writer(u_A,u_B,u_C, J_min="00", J_max="20", inten="-10.0",Q_rot="300000",freq="25.8", temperature="298", flag="default"):#generates SPCAT input file
@@ -162,29 +169,15 @@ def lin_writer_refit(assignment_list): #writes a lin file for use with SPFIT
     fh_lin.close()        
 
 def run_SPCAT_refit(): 
-    a = subprocess.Popen("SPCAT refit", stdout=subprocess.PIPE, shell=False)
-    a.stdout.read()#seems to be best way to get SPCAT to finish. I tried .wait(), but it outputted everything to screen
+    prediction_cache_module.run_spcat("refit",lambda: subprocess.Popen("SPCAT refit", stdout=subprocess.PIPE, shell=False).stdout.read()) # Only run for a .var/.int it hasn't predicted; reading stdout is what waits for SPCAT
 
 def cat_reader(freq_high,freq_low,flag): #reads output from SPCAT
 
-    if flag == "default":
-        fh = open("default.cat")
-
-    if flag == "refit":
-        fh = open("refit.cat")
-
     linelist = []
-    for line in fh:
-        if line[8:9]==".": 
-            freq = line[3:13]
-            inten = line[22:29]
-            qnum_up = line[55:61]
-            qnum_low = line[67:73]
-            uncert = line[13:21]
-            if float(freq)> freq_low and float(freq)<freq_high:#<<<<<<<<<<<<<<<<<<<<
-                linelist.append((inten,freq, qnum_up, qnum_low,uncert))
+    for (value,freq,inten,qnum_up,qnum_low,uncert) in prediction_cache_module.catalog(flag): # flag is the file name, parsed once per catalog
+        if value > freq_low and value < freq_high:#<<<<<<<<<<<<<<<<<<<<
+            linelist.append((inten,freq, qnum_up, qnum_low,uncert))
     linelist.sort()
-    fh.close()
     return linelist
     
 def trans_freq_refit_reader(peaklist):
@@ -201,53 +194,17 @@ def trans_freq_refit_reader(peaklist):
 
 def match_to_peaklist(pred_trans,peaklist,threshold):
 
-    peak_list_1 = peaklist[0:int(len(peaklist)/4)]#splits peaks into 4 parts to speed up processing
-    peak_list_2 = peaklist[int(len(peaklist)/4):int(len(peaklist)/2)]
-    peak_list_3 = peaklist[int(len(peaklist)/2):int(len(peaklist)*0.75)]
-    peak_list_4 = peaklist[int(len(peaklist)*0.75):len(peaklist)]
-
-    p_1 = float(peak_list_1[0][0])
-    p_2 = float(peak_list_1[-1][0])
-    p_3 = float(peak_list_2[0][0])
-    p_4 = float(peak_list_2[-1][0])
-    p_5 = float(peak_list_3[0][0])
-    p_6 = float(peak_list_3[-1][0])
-    p_7 = float(peak_list_4[0][0])
-    p_8 = float(peak_list_4[-1][0])
-
+    (peak_freqs,peak_intens) = triples_scoring_module.sorted_peaks(peaklist)
     best_match_freqs=[]
 
-    for x in range(len(pred_trans)): #matches predicted peaks to peaks in experimental peak list <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+    (omc,nearest) = triples_scoring_module.nearest_peaks([float(trans[0]) for trans in pred_trans],peak_freqs) #matches predicted peaks to peaks in experimental peak list
+
+    for x in range(len(pred_trans)):
         weight = '0.50'
-        current_peak = float(pred_trans[x][0])
-        
-        if current_peak>p_1 and current_peak<p_2:#conditionals to find proper portion of experimental peak list to loop through
-            peaks_section = peak_list_1
-            peak = p_2
-        elif current_peak>p_3 and current_peak<p_4:
-            peaks_section = peak_list_2
-            peak = p_4
-        elif current_peak>p_5 and current_peak<p_6:
-            peaks_section = peak_list_3
-            peak = p_6
-        elif current_peak>p_7 and current_peak<p_8:
-            peaks_section = peak_list_4
-            peak = p_8
-        else:
-            peaks_section = peaklist
-            peak = p_8
-        
-        old_omc = 100000.0
-        for peak_freq,peak_inten in peaks_section: #find nearest peak in actual spectrum to the given predicted peak
-            omc = abs(current_peak-float(peak_freq))
-            if omc <= old_omc:
-                temp_freq = peak_freq
-                old_omc = omc
-
-        if old_omc > threshold: # If the best match is too far off, we don't want to have a bad line in the fit file.  Threshold (in MHz) is a user-determined parameter.
+        if omc[x] > threshold: # If the best match is too far off, we don't want to have a bad line in the fit file.  Threshold (in MHz) is a user-determined parameter.
             weight = '0.00'
 
-        best_match_freqs.append((temp_freq,pred_trans[x][1],pred_trans[x][2],weight))
+        best_match_freqs.append((peak_freqs[nearest[x]],pred_trans[x][1],pred_trans[x][2],weight))
 
     return best_match_freqs
 
@@ -316,7 +273,7 @@ def refine_fits(job_name,isotope_ID,u_A,u_B,u_C,Jmax,freq_high,temperature,fit_t
 
         fit_peaklist = fit_peaklist + unique_extra_peaks
 
-    else
+    else:
         pass
 
     updated_trans = trans_freq_refit_reader(fit_peaklist) # Finds updated predicted frequencies with improved A, B, and C estimates.
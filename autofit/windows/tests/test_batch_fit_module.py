@@ -0,0 +1,84 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_fit_module
+import triples_store_module
+
+MODEL = {'constants':numpy.array([3000.0,1500.0,1200.0]),
+         'fit_freqs':numpy.array([17591.4518,15221.1777,14034.1893]),
+         'fit_jacobian':numpy.array([[0.27937,0.96237,12.7584],[0.28649,1.01897,10.694755],[0.15179,5.86969,3.97829]]),
+         'fit_hessian':numpy.array([[[-0.000044,0.000263,-0.000219],[0.000263,-0.00158,0.001325],[-0.000219,0.001325,-0.001098]],
+                                    [[-0.000094,0.000565,-0.000471],[0.000565,-0.003392,0.002836],[-0.000471,0.002836,-0.002355]],
+                                    [[-0.000206,0.001235,-0.001028],[0.001235,-0.007406,0.006171],[-0.001028,0.006171,-0.005144]]])}
+
+def true_lines(width,count=300,seed=0,spread=(3,1,1)): # Peak lists from constants spread over +-spread*width around the guess, exact to second order
+    rng = numpy.random.RandomState(seed)
+    true = MODEL['constants']+rng.uniform(-1,1,(count,3))*numpy.array(spread)*width
+    true = true[(true[:,0] >= true[:,1]) & (true[:,1] >= true[:,2]) & (true[:,2] > 0)]
+    freqs = batch_fit_module.model_freqs(true-MODEL['constants'],MODEL['fit_freqs'],MODEL['fit_jacobian'],MODEL['fit_hessian'])
+    return [[(str(freq),'1') for freq in freqs[:,k]] for k in range(3)]
+
+class AdmissiblePairsTest(unittest.TestCase):
+
+    def test_moderate_window(self): # Every true pair is kept, and the pruning still removes a good part of the rest
+        (list_a,list_b,list_c) = true_lines(100.0)
+        admissible = batch_fit_module.admissible_pairs(list_a,list_b,list_c,MODEL)
+        self.assertTrue(admissible.diagonal().all())
+        self.assertLess(admissible.mean(),0.7)
+
+    def test_wide_window(self): # Shifts of a few hundred MHz can drop true pairs that are outside the bounds on the line itself, but few
+        (list_a,list_b,list_c) = true_lines(300.0)
+        admissible = batch_fit_module.admissible_pairs(list_a,list_b,list_c,MODEL)
+        self.assertLess(1.0-admissible.diagonal().mean(),0.08)
+
+class Trans3WindowsTest(unittest.TestCase):
+
+    def misses(self,width,spread=(3,1,1),free=(True,True,True)): # Fraction of true trans_3 lines outside their pair's window
+        (list_a,list_b,list_c) = true_lines(width,spread=spread)
+        (low,high) = batch_fit_module.trans_3_windows(list_a,list_b,list_c,MODEL,free)
+        freqs_c = numpy.array([float(freq) for freq,inten in list_c])
+        return ((freqs_c < low.diagonal()) | (freqs_c > high.diagonal())).mean()
+
+    def test_moderate_window(self):
+        self.assertEqual(self.misses(100.0),0.0)
+
+    def test_fixed_constant(self): # With A fixed a pair is a point, and the quadratic term there is far more than the slack
+        self.assertLess(self.misses(20.0,spread=(0,1,1),free=(False,True,True)),0.05) # 0.38 with the slack alone
+
+    def test_wide_window(self): # No more than the true pairs admissible_pairs already drops, give or take
+        self.assertLess(self.misses(300.0),0.1)
+
+class BatchScreenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder,True)
+
+    def test_mapped_peaks(self): # fit_triples' batch path with the peak list mapped from the job folder (peaklist None)
+        model = dict(MODEL)
+        model['check_freqs'] = numpy.array([19876.5,21234.25,23456.75])
+        model['check_jacobian'] = numpy.array([[1.5,-2.0,8.5],[-3.25,9.0,2.5],[0.75,4.5,-6.0]])
+        model['check_hessian'] = numpy.zeros((3,3,3))
+        rng = numpy.random.RandomState(0)
+        shift = rng.uniform(-1,1,(40,3))*[30.0,10.0,10.0]
+        fit_freqs = batch_fit_module.model_freqs(shift,model['fit_freqs'],model['fit_jacobian'],model['fit_hessian'])
+        triples = [(f1,1.0,f2,1.0,f3,1.0,0.0) for f1,f2,f3 in fit_freqs]
+        check = batch_fit_module.model_freqs(shift[0::2],model['check_freqs'],model['check_jacobian'],model['check_hessian']) # Only every other triple's check lines are peaks
+        peaklist = [(str(freq),'1.0') for freq in check.ravel()]+[(str(freq),'0.5') for freq in rng.uniform(19000.0,24000.0,30)]
+        triples_store_module.save_peaks(peaklist,self.folder)
+
+        expected = list(batch_fit_module.batch_screen(triples,model,peaklist))
+        screened = list(batch_fit_module.batch_screen(triples,model,None,peaks=triples_store_module.attach_peaks(self.folder)))
+        self.assertEqual(screened,expected)
+        self.assertTrue(0 < len(screened) < len(triples))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import triples_queue_module
+import triples_progress_module
+import triples_timing_module
+
+DELAY = 0.2 # Seconds the fake worker takes per triple
+PROCESSORS = 2
+
+def fake_worker(num,task_queue,progress): # Like fit_triples: a triple is only reported once it's done
+    done = 0
+    for triple in triples_queue_module.queue_triples(task_queue):
+        time.sleep(DELAY)
+        done += 1
+        triples_progress_module.report(progress,num,done,0.0)
+
+class CalibrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder,True)
+
+    def test_seconds_per_triple(self): # Two processes at DELAY a triple get through one every DELAY/2 seconds
+        triples = [(float(n),0.0,0.0,0.0,0.0,0.0,0.0) for n in range(triples_timing_module.CALIBRATION_TRIPLES*PROCESSORS)]
+        seconds = triples_timing_module.calibrate(fake_worker,lambda num,task_queue,progress: (num,task_queue,progress),iter(triples),PROCESSORS)
+        self.assertAlmostEqual(seconds,DELAY/PROCESSORS,delta=0.05*DELAY/PROCESSORS) # Counting a triple too many per process is 1/CALIBRATION_TRIPLES low
+        self.assertFalse(os.path.exists(triples_timing_module.CALIBRATION_FOLDER))
+
+    def test_no_triples(self):
+        self.assertEqual(triples_timing_module.calibrate(fake_worker,lambda num,task_queue,progress: (num,task_queue,progress),iter([]),PROCESSORS),None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import os
+import sys
+import glob
+import ast
+import numpy
+import triples_store_module
+
+""""
+Triples checkpoints
+
+Please comment any changes you make to the code here:
+
+triples checkpoint module:
+-A 10M triple job runs for hours and nothing used to record which triples were done, so a crash or reboot lost everything.
+Triples are now handed out in numbered chunks (triples_queue_module), always in the same order for the same windows
+(best_first_triples is deterministic, there's no shuffle and so no seed to keep), and the job directory gets:
+
+    checkpoint_info.txt        everything needed to rebuild the triples stream: program that started the job, constants,
+                               fitting and check transitions, peak windows, processors, engine, chunk size
+    checkpoint_peaklist.npy    the experimental peak list
+    completed_chunks%s.txt     one line per chunk finished by process %s: chunk id and the sizes of final_output%s.txt,
+                               results%s.bin, evaluated%s.bin and multiplicity%s.txt at that point
+    partial_best%s.txt         the best results of process %s so far (by avg w/ inten penalty), rewritten after every chunk
+
+-Pausing: creating the file pause_triples in the job directory (request_pause, or "python triples_checkpoint_module.py pause
+job_dir") stops the driver from handing out new chunks; the processes finish the chunks they already have and the run
+stops.  Resuming (the "Resume a job" choice in prog_A, autofit_NS_module.resume_autofit_NS, or "python
+triples_checkpoint_module.py resume job_dir") rewinds each process's output files to its last finished chunk, skips every
+completed chunk and carries on.  Jobs started from prog_A are resumed from prog_A, since its fits use its own .par
+settings.  "python triples_checkpoint_module.py status job_dir" prints how far a job has got.
+
+-A new search in a job directory that already has results (an incremental rerun, see triples_store_module.skip_evaluated)
+starts over with its own chunk ids: start_rerun replaces the old completed_chunks%s.txt with a "-1 size" line per
+final_output%s.txt, so resuming the rerun rewinds to the old results and no further.
+
+-rewind_outputs used to cut back only final_output%s.txt and results%s.bin, so a chunk that was half written when the job
+stopped was appended to evaluated%s.bin and multiplicity%s.txt a second time when it was redone.  Each chunk now records
+the sizes of all four files (OUTPUT_FILES) and all four are rewound.  Queued fit_triples processes only write their
+outputs when a chunk is done (no 100000-triple flush in the middle of one), so what's on disk is always whole chunks.
+
+"""
+
+PAUSE_FILE = "pause_triples"
+BEST_COUNT = 100
+
+def write_checkpoint_info(info,peaklist): # info is a dict of values that can go through repr/literal_eval; peak windows must already be strings
+    fh = open("checkpoint_info.txt","w")
+    for key in sorted(info.keys()):
+        fh.write("%s: %s\n"%(key,repr(info[key])))
+    fh.close()
+    numpy.save("checkpoint_peaklist.npy",numpy.asarray(peaklist,dtype=float))
+
+def read_checkpoint_info():
+    info = {}
+    fh = open("checkpoint_info.txt")
+    for line in fh:
+        if line.strip() != "":
+            key,value = line.split(": ",1)
+            info[key] = ast.literal_eval(value.strip())
+    fh.close()
+    peaklist = numpy.load("checkpoint_peaklist.npy")
+    return info,peaklist
+
+def string_peaks(peaks): # Peak windows with plain string entries, so they survive repr/literal_eval unchanged
+    return [(str(freq),str(inten)) for freq,inten in peaks]
+
+def completed_chunks(): # Ids of every chunk finished by any process
+    done = set()
+    for filename in glob.glob("completed_chunks*.txt"):
+        fh = open(filename)
+        for line in fh:
+            if line.split() != [] and int(line.split()[0]) >= 0: # -1 is start_rerun's base offset, not a chunk
+                done.add(int(line.split()[0]))
+        fh.close()
+    return done
+
+OUTPUT_FILES = ["final_output%s.txt",triples_store_module.STORE_FILE,triples_store_module.EVALUATED_FILE,"multiplicity%s.txt"] # What a process appends to with each chunk, in the order of completed_chunks%s.txt's sizes
+
+def output_sizes(file_num): # Sizes of process file_num's OUTPUT_FILES (0 if not written yet)
+    sizes = []
+    for pattern in OUTPUT_FILES:
+        filename = pattern%(str(file_num))
+        if os.path.exists(filename):
+            sizes.append(os.path.getsize(filename))
+        else:
+            sizes.append(0)
+    return sizes
+
+def output_file_nums(): # Process numbers (as in the file names) of every OUTPUT_FILES file in the job directory
+    file_nums = set()
+    for pattern in OUTPUT_FILES:
+        (head,tail) = pattern.split("%s")
+        for filename in glob.glob(pattern%("*")):
+            file_nums.add(filename[len(head):-len(tail)])
+    return sorted(file_nums)
+
+def start_rerun(): # The old chunk ids mean nothing for the new search; what's in the output files already is its starting point
+    for filename in glob.glob("completed_chunks*.txt"):
+        os.remove(filename)
+    for file_num in output_file_nums():
+        fh = open("completed_chunks%s.txt"%(file_num),"w")
+        fh.write("-1 %s\n"%(" ".join([str(size) for size in output_sizes(file_num)])))
+        fh.close()
+
+def rewind_outputs():
+
+    """ Cuts each process's OUTPUT_FILES back to their sizes after its last finished chunk, so the fits, results
+    records, evaluated triples and multiplicity counts of a chunk that was interrupted half way aren't in them twice once
+    the chunk is redone.  A process with no finished chunk is cut back to nothing."""
+
+    for file_num in output_file_nums():
+        sizes = [0]*len(OUTPUT_FILES)
+        if os.path.exists("completed_chunks%s.txt"%(file_num)):
+            fh = open("completed_chunks%s.txt"%(file_num))
+            for line in fh:
+                if line.split() != []:
+                    sizes = [int(size) for size in line.split()[1:]]
+            fh.close()
+        if len(sizes) == 1: # Checkpoint from before the other outputs were recorded: only final_output%s.txt and results%s.bin
+            if not os.path.exists("final_output%s.txt"%(file_num)):
+                continue
+            fh = open("final_output%s.txt"%(file_num),"r+")
+            fh.truncate(sizes[0])
+            fh.close()
+            fh = open("final_output%s.txt"%(file_num))
+            num_lines = sum(1 for line in fh if line.strip() != "")
+            fh.close()
+            triples_store_module.rewind_results(file_num,num_lines) # One record per result line
+            continue
+        for pattern,size in zip(OUTPUT_FILES,sizes):
+            filename = pattern%(file_num)
+            if os.path.exists(filename):
+                fh = open(filename,"r+b")
+                fh.truncate(size)
+                fh.close()
+
+def penalized_avg(line): # Sorting key of the result lines (avg w/ inten penalty, field 6 of sort -t "=")
+    return float(line.split("=")[-1])
+
+def read_partial_best(file_num):
+    best = []
+    if os.path.exists("partial_best%s.txt"%(str(file_num))):
+        fh = open("partial_best%s.txt"%(str(file_num)))
+        best = [line for line in fh if line.strip() != ""]
+        fh.close()
+    return best
+
+def chunk_done(file_num,chunk_id,best,read_offset):
+
+    """ Checkpoints a finished chunk for process file_num: updates the running best list with the lines written to
+    final_output%s.txt since read_offset, rewrites partial_best%s.txt and records the chunk id.  Returns the new best list
+    and offset."""
+
+    output_name = "final_output%s.txt"%(str(file_num))
+    if os.path.exists(output_name):
+        fh = open(output_name)
+        fh.seek(read_offset)
+        best = best + [line for line in fh if line.strip() != ""]
+        read_offset = fh.tell()
+        fh.close()
+        best = sorted(best,key=penalized_avg)[0:BEST_COUNT]
+
+    fh = open("partial_best%s.txt"%(str(file_num)),"w")
+    fh.write("".join(best))
+    fh.close()
+
+    fh = open("completed_chunks%s.txt"%(str(file_num)),"a")
+    fh.write("%s %s\n"%(chunk_id," ".join([str(size) for size in output_sizes(file_num)])))
+    fh.close()
+    return best,read_offset
+
+def request_pause(job_dir="."):
+    fh = open(os.path.join(job_dir,PAUSE_FILE),"w")
+    fh.close()
+
+def clear_pause(job_dir="."):
+    if os.path.exists(os.path.join(job_dir,PAUSE_FILE)):
+        os.remove(os.path.join(job_dir,PAUSE_FILE))
+
+def pause_requested(job_dir="."):
+    return os.path.exists(os.path.join(job_dir,PAUSE_FILE))
+
+def job_status(job_dir="."): # (chunks done, total chunks, whether the total is exact) of a checkpointed job
+    cwd = os.getcwd()
+    os.chdir(job_dir)
+    try:
+        info,peaklist = read_checkpoint_info()
+        done = len(completed_chunks())
+    finally:
+        os.chdir(cwd)
+    total = int((info['num_of_triples']+info['chunk_size']-1)/info['chunk_size'])
+    return done,total,info['engine'] != "batch" and not info.get('evaluated_records') # Only the screened (batch) or not yet evaluated (rerun) triples are chunked, so total is an upper limit
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ("pause","resume","status"):
+        print("usage: python triples_checkpoint_module.py pause|resume|status job_dir")
+        sys.exit(1)
+    command = sys.argv[1]
+    job_dir = sys.argv[2]
+    if command == "pause":
+        request_pause(job_dir)
+        print("Pause requested; the running processes will stop after their current chunks.")
+    elif command == "status":
+        (done,total,exact) = job_status(job_dir)
+        if exact:
+            print("%s of %s chunks done"%(done,total))
+        else:
+            print("%s of at most %s chunks done"%(done,total))
+        if pause_requested(job_dir):
+            print("paused")
+    elif command == "resume":
+        cwd = os.getcwd()
+        os.chdir(job_dir)
+        info,peaklist = read_checkpoint_info()
+        os.chdir(cwd)
+        if info['program'] == "autofit_NS":
+            import autofit_NS_module
+            clear_pause(job_dir)
+            print(autofit_NS_module.resume_autofit_NS(job_dir))
+        else:
+            print("This job was started from %s; resume it there with the \"Resume a job\" choice."%(info['program']))
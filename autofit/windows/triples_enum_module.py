@@ -0,0 +1,198 @@
+import heapq
+import tempfile
+import numpy
+
+""""
+Best-first triples enumeration
+
+Please comment any changes you make to the code here:
+
+triples enum module:
+-fit_triples used to build every combination of the three peak windows as a list of tuples, sort it by scaled_diff, write it
+to all_combo_list%s.txt and read it back before the first fit could start.  best_first_triples is a generator that yields
+the same (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff) entries in ascending scaled_diff order without ever
+holding the whole list.
+
+-How it works: each window is sorted by its distance from the predicted line, so the average distance avg_diff is monotonic
+in the three window indices and the index tuples can be walked with a heap in ascending avg_diff order (k-best
+enumeration; every index tuple has exactly one parent, so no visited set is needed and the heap never holds more than one
+entry per (index_1,index_2) pair).  scaled_diff = avg_diff*(abs(real_ratio-pred_ratio)+1) is never smaller than avg_diff,
+so an entry is held in a second heap until the avg_diff frontier has passed its scaled_diff, at which point nothing later
+can beat it.  That held heap is capped at max_pending entries; past the cap it's written out, sorted, to a temporary file
+(a run) and emptied, and the runs are merged back in as the frontier passes them, so the order stays exact however many
+entries are held and memory stays at max_pending plus a block of each run.  The largest window is always walked innermost, so the heap stays
+small when the drivers enumerate a whole search at once.
+
+-best_first_triples takes an optional pair_mask of admissible trans_1/trans_2 pairs (batch_fit_module.admissible_pairs).
+trans_3 is then always walked innermost and a pair that isn't allowed is only visited once, without any of its third
+peaks, so pruned pairs cost one heap step each instead of a whole window of fits.
+
+-Pair-line sweep: with pair_window (batch_fit_module.trans_3_windows) each trans_1/trans_2 pair only gets the list_c peaks
+inside its own trans_3 interval.  They're found with a binary search on the trans_3 peaks sorted by frequency, so a pair
+costs O(log N) plus its own triples, and the order is still exact: every pair is first put on the heap as a header keyed
+on the nearest trans_3 peak of the whole window, which no later entry can beat.
+
+"""
+
+def window_order(peaks,trans): # Indices of the peaks of a window, nearest to the predicted line first
+    return sorted(range(len(peaks)),key=lambda x: abs(float(trans[1])-float(peaks[x][0])))
+
+def window_by_diff(peaks,trans): # (diff,freq,inten) for every peak of a window, sorted by distance from the predicted line
+    window = []
+    for x in window_order(peaks,trans):
+        freq,inten = peaks[x]
+        window.append((abs(float(trans[1])-float(freq)),freq,inten))
+    return window
+
+def best_first_triples(list_a,list_b,list_c,trans_1,trans_2,trans_3,max_pending=200000,pair_mask=None,pair_window=None):
+
+    """ Yields (freq_1,inten_1,freq_2,inten_2,freq_3,inten_3,scaled_diff) for every combination of list_a x list_b x list_c
+    (windows for trans_1, trans_2 and trans_3) in ascending scaled_diff order.  Memory is O(product of the two smaller
+    windows + max_pending); held entries past max_pending are spilled to temporary files.  If pair_mask (boolean, len(list_a) x len(list_b), e.g. from batch_fit_module.admissible_pairs)
+    is given, only the trans_1/trans_2 pairs it allows are combined with list_c.  If pair_window ((low,high) arrays of the
+    same shape, e.g. from batch_fit_module.trans_3_windows) is given, each pair is only combined with the list_c peaks
+    between its low and high."""
+
+    windows = [window_by_diff(list_a,trans_1),window_by_diff(list_b,trans_2),window_by_diff(list_c,trans_3)]
+
+    if [] in windows:
+        return
+
+    allowed = None
+    freq_low = None
+    if pair_mask is None and pair_window is None:
+        order = sorted(range(3),key=lambda x: len(windows[x])) # The largest window goes last so the frontier stays small
+    else: # trans_3 goes last so each pair gets its own row of third peaks
+        order = sorted(range(2),key=lambda x: len(windows[x])) + [2]
+        pair_order = numpy.ix_(window_order(list_a,trans_1),window_order(list_b,trans_2))
+        if pair_mask is not None:
+            allowed = numpy.asarray(pair_mask,dtype=bool)[pair_order]
+        if pair_window is not None:
+            freq_low = numpy.asarray(pair_window[0],dtype=float)[pair_order]
+            freq_high = numpy.asarray(pair_window[1],dtype=float)[pair_order]
+        if order[0] == 1:
+            if allowed is not None:
+                allowed = allowed.T
+            if freq_low is not None:
+                freq_low = freq_low.T
+                freq_high = freq_high.T
+    window_a = windows[order[0]]
+    window_b = windows[order[1]]
+    window_c = windows[order[2]]
+    position = [order.index(x) for x in range(3)] # Where trans_1, trans_2 and trans_3 ended up
+
+    if freq_low is not None: # Third peaks by frequency, with their place in window_c, for the binary search
+        freqs_c = numpy.array([float(peak[1]) for peak in window_c])
+        by_freq = numpy.argsort(freqs_c,kind='mergesort')
+        freqs_c = freqs_c[by_freq]
+
+    rows = {}
+    def third_peaks(i,j): # Indices into window_c of the third peaks of pair (i,j), nearest first; None means all of them
+        if allowed is not None and not allowed[i,j]:
+            return []
+        if freq_low is None:
+            return None
+        first = numpy.searchsorted(freqs_c,freq_low[i,j],side='left')
+        last = numpy.searchsorted(freqs_c,freq_high[i,j],side='right')
+        return sorted(by_freq[first:last].tolist())
+
+    pred_ratio = pow(10,max(float(trans_1[0]),float(trans_2[0]),float(trans_3[0]))-min(float(trans_1[0]),float(trans_2[0]),float(trans_3[0])))
+
+    def avg_diff(i,j,k):
+        return (window_a[i][0]+window_b[j][0]+window_c[k][0])/3
+
+    # Each pair (i,j) first comes up as a header entry (k = -1) keyed on the nearest third peak of the whole window, which is
+    # never more than any of its own triples or the next pairs' keys; the header hands on to the next pairs and the pair's
+    # own first triple.  Without a mask or windows every pair has all of window_c and the headers are skipped.
+    headers = allowed is not None or freq_low is not None
+    if headers:
+        frontier = [(avg_diff(0,0,0),0,0,-1)]
+    else:
+        frontier = [(avg_diff(0,0,0),0,0,0)]
+    pending = []
+    runs = [] # [memmap, next row, file] of each sorted run of held entries spilled to disk
+    heads = [] # (scaled_diff,i,j,k,run) of the next entry of each run
+
+    def next_head(run): # Puts the next entry of a run on heads
+        rows,row,fh = runs[run]
+        if row < len(rows):
+            runs[run][1] = row+1
+            scaled_diff,i,j,k = rows[row].tolist()
+            heapq.heappush(heads,(scaled_diff,int(i),int(j),int(k),run))
+        else:
+            runs[run] = None
+            fh.close()
+
+    def spill(): # Writes the held entries to a new run, sorted like the heap would hand them out, and empties pending
+        entries = numpy.array(pending,dtype=float)
+        entries = entries[numpy.lexsort((entries[:,3],entries[:,2],entries[:,1],entries[:,0]))]
+        fh = tempfile.TemporaryFile()
+        entries.tofile(fh)
+        fh.flush()
+        runs.append([numpy.memmap(fh,dtype=float,mode='r',shape=entries.shape),0,fh])
+        next_head(len(runs)-1)
+        del pending[:]
+
+    while frontier:
+        diff,i,j,k = heapq.heappop(frontier)
+
+        if k == -1:
+            if j+1 < len(window_b): # (i,j+1) always comes from (i,j) and (i+1,0) from (i,0)
+                heapq.heappush(frontier,(avg_diff(i,j+1,0),i,j+1,-1))
+            if j == 0 and i+1 < len(window_a):
+                heapq.heappush(frontier,(avg_diff(i+1,0,0),i+1,0,-1))
+            row = third_peaks(i,j)
+            if row is None:
+                heapq.heappush(frontier,(diff,i,j,0))
+            elif row:
+                rows[(i,j)] = row
+                heapq.heappush(frontier,(avg_diff(i,j,row[0]),i,j,0))
+        else:
+            row = rows.get((i,j))
+            if row is None:
+                num_third = len(window_c)
+                third = k
+            else:
+                num_third = len(row)
+                third = row[k]
+            if k+1 < num_third: # (i,j,k+1) always comes from (i,j,k), (i,j+1,0) from (i,j,0) and (i+1,0,0) from (i,0,0)
+                if row is None:
+                    heapq.heappush(frontier,(avg_diff(i,j,k+1),i,j,k+1))
+                else:
+                    heapq.heappush(frontier,(avg_diff(i,j,row[k+1]),i,j,k+1))
+            elif row is not None:
+                del rows[(i,j)]
+            if not headers and k == 0 and j+1 < len(window_b):
+                heapq.heappush(frontier,(avg_diff(i,j+1,0),i,j+1,0))
+            if not headers and k == 0 and j == 0 and i+1 < len(window_a):
+                heapq.heappush(frontier,(avg_diff(i+1,0,0),i+1,0,0))
+
+            diff_1,freq_1,inten_1 = window_a[i]
+            diff_2,freq_2,inten_2 = window_b[j]
+            diff_3,freq_3,inten_3 = window_c[third]
+            real_ratio = max(float(inten_1),float(inten_2),float(inten_3))/min(float(inten_1),float(inten_2),float(inten_3))
+            scaled_diff = diff*(abs(real_ratio-pred_ratio)+1) # Freq. difference scaled by deviation of intensity ratio from predicted
+            heapq.heappush(pending,(scaled_diff,i,j,third))
+            if len(pending) > max_pending:
+                spill()
+
+        if frontier:
+            next_diff = frontier[0][0]
+        else:
+            next_diff = float('inf')
+
+        while True: # Every held entry the frontier has passed, from pending and the runs merged
+            if heads and (not pending or heads[0][0:4] < pending[0]):
+                if heads[0][0] > next_diff:
+                    break
+                scaled_diff,i,j,k,run = heapq.heappop(heads)
+                next_head(run)
+            elif pending and pending[0][0] <= next_diff:
+                scaled_diff,i,j,k = heapq.heappop(pending)
+            else:
+                break
+            peaks = (window_a[i],window_b[j],window_c[k])
+            peak_1 = peaks[position[0]]
+            peak_2 = peaks[position[1]]
+            peak_3 = peaks[position[2]]
+            yield (peak_1[1],peak_1[2],peak_2[1],peak_2[2],peak_3[1],peak_3[2],scaled_diff)
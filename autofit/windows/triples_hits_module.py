@@ -0,0 +1,151 @@
+import os
+import glob
+import math
+
+""""
+Triples hit detection
+
+Please comment any changes you make to the code here:
+
+triples hits module:
+-A real hit fits the check transitions orders of magnitude better than the random triples around it, but it used to
+show up only in sorted_omc_cat.txt once the whole search was done (interim_good_output%s.txt catches fits under a fixed
+0.2 MHz, which says nothing about how unusual they are for the spectrum).  Each fit_triples process now keeps running
+statistics of its fits' average omc, on a log10 scale since random fits spread over decades (Welford's mean and variance,
+update_stats), and a fit that lands hit_sigma standard deviations below the mean of the fits before it is written to
+hits%s.txt as soon as it's found (check_hit).
+
+-Triples are fitted best first, so a real hit tends to come before a process has MIN_FITS fits to compare it with.  The
+best PENDING_COUNT fits of that start are held back and checked as soon as the statistics are there.
+
+-Each hit line starts with the number of fits it was compared with, its z value and a tail estimate: the expected number
+of those fits that would score this well by chance, from the normal tail.  Well below 1 means the fit is hard to explain
+as a random one.
+
+-Early stop: with stop_hits set, the driver (triples_queue_module.feed_queue) stops handing out triples once stop_hits
+hits in hits%s.txt agree on A, B and C to within AGREE_TOL (hits_agree).  The fits done so far are merged as usual.
+
+-hits_agree is called for every chunk the driver hands out, and used to read every hits file again and compare every hit
+with every other.  It now keeps what it has read (per job directory), reads only the lines added since, and compares
+each new hit with the earlier ones once, keeping a count of the hits that agree with each.
+
+-hits%s.txt belong to one search: a new search in the job directory clears them (clear_hits, like
+program_call_module.clear_skipped) so an earlier search's hits can't stop it; only a resume keeps them.
+
+"""
+
+MIN_FITS = 100 # Fits a process has to have scored before its statistics are trusted to flag a hit
+AGREE_TOL = 0.1 # MHz; hits whose A, B and C are all this close count as the same constants for stop_hits
+OMC_FLOOR = 1e-6 # MHz; keeps log10 finite for an exact fit
+PENDING_COUNT = 10 # Best fits held back until there are MIN_FITS to compare them with
+
+_agreement = {} # (job directory, tolerance): [{hits file: bytes read}, (A,B,C) of the hits read, hits agreeing with each], for hits_agree
+
+def new_stats(): # [fits, mean, sum of squared deviations] of log10(average omc), and the held back (avg,line) of the first fits
+    return [0,0.0,0.0,[]]
+
+def update_stats(stats,avg): # Welford's update with one more fit
+    value = math.log10(max(avg,OMC_FLOOR))
+    stats[0] += 1
+    delta = value-stats[1]
+    stats[1] += delta/stats[0]
+    stats[2] += delta*(value-stats[1])
+
+def significance(stats,avg):
+
+    """ (z,tail) of a fit against the fits in stats: how many standard deviations its log10(average omc) is below their
+    mean, and the expected number of them at least this good if they're normal.  (0.0,None) until there are MIN_FITS."""
+
+    if stats[0] < MIN_FITS or stats[2] <= 0:
+        return 0.0,None
+    z = (stats[1]-math.log10(max(avg,OMC_FLOOR)))/math.sqrt(stats[2]/(stats[0]-1))
+    tail = stats[0]*0.5*math.erfc(z/math.sqrt(2.0))
+    return z,tail
+
+def write_hit(file_num,stats,z,tail,result_line):
+    fh = open("hits%s.txt"%(str(file_num)),"a")
+    fh.write("fits = %s z = %.2f tail = %.2e %s"%(stats[0],z,tail,result_line))
+    fh.close()
+
+def check_hit(file_num,stats,avg,result_line,hit_sigma):
+
+    """ Writes result_line to hits%s.txt if the fit is hit_sigma below the process's fits so far, then adds the fit to
+    stats.  Before there are MIN_FITS the best fits are held back, and checked when the MIN_FITS-th one comes in.  Returns
+    the number of hits written."""
+
+    hits = 0
+    if stats[0] < MIN_FITS:
+        update_stats(stats,avg)
+        stats[3] = sorted(stats[3]+[(avg,result_line)])[0:PENDING_COUNT]
+        if stats[0] == MIN_FITS:
+            for (pending_avg,pending_line) in stats[3]:
+                (z,tail) = significance(stats,pending_avg)
+                if tail != None and z >= hit_sigma:
+                    write_hit(file_num,stats,z,tail,pending_line)
+                    hits += 1
+            stats[3] = []
+        return hits
+
+    (z,tail) = significance(stats,avg)
+    if tail != None and z >= hit_sigma:
+        write_hit(file_num,stats,z,tail,result_line)
+        hits += 1
+    update_stats(stats,avg)
+    return hits
+
+def hit_constants(line): # (A,B,C) of a hit line, None for anything else
+    if b"Const =" not in line:
+        return None
+    fields = line.split(b"Const =")[1].split()
+    return (float(fields[0]),float(fields[1]),float(fields[2]))
+
+def read_hits(job_dir="."): # (A,B,C) of every hit in the hits%s.txt files
+    hits = []
+    for filename in sorted(glob.glob(os.path.join(job_dir,"hits*.txt"))):
+        fh = open(filename,"rb")
+        for line in fh:
+            hit = hit_constants(line)
+            if hit != None:
+                hits.append(hit)
+        fh.close()
+    return hits
+
+def clear_hits(job_dir="."): # A new search in job_dir starts without hits
+    for filename in glob.glob(os.path.join(job_dir,"hits*.txt")):
+        os.remove(filename)
+    for key in list(_agreement.keys()):
+        if key[0] == os.path.abspath(job_dir):
+            del _agreement[key]
+
+def hits_agree(stop_hits,job_dir=".",tolerance=AGREE_TOL):
+
+    """ Whether stop_hits of the hits so far have the same constants (to within tolerance).  Only the hit lines written
+    since the last call are read, and each is compared with the hits before it once."""
+
+    key = (os.path.abspath(job_dir),tolerance)
+    if key not in _agreement:
+        _agreement[key] = [{},[],[]]
+    (offsets,hits,agreeing) = _agreement[key]
+    for filename in sorted(glob.glob(os.path.join(job_dir,"hits*.txt"))):
+        offset = offsets.get(filename,0)
+        if os.path.getsize(filename) < offset: # Not the file that was read before; start over
+            del _agreement[key]
+            return hits_agree(stop_hits,job_dir,tolerance)
+        fh = open(filename,"rb")
+        fh.seek(offset)
+        text = fh.read()
+        fh.close()
+        text = text[0:text.rfind(b"\n")+1] # A line still being written is read next time
+        offsets[filename] = offset+len(text)
+        for line in text.splitlines():
+            hit = hit_constants(line)
+            if hit == None:
+                continue
+            count = 1
+            for x in range(len(hits)):
+                if max([abs(hit[k]-hits[x][k]) for k in range(3)]) <= tolerance:
+                    agreeing[x] += 1
+                    count += 1
+            hits.append(hit)
+            agreeing.append(count)
+    return agreeing != [] and max(agreeing) >= stop_hits
@@ -0,0 +1,142 @@
+import sys
+import time
+import json
+import multiprocessing
+
+""""
+Triples progress reporting
+
+Please comment any changes you make to the code here:
+
+triples progress module:
+-prog_A's update_progress() progress bar only worked on Linux (it read module globals the Windows processes don't share)
+and the GUI showed nothing but "AUTOFIT RUN STARTED" until the search was over.  Now each fit_triples process has a slot
+in two shared arrays (new_counters: triples done and best avg w/ inten penalty so far), which it writes every
+REPORT_EVERY triples and at the end (report), so a triple costs an integer increment.  Each process only writes its own
+slot, so the arrays have no lock.
+
+-The driver polls a ProgressReporter from the loops it already waits in (triples_queue_module.feed_queue, put_task and
+triples_results_module.collect_heaps), so no extra thread is needed.  At most every interval seconds it publishes triples
+done, the rate of each process and the total rate, ETA and the best score so far: on one terminal line, to status.json in
+the job directory and to callback (e.g. the emit of a Qt signal, see fitting_GUI_v11B).  The callback runs in the driver's
+thread, which is the GUI's thread when the GUI started the run.
+
+-With seconds_per_triple (triples_timing_module's stored timing) the ETA is there from the start instead of after the
+first interval, and with timing_key a search that finishes stores the seconds per triple it got, so the next estimate is
+based on it.
+
+-With adaptive_workers the reporter also polls the triples_workers_module.WorkerController, and reports how many
+processes it has active.
+
+"""
+
+REPORT_EVERY = 20 # Triples between a process's writes to the shared counters
+STATUS_FILE = "status.json"
+
+def new_counters(processors): # [triples done, best avg w/ inten penalty] per process, shared with the fit_triples processes
+    best = multiprocessing.Array('d',int(processors),lock=False)
+    for num in range(int(processors)):
+        best[num] = float('inf')
+    return [multiprocessing.Array('l',int(processors),lock=False),best]
+
+def report(counters,file_num,done,best): # Worker side: this process's count and best so far
+    if counters != None:
+        counters[0][file_num] = done
+        counters[1][file_num] = best
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d"%(seconds//3600,(seconds//60)%60,seconds%60)
+
+class ProgressReporter:
+
+    """ Driver side: reads the shared counters and publishes the progress of a search of total triples (0 if unknown).
+    done_before is what a resumed search had already done; it counts towards the total but not the rates.
+    seconds_per_triple gives the ETA until there's a rate, and with timing_key the rate of a finished search is stored
+    (triples_timing_module).  controller (triples_workers_module.WorkerController) is polled along with it."""
+
+    def __init__(self,counters,total=0,done_before=0,interval=2.0,callback=None,status_file=STATUS_FILE,terminal=True,
+                 seconds_per_triple=None,timing_key=None,controller=None):
+        self.counters = counters
+        self.total = total
+        self.done_before = done_before
+        self.interval = interval
+        self.callback = callback
+        self.status_file = status_file
+        self.terminal = terminal
+        self.seconds_per_triple = seconds_per_triple
+        self.timing_key = timing_key
+        self.controller = controller
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.last_done = [0]*len(counters[0])
+        self.rates = [0.0]*len(counters[0])
+
+    def poll(self): # Publishes if interval has gone by since the last time
+        if self.controller != None:
+            self.controller.poll()
+        if time.time()-self.last_time >= self.interval:
+            self.publish()
+
+    def publish(self,state="running"):
+        now = time.time()
+        done = list(self.counters[0])
+        for num in range(len(done)): # Rate of each process over the last interval, smoothed
+            if now > self.last_time:
+                rate = (done[num]-self.last_done[num])/(now-self.last_time)
+                if self.last_time == self.start_time:
+                    self.rates[num] = rate
+                else:
+                    self.rates[num] = 0.5*self.rates[num]+0.5*rate
+        self.last_time = now
+        self.last_done = done
+
+        total_done = self.done_before+sum(done)
+        rate = sum(self.rates)
+        eta = None
+        if self.total > 0 and rate > 0 and state == "running":
+            eta = max(self.total-total_done,0)/rate
+        elif self.total > 0 and self.seconds_per_triple != None and state == "running":
+            eta = max(self.total-total_done,0)*self.seconds_per_triple
+        best = min(list(self.counters[1])+[float('inf')])
+        if best == float('inf'):
+            best = None
+        status = {'state':state,'time':now,'elapsed':now-self.start_time,'done':total_done,'total':self.total,'rate':rate,'eta':eta,
+                  'best_penalized_avg':best,'workers':[{'done':done[num],'rate':self.rates[num]} for num in range(len(done))]}
+        if self.controller != None:
+            status['active_workers'] = self.controller.level()
+
+        if self.terminal:
+            line = "%s"%(total_done)
+            if self.total > 0:
+                percent = min(100,int(100.0*total_done/self.total))
+                line += "/%s :: [%-10s] %s%%"%(self.total,'#'*(percent//10),percent)
+            line += " :: %.1f Hz"%(rate)
+            if self.controller != None:
+                line += " :: %s/%s processes"%(self.controller.level(),len(done))
+            if eta != None:
+                line += " :: ETA %s"%(format_time(eta))
+            if best != None:
+                line += " :: best %.4g"%(best)
+            sys.stdout.write('\r'+line+' '*5)
+            if state != "running":
+                sys.stdout.write('\n')
+            sys.stdout.flush()
+        if self.status_file != None:
+            try:
+                fh = open(self.status_file,"w")
+                json.dump(status,fh)
+                fh.close()
+            except IOError: # A status file that can't be written (e.g. open in an editor on Windows) shouldn't stop the search
+                pass
+        if self.callback != None:
+            self.callback(status)
+        return status
+
+    def finish(self,state): # Last report, with the driver's status ("Done", "Paused", "Stopped")
+        status = self.publish(state.lower())
+        done = sum([worker['done'] for worker in status['workers']])
+        if self.timing_key != None and status['state'] == "done" and done >= REPORT_EVERY*len(status['workers']):
+            import triples_timing_module # Not at the top, triples_timing_module imports this one
+            triples_timing_module.store_seconds(self.timing_key,status['elapsed']/done)
+        return status
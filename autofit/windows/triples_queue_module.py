@@ -0,0 +1,133 @@
+try:
+    import Queue as queue
+except ImportError: # Python 3
+    import queue
+import os
+import triples_checkpoint_module
+import triples_hits_module
+import triples_workers_module
+
+""""
+Triples work queue
+
+Please comment any changes you make to the code here:
+
+triples queue module:
+-The drivers used to random.shuffle the largest peak window, cut it into one equal slice per processor and give each
+process its own slice to enumerate and sort.  Fast processes then sat idle at the end and the globally best triples were
+spread over the whole run.  Now the driver enumerates all triples once in global scaled_diff order
+(triples_enum_module.best_first_triples), feed_queue hands them out in small chunks through a bounded multiprocessing
+queue, and every fit_triples process pulls its next chunk as soon as it's done with the last one (queue_triples), so all
+processes stay busy to the end and the best candidates are fit first.
+
+-Chunks are numbered in the order they're made.  feed_queue skips chunks that a checkpoint says are done and stops handing
+out new ones when a pause is requested; queue_triples checkpoints every chunk its process finishes (see
+triples_checkpoint_module).
+
+-Anytime search: with stop_hits set, feed_queue also stops handing out chunks once that many hits found by the processes
+agree on the constants (triples_hits_module.hits_agree) and returns "Stopped"; the drivers merge what was fitted like
+for a finished run.
+
+-queue_triples calls fit_triples' flush before it checkpoints a chunk, so every fit of the chunk (physical or not, and
+its multiplicity counts) is on disk first.  It used to rely on fit_triples writing after every physical fit, which left
+the unphysical fits and failures of a chunk's tail in memory when the chunk was marked done.
+
+-Screen counts (engine "batch"): the driver's batch_screen counts every triple it passes, including the chunks a resumed
+run skips because they were done before.  feed_queue takes its stats dict and puts the counts back for every chunk it
+doesn't hand out, so the cascade report of a resumed search doesn't count those chunks twice.
+
+-feed_queue and put_task take a triples_progress_module.ProgressReporter and poll it while they wait, so the progress is
+published from the driver's thread.
+
+-With adaptive_workers, queue_triples waits until its process is among the active ones before it takes a chunk
+(triples_workers_module), and feed_queue releases the controller before the stop markers so every process gets one.
+
+"""
+
+def chunks(triples,chunk_size): # Groups an iterable of triples into lists of chunk_size
+    chunk = []
+    for entry in triples:
+        chunk.append(entry)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk != []:
+        yield chunk
+
+def put_task(task_queue,task,workers,reporter=None): # Blocking put that gives up if every worker has died, instead of hanging the driver
+    while True:
+        if reporter != None:
+            reporter.poll()
+        try:
+            task_queue.put(task,True,1.0)
+            return
+        except queue.Full:
+            if workers != None and not [worker for worker in workers if worker.is_alive()]:
+                raise RuntimeError("All fit_triples processes have exited; the triples queue can't be emptied.")
+
+def feed_queue(task_queue,triples,processors,workers=None,chunk_size=50,done_chunks=set(),check_pause=True,stop_hits=0,reporter=None,controller=None,stats=None):
+
+    """ Puts the triples on task_queue as (chunk id, chunk of chunk_size triples), in the order they come, skipping chunk
+    ids in done_chunks, followed by one None per process to tell it to stop.  Blocks while the queue is full, so only a few
+    chunks are ever waiting.  Returns "Paused" if it stopped early because of a pause request, "Stopped" if stop_hits
+    hits agree, otherwise "Done".  controller (triples_workers_module.WorkerController) is released before the stop
+    markers go out.  stats is the dict of counts the screen producing triples adds to (batch_fit_module.batch_screen);
+    what it counted for a chunk that isn't handed out (done before a resume, or held back by a pause) is taken off again."""
+
+    status = "Done"
+    chunk_id = 0
+    counted = None
+    if stats != None:
+        counted = dict(stats)
+    for chunk in chunks(triples,chunk_size):
+        if check_pause and triples_checkpoint_module.pause_requested():
+            status = "Paused"
+        elif stop_hits > 0 and triples_hits_module.hits_agree(stop_hits):
+            status = "Stopped"
+        if status != "Done" or chunk_id in done_chunks:
+            if stats != None: # Back to the counts of the chunks handed out
+                for key in stats:
+                    stats[key] = counted.get(key,0)
+            if status != "Done":
+                break
+        else:
+            put_task(task_queue,(chunk_id,chunk),workers,reporter)
+            if stats != None:
+                counted = dict(stats)
+        chunk_id += 1
+    if controller != None: # Idle processes have to get their stop marker too
+        controller.release()
+    for num in range(processors):
+        put_task(task_queue,None,workers,reporter)
+    return status
+
+def queue_triples(task_queue,file_num=None,active=None,whole_chunks=False,flush=None):
+
+    """ Worker side: yields triples from task_queue until the stop marker arrives.  If file_num is given, each chunk is
+    checkpointed once the caller asks for the triple after its last one, i.e. once every fit of the chunk is written to
+    final_output%s.txt.  With active (triples_workers_module.new_limit), a chunk is only taken while file_num is below it.
+    whole_chunks yields each chunk as a list instead (for program_call_module.spfit_runs with in_flight), checkpointed once
+    the caller asks for the next one.  flush() (the caller's, writing out what it has fitted) is called just before each
+    checkpoint, so a chunk is never marked done with any of its fits still in memory."""
+
+    if file_num != None:
+        best = triples_checkpoint_module.read_partial_best(file_num)
+        read_offset = 0
+        if os.path.exists("final_output%s.txt"%(str(file_num))):
+            read_offset = os.path.getsize("final_output%s.txt"%(str(file_num)))
+
+    while True:
+        triples_workers_module.wait_active(active,file_num)
+        task = task_queue.get()
+        if task == None:
+            break
+        chunk_id,chunk = task
+        if whole_chunks:
+            yield chunk
+        else:
+            for entry in chunk:
+                yield entry
+        if flush != None:
+            flush()
+        if file_num != None:
+            (best,read_offset) = triples_checkpoint_module.chunk_done(file_num,chunk_id,best,read_offset)
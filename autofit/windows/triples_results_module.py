@@ -0,0 +1,210 @@
+try:
+    import Queue as queue
+except ImportError: # Python 3
+    import queue
+import heapq
+import glob
+import triples_scoring_module
+
+""""
+Triples result heaps
+
+Please comment any changes you make to the code here:
+
+triples results module:
+-Every fit_triples process used to shell out to "sort -r" on its final_output%s.txt, and the driver then ran
+cat sorted_final_out*.txt | sort -t "=" -k 4 -n (and -k 6) over every result line of the search just to read the best 100
+back, which is a disk sort of tens of millions of lines and needs a Unix sort on Windows.  Now each process keeps bounded
+heaps of its best TOP_COUNT result lines for each ranking (average omc, avg w/out peaks over edge, avg w/ inten penalty),
+puts them on a result queue when it's done, and the driver merges them in memory and writes sorted_omc_cat%s.txt,
+sorted_real_omc_cat%s.txt, sorted_inten_omc_cat%s.txt and best100%s.txt from them.  The sorted files hold the best
+TOP_COUNT lines of each ranking rather than every line; final_output%s.txt is still written in full.
+
+-The order is the old sort's: ascending by the ranking value, equal values by the whole line.
+
+-A resumed search only fits the chunks that weren't done, so the driver first reads the lines already in the (rewound)
+final_output files into the heaps with read_results.
+
+-Duplicate fits (dedup_tol): each process appends "multiplicity line" for every set of constants it found to
+multiplicity%s.txt when it's done, and write_multiplicity adds them up over the processes (and over the runs of a resumed
+job) into fit_multiplicity%s.txt, most often found first.  A set of constants many triples converge on is a good sign.
+Each process saves its counts with every chunk it finishes (only the ones since the last save), so a checkpointed chunk's
+counts are never lost.
+
+-A save used to walk every set of constants the process had ever found and kept each one's result line for good, so a
+long search spent O(N^2/chunk) on saves and its memory grew with every new fit.  Multiplicity keeps the counts and lines
+only of the constants fitted since the last save; a line is written once, and later fits of the same constants are
+written as just their key.  A fit is recorded before early-abort scoring can drop it, so its duplicates are only counted
+too.
+
+"""
+
+TOP_COUNT = 10000 # Lines kept per ranking; omc_reader reads the first 1000 of sorted_omc_cat.txt
+RANKINGS = [("sorted_omc_cat%s.txt",3),("sorted_real_omc_cat%s.txt",4),("sorted_inten_omc_cat%s.txt",5)] # Output file and field of line.split("=") (sort -t "=" -k 4, 5, 6)
+
+def new_heaps(): # One heap per ranking of (-value, line), worst kept line on top
+    return [[] for ranking in RANKINGS]
+
+def result_values(line): # (average omc, avg w/out peaks over edge, avg w/ inten penalty) of a result line
+    fields = line.split("=")
+    return tuple([float(fields[field].split()[0]) for name,field in RANKINGS])
+
+def add_result(heaps,line,values=None,count=TOP_COUNT):
+
+    """ Keeps line in each ranking's heap if it's among the best count lines so far.  values are the line's
+    (avg,real_avg,penalized_avg) if the caller has them, otherwise they're read from the line."""
+
+    if values == None:
+        values = result_values(line)
+    for key in range(len(RANKINGS)):
+        entry = (-values[key],line)
+        if len(heaps[key]) < count:
+            heapq.heappush(heaps[key],entry)
+        elif entry > heaps[key][0]:
+            heapq.heapreplace(heaps[key],entry)
+
+def merge_heaps(heaps,more_heaps,count=TOP_COUNT): # Adds the entries of more_heaps (e.g. from another process) to heaps
+    for key in range(len(RANKINGS)):
+        for entry in more_heaps[key]:
+            if len(heaps[key]) < count:
+                heapq.heappush(heaps[key],entry)
+            elif entry > heaps[key][0]:
+                heapq.heapreplace(heaps[key],entry)
+
+def read_results(pattern="final_output*.txt",heaps=None,count=TOP_COUNT): # Streams the result lines already in the files matching pattern into heaps
+    if heaps == None:
+        heaps = new_heaps()
+    for filename in sorted(glob.glob(pattern)):
+        fh = open(filename)
+        for line in fh:
+            if line.strip() != "":
+                add_result(heaps,line,None,count)
+        fh.close()
+    return heaps
+
+def collect_heaps(result_queue,workers,heaps=None,count=TOP_COUNT,reporter=None):
+
+    """ Driver side: gets the heaps of every process in workers off result_queue and merges them into heaps.  Has to run
+    before the processes are joined, since a process doesn't exit until what it put on the queue has been read.  Stops
+    waiting for processes that died without sending anything.  reporter (triples_progress_module) is polled while it waits."""
+
+    if heaps == None:
+        heaps = new_heaps()
+    received = 0
+    while received < len(workers):
+        if reporter != None:
+            reporter.poll()
+        try:
+            worker_heaps = result_queue.get(True,1.0)
+        except queue.Empty:
+            if not [worker for worker in workers if worker.is_alive()]:
+                break
+            continue
+        merge_heaps(heaps,worker_heaps,count)
+        received += 1
+    return heaps
+
+def ranked_lines(heaps,key): # Lines of one ranking, best first
+    return [line for value,line in sorted([(-value,line) for value,line in heaps[key]])]
+
+def write_results(heaps,suffix="",best_count=100):
+
+    """ Writes sorted_omc_cat%s.txt, sorted_real_omc_cat%s.txt, sorted_inten_omc_cat%s.txt and best100%s.txt (the best
+    best_count lines by avg w/ inten penalty, numbered) for suffix.  Returns the numbered best lines, as shown in the
+    drivers' codebox."""
+
+    for key in range(len(RANKINGS)):
+        fh = open(RANKINGS[key][0]%(suffix),"w")
+        fh.write("".join(ranked_lines(heaps,key)))
+        fh.close()
+
+    best = ranked_lines(heaps,len(RANKINGS)-1)
+    fits = []
+    for i in range(best_count):
+        r = ""
+        if i < len(best):
+            r = best[i]
+
+        if i < 10:
+            number = '0'+str(i)
+        else:
+            number = i
+
+        temp = str(number) + ' ' + r
+        fits.append(temp)
+
+    f100 = open('best100%s.txt'%(suffix),'w')
+    f100.write("".join(fits))
+    f100.close()
+    return fits
+
+class Multiplicity:
+
+    """ Duplicate fits of one fit_triples process (dedup_tol).  Knows every constants_key the process has fitted, so
+    repeats are only counted, and keeps the counts and not yet written result lines only for the keys fitted since the
+    last save, so a save is as long as a chunk and a line is held until it's written once."""
+
+    def __init__(self):
+        self.seen = {} # constants_key: True once its result line is in multiplicity%s.txt
+        self.counts = {} # constants_key: fits that found it since the last save
+        self.lines = {} # constants_key: result line not written yet
+
+    def repeat(self,key): # True (and counted) if key was fitted before
+        if key not in self.seen:
+            return False
+        self.counts[key] = self.counts.get(key,0)+1
+        return True
+
+    def record(self,key): # First fit of key, before it's scored; without a line (unphysical, or dropped by early abort) it's counted but never written
+        self.seen[key] = False
+        self.counts[key] = 1
+
+    def keep_line(self,key,line): # key's first fit was scored and is physical
+        self.lines[key] = line
+
+    def save(self,file_num):
+
+        """ Appends the counts since the last save to multiplicity%s.txt: "count line" the first time a key's line is
+        written, "count key k_A k_B k_C" for later fits of it, nothing for keys without a line."""
+
+        fh = open("multiplicity%s.txt"%(str(file_num)),"a")
+        for key in self.counts:
+            if key in self.lines:
+                fh.write("%s %s"%(self.counts[key],self.lines.pop(key)))
+                self.seen[key] = True
+            elif self.seen[key]:
+                fh.write("%s key %d %d %d\n"%(self.counts[key],key[0],key[1],key[2]))
+        fh.close()
+        self.counts.clear()
+
+def write_multiplicity(tolerance,suffix=""):
+
+    """ Adds up the multiplicity%s.txt files of every process into fit_multiplicity%s.txt: one line per set of constants
+    (rounded to tolerance), with the number of fits that found it and its best line by avg w/ inten penalty, highest count
+    first.  Returns the merged [count,line] list."""
+
+    merged = {}
+    for filename in sorted(glob.glob("multiplicity*.txt")):
+        fh = open(filename)
+        for entry in fh:
+            if entry.strip() == "":
+                continue
+            (count,line) = entry.split(" ",1)
+            fields = line.split()
+            if fields[0] == "key": # A later count of constants whose line the process wrote before
+                key = (int(fields[1]),int(fields[2]),int(fields[3]))
+                line = None
+            else:
+                key = triples_scoring_module.constants_key(fields[5],fields[6],fields[7],tolerance)
+            if key not in merged:
+                merged[key] = [0,None]
+            merged[key][0] += int(count)
+            if line != None and (merged[key][1] == None or result_values(line)[2] < result_values(merged[key][1])[2]):
+                merged[key][1] = line
+        fh.close()
+    ranked = sorted([entry for entry in merged.values() if entry[1] != None],key=lambda entry: (-entry[0],result_values(entry[1])[2]))
+    fh = open("fit_multiplicity%s.txt"%(suffix),"w")
+    for (count,line) in ranked:
+        fh.write("%s %s"%(count,line))
+    fh.close()
+    return ranked
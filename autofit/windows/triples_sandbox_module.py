@@ -0,0 +1,78 @@
+import os
+import shutil
+import hashlib
+
+""""
+SPFIT files of the triples search on a RAM disk
+
+Please comment any changes you make to the code here:
+
+triples sandbox module:
+-Every triple fit_triples fits means a .par and a .lin written, and a .var, .fit and .bak written by SPFIT and read
+back, all in the job folder on the real disk, and the drivers copied SPFIT.EXE to an SPFIT%s.EXE for every process with
+a "cp" shell call.  open_sandbox gives each fit_triples process a folder of its own on a RAM disk (/dev/shm, or ram_dir)
+for those files, so they never reach the disk, and close_sandbox removes it when the process is done.  The sandbox name
+comes from the job folder and the process number, so a rerun of the job reuses (and empties) the same folders, and a
+process that was killed leaves nothing that grows.  Without a RAM disk (Windows) or with ram_dir "off", the files stay
+in the job folder like before.
+
+-copy_programs puts one SPFIT.EXE and SPCAT.EXE in the job folder, and every process runs that one (spfit_program, by
+its full path since the sandbox is the working directory).  Job folders set up before this only have SPFIT0.EXE and
+the like, which spfit_program falls back on.
+
+-The .par can't be written once per process: SPFIT moves it to .bak and writes its fitted constants to the .par, so it is
+still written for every triple, from the text fit_triples builds once.
+
+"""
+
+RAM_DIRS = ("/dev/shm",) # Tried in order when ram_dir isn't given
+OFF = ("off","none","") # ram_dir values that keep the files in the job folder
+PROGRAMS = ("SPFIT.EXE","SPCAT.EXE") # Copied into the job folder by copy_programs
+SPFIT_NAMES = ("SPFIT.EXE","SPFIT","SPFIT0.EXE","SPFIT0") # What spfit_program looks for, shared copy first
+
+def ram_dir(configured=None): # Folder the sandboxes go in, None if the files stay in the job folder
+    if configured != None:
+        if str(configured).lower() in OFF:
+            return None
+        return configured
+    for folder in RAM_DIRS:
+        if os.path.isdir(folder) and os.access(folder,os.W_OK):
+            return folder
+    return None
+
+def sandbox_name(file_num,job_dir="."):
+    key = hashlib.md5(os.path.abspath(job_dir).encode("utf-8")).hexdigest()[0:10]
+    return "autofit_%s_%s"%(key,str(file_num))
+
+def open_sandbox(file_num,configured=None,job_dir="."):
+
+    """ Empty folder for the SPFIT files of process file_num of the search in job_dir, on the RAM disk (ram_dir).  None
+    if there's no RAM disk, ram_dir is "off" or the folder can't be made; the files then go in the job folder."""
+
+    folder = ram_dir(configured)
+    if folder == None:
+        return None
+    sandbox = os.path.join(folder,sandbox_name(file_num,job_dir))
+    try:
+        if os.path.isdir(sandbox): # Left by a process of an earlier run of this job that didn't finish
+            shutil.rmtree(sandbox)
+        os.makedirs(sandbox)
+    except OSError:
+        return None
+    return sandbox
+
+def close_sandbox(sandbox):
+    if sandbox != None:
+        shutil.rmtree(sandbox,True)
+
+def spfit_program(job_dir="."): # Full path of the SPFIT every process of the search in job_dir runs
+    for name in SPFIT_NAMES:
+        path = os.path.join(os.path.abspath(job_dir),name)
+        if os.path.isfile(path):
+            return path
+    return "SPFIT"
+
+def copy_programs(target,source="."): # One SPFIT.EXE and SPCAT.EXE from source into target, for all the processes
+    for name in PROGRAMS:
+        if os.path.isfile(os.path.join(source,name)):
+            shutil.copy(os.path.join(source,name),target)
@@ -0,0 +1,131 @@
+import numpy
+import math
+
+""""
+Check transition scoring
+
+Please comment any changes you make to the code here:
+
+triples scoring module:
+-fit_triples used to score each fit by cutting the peak list into four quarters and walking one of them peak by peak
+(calling float() on every entry) for every check transition; match_to_peaklist in prog_A and refit_module did the same.
+score_fits does it for a whole block of fits at once: the predicted check frequencies come in as an (n_fits, n_checks)
+array, the nearest experimental peak of every one of them is found with numpy.searchsorted on the sorted peak
+frequencies, and omc, real_omc, matched intensity, score, avg, real_avg and penalized_avg come back as arrays.
+
+-The numbers are the same as the old loop's: score counts check lines within 2 MHz of a peak, avg is the mean omc plus the
+SPFIT rms, real_avg counts lines outside the spectrum as omc 0, and the intensity penalty adds 1 each if the ratio or the
+unitless standard deviation of the matched intensities is at most half or at least 1.5 times the predicted one.  The one
+difference is that the matched intensity is now always the intensity of the nearest peak; the old loop left it at 100000
+(or at the previous line's value) when the nearest peak happened to be the last one of a quarter.
+
+-score_fit_ordered is the early-abort version for one fit: it goes through the check transitions strongest predicted line
+first and gives up as soon as the fit can't reach min_score hits any more, or its average omc can't get under the cutoff
+(fit_triples passes the K-th best avg w/ inten penalty of its process so far) and its real_avg can't get under the
+interim_good_output limit.  Since omc is never negative, the mean of the lines seen so far is a lower bound on avg.
+Fits that survive are scored by score_fits, so their numbers are exactly the same as before.
+
+-constants_key rounds a fit's A, B and C to a tolerance.  With dedup_tol set, fit_triples keeps a dict on that key: a fit
+that lands on constants the process has already scored isn't scored or written again, the first fit's result stands for
+it and the number of fits that found the same constants is counted (fit_multiplicity files).
+
+"""
+
+def sorted_peaks(peaklist): # Peak frequencies and intensities as float arrays sorted by frequency
+    peaks = numpy.asarray(peaklist,dtype=float)
+    order = numpy.argsort(peaks[:,0],kind='mergesort')
+    return peaks[order,0],peaks[order,1]
+
+def nearest_peaks(pred_freqs,peak_freqs):
+
+    """ omc (distance to the nearest peak) and index of the nearest peak in peak_freqs (sorted) for an array of predicted
+    frequencies of any shape.  Ties go to the higher frequency peak like the old loop; predictions that are nan (line not
+    predicted) get omc = 100000."""
+
+    pred_freqs = numpy.asarray(pred_freqs,dtype=float)
+    index = numpy.searchsorted(peak_freqs,pred_freqs)
+    right = numpy.minimum(index,len(peak_freqs)-1)
+    left = numpy.maximum(index-1,0)
+    omc_left = numpy.abs(pred_freqs-peak_freqs[left])
+    omc_right = numpy.abs(pred_freqs-peak_freqs[right])
+    nearest = numpy.where(omc_left < omc_right,left,right)
+    omc = numpy.minimum(omc_left,omc_right)
+    omc[numpy.isnan(pred_freqs)] = 100000.0
+    return omc,nearest
+
+def inten_figures(inten): # Max/min ratio and unitless standard deviation of each row of intensities
+    inten = numpy.atleast_2d(numpy.asarray(inten,dtype=float))
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        ratio = inten.max(axis=1)/inten.min(axis=1)
+        unitless_stdev = inten.std(axis=1)/inten.mean(axis=1)
+    return ratio,unitless_stdev
+
+def score_fits(pred_freqs,rms_fit,peak_freqs,peak_intens,theor_inten,score_omc=2.0):
+
+    """ Scores a block of fits.  pred_freqs is (n_fits, n_checks) predicted check transition frequencies, rms_fit a number
+    or one per fit, peak_freqs/peak_intens from sorted_peaks, theor_inten the predicted intensities (not log) of the check
+    transitions.  Returns a dict of arrays: omc, real_omc, inten (n_fits, n_checks) and score, avg, real_avg,
+    penalized_avg (n_fits)."""
+
+    pred_freqs = numpy.atleast_2d(numpy.asarray(pred_freqs,dtype=float))
+    (omc,nearest) = nearest_peaks(pred_freqs,peak_freqs)
+
+    inside = (pred_freqs >= peak_freqs[0]) & (pred_freqs <= peak_freqs[-1])
+    real_omc = numpy.where(inside,omc,0.0) # this is the omc if you throw out peaks that go over the edge of the spectrum
+    inten = peak_intens[nearest]
+
+    rms_fit = numpy.asarray(rms_fit,dtype=float)
+    score = (omc < score_omc).sum(axis=1)
+    avg = omc.mean(axis=1)+rms_fit
+    real_avg = real_omc.mean(axis=1)+rms_fit
+
+    (theor_ratio,theor_stdev) = inten_figures(theor_inten)
+    (omc_inten_ratio,omc_inten_stdev) = inten_figures(inten)
+    penalty = numpy.ones(len(pred_freqs))
+    penalty += (omc_inten_ratio <= 0.5*theor_ratio[0]) | (omc_inten_ratio >= 1.5*theor_ratio[0])
+    penalty += (omc_inten_stdev <= 0.5*theor_stdev[0]) | (omc_inten_stdev >= 1.5*theor_stdev[0])
+
+    scores = {}
+    scores['omc'] = omc
+    scores['real_omc'] = real_omc
+    scores['inten'] = inten
+    scores['score'] = score
+    scores['avg'] = avg
+    scores['real_avg'] = real_avg
+    scores['penalized_avg'] = avg*penalty
+    return scores
+
+def check_order(theor_inten): # Indices of the check transitions, strongest predicted line first
+    return numpy.argsort(-numpy.asarray(theor_inten,dtype=float),kind='mergesort')
+
+def score_fit_ordered(pred_freqs,rms_fit,peak_freqs,peak_intens,theor_inten,order,cutoff=float('inf'),min_score=0,real_cutoff=0.2,score_omc=2.0):
+
+    """ Scores one fit (pred_freqs is the list of its predicted check transition frequencies) like score_fits, but checks
+    the lines in order and returns None as soon as the fit can't reach min_score lines within score_omc, or neither its avg
+    can come in under cutoff nor its real_avg under real_cutoff."""
+
+    pred_freqs = [float(freq) for freq in pred_freqs]
+    num_checks = len(pred_freqs)
+    omc_sum = 0.0
+    real_sum = 0.0
+    hits = 0
+    for count in range(len(order)):
+        freq = pred_freqs[order[count]]
+        if math.isnan(freq):
+            omc = 100000.0
+        else:
+            index = int(numpy.searchsorted(peak_freqs,freq))
+            omc = min(abs(freq-peak_freqs[max(index-1,0)]),abs(freq-peak_freqs[min(index,len(peak_freqs)-1)]))
+            if peak_freqs[0] <= freq <= peak_freqs[-1]:
+                real_sum += omc
+        omc_sum += omc
+        if omc < score_omc:
+            hits += 1
+        if hits+num_checks-count-1 < min_score:
+            return None
+        if omc_sum/num_checks+rms_fit > cutoff and real_sum/num_checks+rms_fit > real_cutoff:
+            return None
+    return score_fits(numpy.array([pred_freqs]),rms_fit,peak_freqs,peak_intens,theor_inten,score_omc)
+
+def constants_key(A,B,C,tolerance): # A, B and C rounded to multiples of tolerance (MHz), the key fits are recognized as duplicates by
+    return (int(round(float(A)/tolerance)),int(round(float(B)/tolerance)),int(round(float(C)/tolerance)))
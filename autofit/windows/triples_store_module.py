@@ -0,0 +1,251 @@
+import os
+import glob
+import ast
+import numpy
+
+""""
+Triples result store
+
+Please comment any changes you make to the code here:
+
+triples store module:
+-Every fit used to be kept only as a "score = ... Const = ..." text line in final_output%s.txt, and everything that ranks
+or browses the results (fitting_GUI_v11B.run_autofit, omc_reader.py) read those lines back with split() and fixed
+positions.  fit_triples now also appends one fixed-size record per result line to results%s.bin in the job directory
+(numpy structured array, RESULT_DTYPE, written with tofile so the file is append-only), and load_results maps all of them
+with numpy.memmap.  top_results and filter_results work on whole columns, so ranking or cutting down millions of results
+doesn't parse any text.
+
+-load_results gives one memmap per results%s.bin instead of concatenating them, which copied every record of a job with
+more than one process into memory.  top_results and filter_results take that list and work on each mapped file in turn;
+only their (small) results are merged.
+
+-peak_1, peak_2 and peak_3 are indices into the job's peak list sorted by frequency, saved as results_peaks.npy (frequency
+and intensity columns) by the driver; peak_frequencies turns them back into frequencies.
+
+-save_peaks also writes the sorted frequencies and intensities as two contiguous rows to peak_columns.npy, and the
+fit_triples processes map that file read-only (attach_peaks) instead of getting the peak list pickled into their
+arguments and sorting their own copy of it.  Under Windows' spawn every process used to get the whole list through a
+pipe and convert and sort it again; now they share the OS's page cache of one file.
+
+-A record is written together with its final_output line, so the two always hold the same fits.  When a checkpointed run
+is resumed, triples_checkpoint_module.rewind_outputs cuts results%s.bin (and evaluated%s.bin) back to their sizes at the
+last finished chunk, like final_output%s.txt.
+
+-Index of evaluated triples: fit_triples also appends the frequencies of every triple it fitted (kept, dropped or unphysical)
+to evaluated%s.bin at the same points it writes final_output%s.txt.  A new search started in a job directory that already
+has an index (the GUI or prog_A relaunched with the same job name, e.g. after widening the windows) only fits the triples
+that aren't in it, skip_evaluated, and its results are merged with the old ones.  evaluated_counts is the snapshot of the
+index a search skips; it goes into checkpoint_info.txt so a resumed rerun skips exactly the same triples.
+
+-The index only says which peak frequencies were fitted, so it can only be reused by a search that would have fitted
+them the same way.  start_search keeps the search's fitting transitions, check transitions, guess constants and engine
+(search_identity) in evaluated_search.txt next to the index, and a new search is only incremental if they match.  If
+they don't, the earlier search's outputs (final_output, results, the index, checkpoints, hits, rankings; ARCHIVE_FILES)
+are moved to previous_search<n> and the new search starts from nothing.
+
+"""
+
+RESULT_DTYPE = numpy.dtype([('peak_1','<i4'),('peak_2','<i4'),('peak_3','<i4'),('A','<f8'),('B','<f8'),('C','<f8'),('rms_fit','<f8'),
+                            ('score','<i4'),('avg','<f8'),('real_avg','<f8'),('penalized_avg','<f8')])
+STORE_FILE = "results%s.bin"
+PEAKS_FILE = "results_peaks.npy"
+PEAK_COLUMNS_FILE = "peak_columns.npy" # Sorted frequencies and intensities as rows, mapped by the fit_triples processes
+EVALUATED_DTYPE = numpy.dtype([('freq_1','<f8'),('freq_2','<f8'),('freq_3','<f8')])
+EVALUATED_FILE = "evaluated%s.bin"
+SEARCH_FILE = "evaluated_search.txt" # search_identity of the searches the evaluated index belongs to
+ARCHIVE_FILES = ["final_output*.txt",STORE_FILE%("*"),PEAKS_FILE,EVALUATED_FILE%("*"),SEARCH_FILE,"completed_chunks*.txt","partial_best*.txt",
+                 "interim_good_output*.txt","hits*.txt","multiplicity*.txt","fit_multiplicity*.txt","skipped*.txt","cascade_stats*.txt",
+                 "screen_stats.txt","cascade_report.txt","sorted_*omc_cat*.txt","best100*.txt"] # A search's outputs, moved away when the next one can't build on them
+
+def save_peaks(peaklist,job_dir="."): # The peak list sorted by frequency, which the records' peak indices point into, and its columns for attach_peaks
+    peaks = numpy.asarray(peaklist,dtype=float)
+    peaks = peaks[numpy.argsort(peaks[:,0],kind='mergesort')]
+    numpy.save(os.path.join(job_dir,PEAKS_FILE),peaks)
+    numpy.save(os.path.join(job_dir,PEAK_COLUMNS_FILE),numpy.ascontiguousarray(peaks.T))
+
+def attach_peaks(job_dir="."): # (peak_freqs,peak_intens) as triples_scoring_module.sorted_peaks gives them, read-only views of the mapped PEAK_COLUMNS_FILE
+    columns = numpy.load(os.path.join(job_dir,PEAK_COLUMNS_FILE),mmap_mode='r')
+    return numpy.asarray(columns[0]),numpy.asarray(columns[1])
+
+def append_results(file_num,records): # Appends a list of record tuples (RESULT_DTYPE field order) to results%s.bin
+    if records == []:
+        return
+    fh = open(STORE_FILE%(str(file_num)),"ab")
+    numpy.array(records,dtype=RESULT_DTYPE).tofile(fh)
+    fh.close()
+
+def rewind_results(file_num,num_records): # Cuts results%s.bin back to its first num_records records
+    filename = STORE_FILE%(str(file_num))
+    if os.path.exists(filename):
+        fh = open(filename,"r+b")
+        fh.truncate(num_records*RESULT_DTYPE.itemsize)
+        fh.close()
+
+def load_results(job_dir="."):
+
+    """ Every record in the job directory's results%s.bin files, as a list of read-only memmaps, one per file (sorted by
+    name), for top_results and filter_results.  A record cut short by a crash at the end of a file is left out."""
+
+    parts = []
+    for filename in sorted(glob.glob(os.path.join(job_dir,STORE_FILE%("*")))):
+        num_records = os.path.getsize(filename)//RESULT_DTYPE.itemsize
+        if num_records > 0:
+            parts.append(numpy.memmap(filename,dtype=RESULT_DTYPE,mode='r',shape=(num_records,)))
+    return parts
+
+def _merge(parts): # One array of the (small) per-file results
+    if parts == []:
+        return numpy.zeros(0,dtype=RESULT_DTYPE)
+    return numpy.concatenate(parts)
+
+def top_results(results,column="penalized_avg",count=100,largest=False):
+
+    """ The count records with the smallest values of column (largest=True for the largest, e.g. score), best first.
+    results is an array of records or a list of them (load_results), taken in order.  Equal values keep the order they
+    have in results, and of the ones tied at the cut the first are kept, so a list gives the same records as its files
+    would concatenated."""
+
+    if isinstance(results,list): # Each file's best count, then the best count of those
+        return top_results(_merge([top_results(part,column,count,largest) for part in results]),column,count,largest)
+    values = numpy.asarray(results[column])
+    if largest:
+        values = -values
+    if count <= 0:
+        index = numpy.zeros(0,dtype=int)
+    elif count < len(values):
+        cutoff = values[numpy.argpartition(values,count-1)[count-1]] # The count-th smallest value
+        index = numpy.nonzero(values < cutoff)[0]
+        index = numpy.concatenate((index,numpy.nonzero(values == cutoff)[0][0:count-len(index)])) # The first of the ties at the cut
+        index = index[numpy.lexsort((index,values[index]))]
+    else:
+        index = numpy.argsort(values,kind='mergesort')
+    return results[index]
+
+def filter_results(results,**ranges):
+
+    """ The records whose columns fall inside the given (low,high) ranges, e.g. filter_results(results,A=(3000,3100),
+    avg=(None,1.0)); None leaves that end open.  results is an array of records or a list of them (load_results);
+    the records kept are returned as one array."""
+
+    if isinstance(results,list):
+        return _merge([filter_results(part,**ranges) for part in results])
+    keep = numpy.ones(len(results),dtype=bool)
+    for column in ranges:
+        (low,high) = ranges[column]
+        if low != None:
+            keep &= results[column] >= low
+        if high != None:
+            keep &= results[column] <= high
+    return results[keep]
+
+def peak_frequencies(records,job_dir="."): # (n,3) frequencies of the three fitted peaks of each record
+    peaks = numpy.load(os.path.join(job_dir,PEAKS_FILE))
+    return peaks[numpy.column_stack((records['peak_1'],records['peak_2'],records['peak_3'])),0]
+
+def result_line(record): # The record as a final_output line
+    score = str(record['score'])
+    if int(score)<10:
+        score = '0'+score
+    return 'score = '+' '+score+' '+"Const = "+str(float(record['A']))+' '+str(float(record['B']))+' '+str(float(record['C']))+' '+"average omc = "+str(float(record['avg']))+'  '+\
+           "avg w/out peaks over edge = "+str(float(record['real_avg']))+' '+"avg w/ inten penalty = "+str(float(record['penalized_avg']))+"\n"
+
+def append_evaluated(file_num,triples): # Appends (freq_1,freq_2,freq_3) of fitted triples to evaluated%s.bin
+    if triples == []:
+        return
+    fh = open(EVALUATED_FILE%(str(file_num)),"ab")
+    numpy.array(triples,dtype=EVALUATED_DTYPE).tofile(fh)
+    fh.close()
+
+def evaluated_counts(job_dir="."): # {file name: records} of the evaluated%s.bin files, empty if nothing has been fitted here yet
+    counts = {}
+    for filename in sorted(glob.glob(os.path.join(job_dir,EVALUATED_FILE%("*")))):
+        num_records = os.path.getsize(filename)//EVALUATED_DTYPE.itemsize
+        if num_records > 0:
+            counts[os.path.basename(filename)] = int(num_records)
+    return counts
+
+def load_evaluated(counts,job_dir="."):
+
+    """ The first counts[name] records of each evaluated file, as a sorted array of distinct raw 24 byte keys for
+    skip_evaluated (24 bytes a triple instead of a set of tuples, which wouldn't fit in memory for a large job)."""
+
+    parts = [numpy.fromfile(os.path.join(job_dir,name),dtype=EVALUATED_DTYPE,count=counts[name]) for name in sorted(counts)]
+    if parts == []:
+        return numpy.zeros(0,dtype='V%s'%(EVALUATED_DTYPE.itemsize))
+    return numpy.unique(numpy.concatenate(parts).view('V%s'%(EVALUATED_DTYPE.itemsize)))
+
+def skip_evaluated(triples,evaluated,block_size=4096):
+
+    """ Passes on the triples (best_first_triples entries) whose three frequencies aren't in evaluated, in the same order,
+    looking them up a block at a time."""
+
+    block = []
+    for triple in triples:
+        block.append(triple)
+        if len(block) == block_size:
+            for kept in _unevaluated(block,evaluated):
+                yield kept
+            block = []
+    for kept in _unevaluated(block,evaluated):
+        yield kept
+
+def _unevaluated(block,evaluated):
+    if block == [] or len(evaluated) == 0:
+        return block
+    keys = numpy.array([(float(entry[0]),float(entry[2]),float(entry[4])) for entry in block],dtype=EVALUATED_DTYPE).view(evaluated.dtype)
+    index = numpy.searchsorted(evaluated,keys)
+    index[index == len(evaluated)] = 0
+    found = evaluated[index] == keys
+    return [block[x] for x in range(len(block)) if not found[x]]
+
+def search_identity(trans_1,trans_2,trans_3,check_peaks,constants,engine,fixed_flags=None): # What a search has to share with the earlier one to reuse its evaluated index
+    identity = {'trans_1':tuple(trans_1),'trans_2':tuple(trans_2),'trans_3':tuple(trans_3),'check_peaks':[tuple(entry) for entry in check_peaks],
+                'constants':[str(value) for value in constants],'engine':engine}
+    if fixed_flags != None:
+        identity['fixed_flags'] = [bool(flag) for flag in fixed_flags]
+    return ast.literal_eval(repr(identity)) # As it reads back from SEARCH_FILE
+
+def read_search(job_dir="."): # The search_identity saved by start_search, None if there isn't one
+    if not os.path.exists(os.path.join(job_dir,SEARCH_FILE)):
+        return None
+    fh = open(os.path.join(job_dir,SEARCH_FILE))
+    text = fh.read()
+    fh.close()
+    try:
+        return ast.literal_eval(text.strip())
+    except (ValueError,SyntaxError):
+        return None
+
+def archive_search(job_dir="."): # Moves the outputs of the earlier search to previous_search<n>; returns its name, None if there was nothing
+    filenames = []
+    for pattern in ARCHIVE_FILES:
+        filenames += [filename for filename in glob.glob(os.path.join(job_dir,pattern)) if filename not in filenames]
+    if filenames == []:
+        return None
+    num = 1
+    while os.path.exists(os.path.join(job_dir,"previous_search%s"%(num))):
+        num += 1
+    folder = os.path.join(job_dir,"previous_search%s"%(num))
+    os.mkdir(folder)
+    for filename in filenames:
+        os.rename(filename,os.path.join(folder,os.path.basename(filename)))
+    return folder
+
+def start_search(identity,job_dir="."):
+
+    """ Starts a new search in job_dir.  If the earlier search there had the same identity (search_identity), returns its
+    evaluated_counts so the new one only fits the triples it didn't (incremental rerun).  Otherwise the earlier search's
+    outputs are archived (archive_search) and {} is returned.  identity is saved either way."""
+
+    counts = evaluated_counts(job_dir)
+    if counts and read_search(job_dir) != identity:
+        folder = archive_search(job_dir)
+        print("The earlier search in this folder used other transitions, check transitions, constants or engine; its results were moved to %s."%(folder))
+        counts = {}
+    elif not counts:
+        archive_search(job_dir) # Nothing was fitted, but whatever an earlier search left isn't this one's
+    fh = open(os.path.join(job_dir,SEARCH_FILE),"w")
+    fh.write("%s\n"%(repr(identity)))
+    fh.close()
+    return counts
@@ -0,0 +1,128 @@
+import os
+import glob
+import time
+import math
+import json
+import shutil
+import platform
+import itertools
+import multiprocessing
+from multiprocessing import Process
+import triples_queue_module
+import triples_progress_module
+
+""""
+Triples search timing
+
+Please comment any changes you make to the code here:
+
+triples timing module:
+-prog_A's time_estimate() timed 25 SPCAT runs and divided by the number of cores, which has little to do with what a
+triple costs (an SPFIT run, reading its output and scoring the check lines, on the processes the search actually uses),
+so the "roughly X hours" in triples_gen was often far off.  calibrate now times the real fit_triples on the first triples
+of the actual windows with the planned number of processes, in a scratch folder that is removed afterwards.  The time is
+taken from when every process has finished its first triple, so starting the processes (slow on Windows) isn't counted,
+and only the triples finished after that are.  (The count used to take each process's first triple as still running
+then, but a process only reports a triple after its fit, so that was one triple too many per process and the seconds
+per triple, which are kept for every later estimate, came out too low.  fit_triples reports each of its first
+triples_progress_module.REPORT_EVERY triples, so a process that is ahead isn't counted short at that point either.)
+
+-Timings are kept per machine in TIMING_FILE in the home directory, one entry (seconds per triple for the whole pool) per
+host, engine and number of processes.  Once there's an entry the calibration run is skipped, and every search that
+finishes updates its entry from the throughput it actually got (ProgressReporter with timing_key), so the estimates keep
+calibrating themselves.  The stored value is also the ETA the progress reporter shows before the search has a rate of
+its own.
+
+"""
+
+TIMING_FILE = os.path.join(os.path.expanduser("~"),".autofit_timing.json")
+CALIBRATION_TRIPLES = 8 # Triples per process in a calibration run
+CALIBRATION_FOLDER = "calibration"
+ENGINE_FILES = ("SPFIT*","SPCAT*") # Copied into the calibration folder
+
+def timing_key(engine,processors):
+    return "%s engine=%s processors=%s"%(platform.node(),engine,int(processors))
+
+def load_timing():
+    if not os.path.exists(TIMING_FILE):
+        return {}
+    try:
+        fh = open(TIMING_FILE)
+        timing = json.load(fh)
+        fh.close()
+    except ValueError: # Cut short by a crash; it's only a cache
+        timing = {}
+    return timing
+
+def stored_seconds(key): # Seconds per triple stored for key, None if this machine hasn't timed it yet
+    return load_timing().get(key)
+
+def store_seconds(key,seconds):
+
+    """ Updates the stored seconds per triple for key with a new measurement (the mean of the two if there was one, so
+    one odd run doesn't throw it off)."""
+
+    timing = load_timing()
+    if timing.get(key) != None:
+        seconds = 0.5*(timing[key]+seconds)
+    timing[key] = seconds
+    try:
+        fh = open(TIMING_FILE,"w")
+        json.dump(timing,fh,indent=1,sort_keys=True)
+        fh.close()
+    except IOError:
+        pass
+
+def calibrate(target,make_args,triples,processors,key=None):
+
+    """ Seconds per triple of a search with processors processes running target (a fit_triples), measured on the first
+    CALIBRATION_TRIPLES*processors of triples in a scratch folder.  make_args(num,task_queue,progress) gives the args of
+    process num.  The result is stored under key.  Returns None if there are no triples."""
+
+    sample = list(itertools.islice(triples,CALIBRATION_TRIPLES*int(processors)))
+    if sample == []:
+        return None
+
+    cwd = os.getcwd()
+    scratch = os.path.join(cwd,CALIBRATION_FOLDER)
+    if os.path.isdir(scratch):
+        shutil.rmtree(scratch)
+    os.mkdir(scratch)
+    for pattern in ENGINE_FILES:
+        for filename in glob.glob(pattern):
+            if os.path.isfile(filename):
+                shutil.copy(filename,scratch)
+    os.chdir(scratch)
+    try:
+        task_queue = multiprocessing.Queue(len(sample)+int(processors))
+        progress = triples_progress_module.new_counters(processors)
+        workers = []
+        for num in range(int(processors)):
+            workers.append(Process(target=target,args=make_args(num,task_queue,progress)))
+        for worker in workers:
+            worker.start()
+        triples_queue_module.feed_queue(task_queue,sample,int(processors),workers,chunk_size=1,check_pause=False)
+
+        while min(list(progress[0])) < 1 and sum(list(progress[0])) < len(sample) and [worker for worker in workers if worker.is_alive()]:
+            time.sleep(0.01) # Until every process has finished its first triple
+        start = time.time()
+        fitted = len(sample)-sum(list(progress[0])) # Finished from start on; a process only reports a triple once its fit is done
+        for worker in workers:
+            worker.join()
+        seconds = (time.time()-start)/max(fitted,1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch,True)
+
+    if key != None:
+        store_seconds(key,seconds)
+    return seconds
+
+def format_estimate(seconds): # "n seconds/minutes/hours/days", as in the triples_gen dialog
+    if seconds <= 90:
+        return str(int(seconds)) + " seconds"
+    elif seconds <= 5400:
+        return str(int(math.ceil(seconds/60.0))) + " minutes"
+    elif seconds <= 129600:
+        return str(int(math.ceil(seconds/3600.0))) + " hours"
+    return str(int(math.ceil(seconds/86400.0))) + " days"
@@ -0,0 +1,122 @@
+import os
+import time
+import multiprocessing
+try:
+    import psutil # Optional, only used to pin processes to CPUs where os.sched_setaffinity isn't there (Windows, Python 2)
+except ImportError:
+    psutil = None
+
+""""
+Adaptive number of triples processes
+
+Please comment any changes you make to the code here:
+
+triples workers module:
+-"processors" used to be the number of fit_triples processes, full stop.  What a triple costs is mostly starting SPFIT
+and writing and reading its files, so the best number of processes depends on the disk and the OS as much as on the
+cores, and it's often not the core count.  With adaptive_workers on, the drivers start processors processes (the most
+they may use), and a shared limit (new_limit) says how many of them take chunks off the queue: process file_num waits
+in wait_active while file_num >= the limit.  WorkerController, polled by the driver's ProgressReporter, measures the
+total rate from the shared progress counters every interval seconds and moves the limit one step at a time (hill
+climbing): on while the rate goes up by more than MIN_GAIN, back to the better level and the other way when it doesn't.
+After the second turn it settles on the best level it measured.  feed_queue opens the limit (release) before it puts
+the stop markers on the queue, so every process gets one.
+
+-pin_cpus pins process file_num to CPU file_num (mod the CPU count) with os.sched_setaffinity, or psutil if that's
+installed and there's no sched_setaffinity.  Without either it does nothing.
+
+"""
+
+INTERVAL = 30.0 # Seconds the rate is measured over at each level
+MIN_GAIN = 0.03 # Relative rate increase a step needs to count as better
+IDLE_SLEEP = 0.2 # Seconds between an idle process's checks of the limit
+
+def new_limit(processors,start=None): # Shared number of processes allowed to take chunks, start = the CPU count (at most processors) by default
+    if start == None:
+        start = min(int(processors),multiprocessing.cpu_count())
+    return multiprocessing.RawValue('i',max(1,int(start)))
+
+def wait_active(limit,file_num): # Worker side: returns once process file_num is allowed to take a chunk
+    if limit == None:
+        return
+    while file_num >= limit.value:
+        time.sleep(IDLE_SLEEP)
+
+def pin_cpu(file_num): # Pins this process to one CPU; True if it could
+    cpus = multiprocessing.cpu_count()
+    try:
+        if hasattr(os,"sched_setaffinity"):
+            os.sched_setaffinity(0,[int(file_num)%cpus])
+            return True
+        if psutil != None:
+            psutil.Process().cpu_affinity([int(file_num)%cpus])
+            return True
+    except (OSError,ValueError,AttributeError): # Fewer CPUs allowed to this process than there are, or not supported here
+        pass
+    return False
+
+class WorkerController:
+
+    """ Driver side: moves limit (new_limit) between 1 and processors towards the number of active processes with the
+    highest rate of triples, read from counters (triples_progress_module.new_counters)."""
+
+    def __init__(self,limit,counters,processors,interval=None,min_gain=None):
+        self.limit = limit
+        self.counters = counters
+        self.processors = int(processors)
+        self.interval = interval
+        if interval == None:
+            self.interval = INTERVAL
+        self.min_gain = min_gain
+        if min_gain == None:
+            self.min_gain = MIN_GAIN
+        self.rates = {} # Level: last rate measured there
+        self.previous = None # Level before the current one, if the current one is to be compared with it
+        self.direction = 1
+        self.turns = 0
+        self.settled = False
+        self.last_time = time.time()
+        self.last_done = sum(list(counters[0]))
+
+    def poll(self): # Measures the rate at the current level once interval has gone by, and picks the next level
+        now = time.time()
+        if self.settled or now-self.last_time < self.interval:
+            return
+        done = sum(list(self.counters[0]))
+        rate = (done-self.last_done)/(now-self.last_time)
+        self.last_time = now
+        self.last_done = done
+
+        level = self.limit.value
+        self.rates[level] = rate
+        if self.previous == None or rate > self.rates[self.previous]*(1.0+self.min_gain):
+            (self.previous,next_level) = (level,level+self.direction)
+            if next_level < 1 or next_level > self.processors: # At the end of the range: the other way
+                self.turns += 1
+                self.direction = -self.direction
+                next_level = level+self.direction
+        else: # No better than the level before: go back there and try the other way from it
+            self.turns += 1
+            self.direction = -self.direction
+            (self.previous,next_level) = (None,self.previous)
+        if self.turns >= 2 or next_level < 1 or next_level > self.processors:
+            next_level = max([(self.rates[key],key) for key in self.rates])[1]
+            self.settled = True
+        self.limit.value = next_level
+
+    def release(self): # Lets every process take chunks again, so each gets its stop marker; no more changes after this
+        self.settled = True
+        self.limit.value = self.processors
+
+    def level(self):
+        return self.limit.value
+
+def adaptive(processors,counters,adaptive_workers):
+
+    """ (limit,controller) for a search with processors processes, or (None,None) if adaptive_workers is off.  limit goes
+    to the fit_triples processes, controller to the ProgressReporter and feed_queue."""
+
+    if not adaptive_workers:
+        return None,None
+    limit = new_limit(processors)
+    return limit,WorkerController(limit,counters,processors)
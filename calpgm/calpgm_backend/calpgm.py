@@ -11,7 +11,13 @@ import numpy as np
 import time
 import struct
 import fileinput
+import hashlib
+from collections import OrderedDict
 from matplotlib import pyplot as pp
+try:
+	import calpgm_lib # SPCAT/SPFIT in this process (engine='lib'), needs libcalpgm.so from "make lib" in calpgm/src
+except ImportError:
+	calpgm_lib = None
 
 class InitializeError(Exception):
 	def __init__(self,value):
@@ -153,6 +159,8 @@ class calpgm(object):
 	# - reduction: 'a' or 's' (specifies which watson reduction to use, default 'a')
 	# - J_min/J_max : min/max J for predictions (0/20 default)
 	# - inten: intensity cutoff (log strength, default -10.0)
+	# - engine: 'exe' runs the spcat/spfit executables (default), 'lib' runs them in this process from libcalpgm.so (calpgm_lib)
+	# - cache_dir: folder SPCAT predictions are also kept in (see spcat.run_spcat), so other processes and later sessions reuse them
 	def __init__(self,**kwargs):
 
 		self.name = "molecule"
@@ -166,6 +174,8 @@ class calpgm(object):
 		self.J_max = 20
 		self.inten = -10.0
 		self.temp = 2.0
+		self.engine = 'exe'
+		self.cache_dir = None
 
 		print 'CALPGM constructor initialized\n'
 		#self.spin = self.spincalc(self.spin)
@@ -206,6 +216,12 @@ class calpgm(object):
 				elif key == 'inten' or key == 'intensity':
 					self. inten = value
 
+				elif key == 'engine':
+					self.engine = value
+
+				elif key == 'cache_dir':
+					self.cache_dir = value
+
 				elif key == 'new_params':
 					try:
 						if isinstance(value,dict):
@@ -242,6 +258,10 @@ class calpgm(object):
 
 class spcat(calpgm):
 
+	# SPCAT predictions by md5 of the var and int text, shared by every spcat object in this process (least recently used dropped first)
+	CACHE_SIZE = 256
+	cat_cache = OrderedDict()
+
 	def qrotcalc(self):
 	# Calculates pure, low-temp-approx rotational partition function
 		A = self.current_vals_rigid[0]
@@ -346,6 +366,7 @@ class spcat(calpgm):
 	# v = 'cur' / 'current' / 'c' <--- DEFAULT. runs SPCAT on current var/int in spcat() object, self.cur_var and self.cur_int
 	# update = 1 / 0 (default = 0). If set to 1, execute will rerun to_var() and to_int(). This is essential if you update a variable in the class object, such as dipoles or the temperature,
 	# and want to get a new prediction. 
+	# engine = 'exe' / 'lib' <--- overrides the class engine; 'lib' runs SPCAT in this process (calpgm_lib) instead of ./spcat
 
 		try:
 			if 'filename' in kwargs:
@@ -367,9 +388,7 @@ class spcat(calpgm):
 						self.to_file(type='var',filename=output_name,v='i')
 						self.to_file(type='int',filename=output_name,v='i')
 
-						# For *nix systems:
-						a = subprocess.Popen("./spcat "+output_name,stdout=subprocess.PIPE,shell=True)
-						a.stdout.read()
+						self.run_spcat(output_name,self.init_var,self.init_int,kwargs.get('engine',self.engine))
 						
 
 					if self.init_int == "" or self.init_var == "":
@@ -388,9 +407,7 @@ class spcat(calpgm):
 						self.to_file(type='var',filename=output_name,v='c')
 						self.to_file(type='int',filename=output_name,v='c')
 						
-						# For *nix systems:
-						a = subprocess.Popen("./spcat "+output_name,stdout=subprocess.PIPE,shell=True)
-						a.stdout.read()
+						self.run_spcat(output_name,self.cur_var,self.cur_int,kwargs.get('engine',self.engine))
 						
 
 					if self.cur_int == "" or self.cur_var == "":
@@ -402,6 +419,66 @@ class spcat(calpgm):
 
 
 
+	def run_spcat(self, output_name, var, int_file, engine):
+	# Writes output_name.cat for the var and int strings (also in output_name.var/.int): with ./spcat, or in this process
+	# from libcalpgm.so if engine is 'lib'. A var/int that was predicted before (cat_cache, or cache_dir) isn't run again,
+	# the .cat from then is written instead.
+
+		key = hashlib.md5(var+'\0'+int_file).hexdigest()
+		cat = self.cached_cat(key)
+		if cat != None:
+			output = open(output_name+'.cat','wb')
+			output.write(cat)
+			output.close()
+			return
+
+		if os.path.isfile(output_name+'.cat'): # A failed run mustn't leave the last .cat to be stored under this key
+			os.remove(output_name+'.cat')
+		if engine == 'lib':
+			if calpgm_lib == None:
+				raise ExecuteError('engine lib needs calpgm_lib.py and libcalpgm.so ("make lib" in calpgm/src)')
+			try:
+				cat = calpgm_lib.predict(var,int_file)
+			except calpgm_lib.CalpgmLibError as e:
+				raise ExecuteError(e.args[0])
+			output = open(output_name+'.cat','wb')
+			output.write(cat)
+			output.close()
+		else:
+			# For *nix systems:
+			a = subprocess.Popen("./spcat "+output_name,stdout=subprocess.PIPE,shell=True)
+			a.stdout.read()
+		if os.path.isfile(output_name+'.cat'):
+			f = open(output_name+'.cat','rb')
+			self.store_cat(key,f.read())
+			f.close()
+
+	def cached_cat(self, key):
+	# Text of the .cat stored for key, None if there is none
+
+		if key in spcat.cat_cache:
+			cat = spcat.cat_cache.pop(key)
+			spcat.cat_cache[key] = cat
+			return cat
+		if self.cache_dir != None and os.path.isfile(os.path.join(self.cache_dir,key+'.cat')):
+			f = open(os.path.join(self.cache_dir,key+'.cat'),'rb')
+			cat = f.read()
+			f.close()
+			self.store_cat(key,cat)
+			return cat
+		return None
+
+	def store_cat(self, key, cat):
+		spcat.cat_cache[key] = cat
+		while len(spcat.cat_cache) > spcat.CACHE_SIZE:
+			spcat.cat_cache.popitem(last=False)
+		if self.cache_dir != None and not os.path.isfile(os.path.join(self.cache_dir,key+'.cat')):
+			if not os.path.isdir(self.cache_dir):
+				os.makedirs(self.cache_dir)
+			output = open(os.path.join(self.cache_dir,key+'.cat'),'wb')
+			output.write(cat)
+			output.close()
+
 	def read_cat(self, **kwargs):
 	# Returns a list of lists (cat[i][j]) with the following info extracted from cat file
 	# - cat[i][0] : freq  <--- frequency of transition in MHz
@@ -905,16 +982,59 @@ class spfit(spcat):
 
 		else:
 			f = open(str(self.filename)+".lin",'wb')
-			fmt = "%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%17s%13s%10s"
-			for entry in self.linelist:
-				if self.spin == 1:
-					f.write(fmt %(str(entry[0]),str(entry[1]),str(entry[2]),str(entry[3]),str(entry[4]),str(entry[5]),"0","0","0","0","0","0",str(entry[6]),str(self.line_uncert),"1.00000"))
-					f.write("\n")
-				elif self.spin != 1:
-					f.write(fmt %(str(entry[0]),str(entry[1]),str(entry[2]),str(entry[3]),str(entry[4]),str(entry[5]),str(entry[6]),str(entry[7]),"0","0","0","0",str(entry[8]),str(self.line_uncert),"1.00000"))
-					f.write("\n")
+			f.write(self.lin_text())
 			f.close()
 
+	# LIN file contents for the linelist
+	def lin_text(self):
+		lin = ""
+		fmt = "%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%3s%17s%13s%10s"
+		for entry in self.linelist:
+			if self.spin == 1:
+				lin += fmt %(str(entry[0]),str(entry[1]),str(entry[2]),str(entry[3]),str(entry[4]),str(entry[5]),"0","0","0","0","0","0",str(entry[6]),str(self.line_uncert),"1.00000")
+				lin += "\n"
+			elif self.spin != 1:
+				lin += fmt %(str(entry[0]),str(entry[1]),str(entry[2]),str(entry[3]),str(entry[4]),str(entry[5]),str(entry[6]),str(entry[7]),"0","0","0","0",str(entry[8]),str(self.line_uncert),"1.00000")
+				lin += "\n"
+		return lin
+
+	def execute(self, **kwargs):
+	# Runs SPFIT with the current var as the .par and the linelist as the .lin, and leaves filename.var and filename.fit
+	# (for read_fit). Takes filename=" " and engine='exe' / 'lib' like spcat.execute; with 'lib' SPFIT runs in this process
+	# (calpgm_lib) and only the .var and .fit are written.
+
+		try:
+			if 'filename' in kwargs:
+				output_name = kwargs['filename']
+			else:
+				output_name = self.filename
+
+			if self.cur_var == "" or not self.linelist:
+				raise ExecuteError('Empty var or linelist during execute step')
+
+			if kwargs.get('engine',self.engine) == 'lib':
+				if calpgm_lib == None:
+					raise ExecuteError('engine lib needs calpgm_lib.py and libcalpgm.so ("make lib" in calpgm/src)')
+				try:
+					(var, fit) = calpgm_lib.fit(self.cur_var,self.lin_text())
+				except calpgm_lib.CalpgmLibError as e:
+					raise ExecuteError(e.args[0])
+				for (extension, text) in (('.var',var),('.fit',fit)):
+					output = open(output_name+extension,'wb')
+					output.write(text)
+					output.close()
+			else:
+				for (extension, text) in (('.par',self.cur_var),('.lin',self.lin_text())):
+					output = open(output_name+extension,'wb')
+					output.write(text)
+					output.close()
+				# For *nix systems:
+				a = subprocess.Popen("./spfit "+output_name,stdout=subprocess.PIPE,shell=True)
+				a.stdout.read()
+
+		except ExecuteError as e:
+			self.error_message("ExecuteError",e.value,1)
+
 
 
 	def __init__(self,**kwargs):
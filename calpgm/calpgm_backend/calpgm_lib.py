@@ -0,0 +1,119 @@
+import os
+import ctypes
+
+""""
+SPFIT and SPCAT in the calling process (libcalpgm.so)
+
+Please comment any changes you make to the code here:
+
+calpgm lib:
+-Running the SPFIT or SPCAT executable costs a process start and a round trip through files on disk every time.
+"make lib" in calpgm/src builds libcalpgm.so from the same sources, with SPFIT and SPCAT as functions that read and write
+their files in memory (calpgmlib.c).  predict(var,int) runs SPCAT on the text of a .var and .int and returns the .cat
+text, and fit(par,lin) runs SPFIT and returns the text of the .var and .fit it writes.  Nothing touches the disk and
+no process is started.
+
+-The library is looked for in CALPGM_LIB (a path), next to this file and in the current folder.  It needs glibc, so
+there's no Windows build; available() says whether it could be loaded, and callers fall back on the executables.
+
+-One run at a time per process (the programs keep state in globals), which is how the fit_triples processes use it.
+
+"""
+
+LIBRARY_NAME = "libcalpgm.so"
+FILE_NAME = "calpgm" # Name of the in-memory files, calpgm.var, calpgm.int and so on
+
+class CalpgmLibError(Exception):
+    pass
+
+_lib = None
+
+def library_paths():
+    paths = []
+    if os.environ.get("CALPGM_LIB"):
+        paths.append(os.environ["CALPGM_LIB"])
+    paths.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),LIBRARY_NAME))
+    paths.append(os.path.join(os.getcwd(),LIBRARY_NAME))
+    return paths
+
+def load():
+
+    """ The loaded libcalpgm.so; raises CalpgmLibError if it can't be found or loaded."""
+
+    global _lib
+    if _lib != None:
+        return _lib
+    errors = []
+    for path in library_paths():
+        if not os.path.isfile(path):
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError as error:
+            errors.append("%s: %s"%(path,error))
+            continue
+        lib.calpgm_put.argtypes = [ctypes.c_char_p,ctypes.c_char_p,ctypes.c_size_t]
+        lib.calpgm_put.restype = ctypes.c_int
+        lib.calpgm_get.argtypes = [ctypes.c_char_p,ctypes.POINTER(ctypes.c_size_t)]
+        lib.calpgm_get.restype = ctypes.c_void_p
+        lib.calpgm_run.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_int]
+        lib.calpgm_run.restype = ctypes.c_int
+        lib.calpgm_reset.argtypes = []
+        lib.calpgm_reset.restype = None
+        _lib = lib
+        return _lib
+    raise CalpgmLibError("%s not found or not loadable (build it with \"make lib\" in calpgm/src) %s"%(LIBRARY_NAME," ".join(errors)))
+
+def available(): # Whether the library can be used here
+    try:
+        load()
+        return True
+    except CalpgmLibError:
+        return False
+
+def _bytes(text):
+    if isinstance(text,bytes):
+        return text
+    return text.encode("latin-1")
+
+def _text(data):
+    if str is bytes: # Python 2
+        return data
+    return data.decode("latin-1")
+
+def put(name,text): # Gives the next run the file name with contents text
+    data = _bytes(text)
+    if load().calpgm_put(_bytes(name),data,len(data)) != 0:
+        raise CalpgmLibError("no room for %s"%(name))
+
+def get(name): # Text of the file name the last run wrote, None if it didn't
+    length = ctypes.c_size_t(0)
+    address = load().calpgm_get(_bytes(name),ctypes.byref(length))
+    if not address:
+        return None
+    return _text(ctypes.string_at(address,length.value))
+
+def run(program,inputs,outputs,quiet=True):
+
+    """ Runs program ("spcat" or "spfit") on inputs {extension: text} and returns {extension: text} of the outputs it
+    wrote (extensions in outputs).  Raises CalpgmLibError if it stops with an error or doesn't write one of them."""
+
+    lib = load()
+    lib.calpgm_reset()
+    for extension in inputs:
+        put("%s.%s"%(FILE_NAME,extension),inputs[extension])
+    status = lib.calpgm_run(int(program == "spcat"),_bytes(FILE_NAME),int(quiet))
+    results = {}
+    for extension in outputs:
+        results[extension] = get("%s.%s"%(FILE_NAME,extension))
+    missing = [extension for extension in outputs if results[extension] == None]
+    if status != 0 or missing != []:
+        raise CalpgmLibError("%s stopped with status %s without writing %s"%(program,status," ".join(["."+extension for extension in missing])))
+    return results
+
+def predict(var,int_file,quiet=True): # SPCAT: text of the .cat for the .var and .int texts
+    return run("spcat",{"var":var,"int":int_file},["cat"],quiet)["cat"]
+
+def fit(par,lin,quiet=True): # SPFIT: (.var, .fit) texts for the .par and .lin texts
+    results = run("spfit",{"par":par,"lin":lin},["var","fit"],quiet)
+    return results["var"],results["fit"]
@@ -0,0 +1,216 @@
+/*   calpgmlib.c: SPFIT and SPCAT as functions of a shared library (make lib)
+
+     The CALPGM sources are compiled unchanged.  For the library the Makefile
+     renames their main to calfit_main and calcat_main, and their exit, fopen,
+     fclose and tmpfile to the calpgm_ functions below:
+       - exit returns to calpgm_run instead of ending the calling process,
+       - files given with calpgm_put are read from memory, and every file the
+         program writes goes to memory, where calpgm_get finds it,
+       - streams the program leaves open (when it stops early) are closed.
+     fmemopen and open_memstream are POSIX 2008 (glibc), so this is not for
+     Windows.  One run at a time per process.
+*/
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <setjmp.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+int calfit_main(int argc, char *argv[]);
+int calcat_main(int argc, char *argv[]);
+
+#define NMEMFILE 32
+#define NSTREAM 64
+
+typedef struct {
+  char *name;          /* file name as the program opens it */
+  char *data;          /* contents */
+  size_t len;
+  FILE *writer;        /* open_memstream stream while it is being written */
+} MEMFILE;
+
+typedef struct {
+  FILE *stream;
+  char *copy;          /* contents being read (fmemopen), NULL for a real file */
+  MEMFILE *file;       /* file being written (open_memstream), NULL otherwise */
+} OPENSTREAM;
+
+static MEMFILE memfiles[NMEMFILE];
+static OPENSTREAM streams[NSTREAM];
+static jmp_buf exit_jump;
+static int exit_status;
+static int running = 0;
+
+static MEMFILE *memfile_find(const char *name)
+{
+  int k;
+  for (k = 0; k < NMEMFILE; ++k) {
+    if (memfiles[k].name != NULL && strcmp(memfiles[k].name, name) == 0)
+      return &memfiles[k];
+  }
+  return NULL;
+} /* memfile_find */
+
+static MEMFILE *memfile_new(const char *name)
+{
+  int k;
+  for (k = 0; k < NMEMFILE; ++k) {
+    if (memfiles[k].name == NULL) {
+      memfiles[k].name = (char *) malloc(strlen(name) + 1);
+      if (memfiles[k].name == NULL) return NULL;
+      strcpy(memfiles[k].name, name);
+      memfiles[k].data = NULL; memfiles[k].len = 0;
+      memfiles[k].writer = NULL;
+      return &memfiles[k];
+    }
+  }
+  return NULL;
+} /* memfile_new */
+
+static FILE *stream_add(FILE *stream, char *copy, MEMFILE *file)
+{
+  int k;
+  if (stream == NULL) {
+    free(copy); return NULL;
+  }
+  for (k = 0; k < NSTREAM; ++k) {
+    if (streams[k].stream == NULL) {
+      streams[k].stream = stream; streams[k].copy = copy;
+      streams[k].file = file;
+      return stream;
+    }
+  }
+  return stream;       /* not tracked: only closed if the program closes it */
+} /* stream_add */
+
+int calpgm_put(const char *name, const char *data, size_t len)
+{                      /* gives the next run file name with contents data */
+  MEMFILE *file;
+  file = memfile_find(name);
+  if (file == NULL) file = memfile_new(name);
+  if (file == NULL) return 1;
+  free(file->data);
+  file->data = (char *) malloc(len + 1);
+  if (file->data == NULL) {
+    file->len = 0; return 1;
+  }
+  memcpy(file->data, data, len); file->data[len] = '\0';
+  file->len = len;
+  return 0;
+} /* calpgm_put */
+
+const char *calpgm_get(const char *name, size_t *len)
+{                      /* contents of file name, NULL if there is none */
+  MEMFILE *file;
+  file = memfile_find(name);
+  if (file == NULL || file->data == NULL) return NULL;
+  *len = file->len;
+  return file->data;
+} /* calpgm_get */
+
+void calpgm_reset(void)
+{                      /* forgets every file */
+  int k;
+  for (k = 0; k < NMEMFILE; ++k) {
+    free(memfiles[k].name); free(memfiles[k].data);
+    memfiles[k].name = NULL; memfiles[k].data = NULL;
+    memfiles[k].len = 0; memfiles[k].writer = NULL;
+  }
+} /* calpgm_reset */
+
+FILE *calpgm_fopen(const char *name, const char *mode)
+{
+  MEMFILE *file;
+  char *copy, *old;
+  size_t oldlen;
+  FILE *stream;
+  if (!running) return fopen(name, mode);
+  file = memfile_find(name);
+  if (mode[0] == 'r') {
+    if (file == NULL || file->data == NULL) /* e.g. sping.nam */
+      return stream_add(fopen(name, mode), NULL, NULL);
+    if (file->len == 0)
+      return stream_add(tmpfile(), NULL, NULL);
+    copy = (char *) malloc(file->len);
+    if (copy == NULL) return NULL;
+    memcpy(copy, file->data, file->len);
+    return stream_add(fmemopen(copy, file->len, "r"), copy, NULL);
+  }
+  if (file == NULL) file = memfile_new(name);
+  if (file == NULL) return NULL;
+  old = file->data; oldlen = file->len;
+  file->data = NULL; file->len = 0;
+  stream = open_memstream(&file->data, &file->len);
+  if (stream != NULL && mode[0] == 'a' && old != NULL)
+    fwrite(old, 1, oldlen, stream);
+  free(old);
+  file->writer = stream;
+  return stream_add(stream, NULL, file);
+} /* calpgm_fopen */
+
+FILE *calpgm_tmpfile(void)
+{
+  if (!running) return tmpfile();
+  return stream_add(tmpfile(), NULL, NULL);
+} /* calpgm_tmpfile */
+
+int calpgm_fclose(FILE *stream)
+{
+  int k, iret;
+  for (k = 0; k < NSTREAM; ++k) {
+    if (streams[k].stream == stream) break;
+  }
+  if (k == NSTREAM) return fclose(stream);
+  if (streams[k].file != NULL) {
+    /* the size of a memstream is its position when closed (SPFIT rewinds the .bak before closing it) */
+    fseek(stream, 0L, SEEK_END);
+    streams[k].file->writer = NULL;
+  }
+  iret = fclose(stream);
+  free(streams[k].copy);
+  streams[k].stream = NULL; streams[k].copy = NULL; streams[k].file = NULL;
+  return iret;
+} /* calpgm_fclose */
+
+void calpgm_exit(int status)
+{
+  if (!running) exit(status);
+  exit_status = status;
+  longjmp(exit_jump, 1);
+} /* calpgm_exit */
+
+int calpgm_run(int spcat, const char *name, int quiet)
+{                      /* runs SPCAT (spcat != 0) or SPFIT on name, returns its exit status */
+  char *argv[3];
+  char prog[8];
+  int k, saved, null;
+  strcpy(prog, spcat ? "spcat" : "spfit");
+  argv[0] = prog; argv[1] = (char *) name; argv[2] = NULL;
+  saved = -1;
+  if (quiet) {         /* the programs print to the screen as they go */
+    fflush(stdout);
+    saved = dup(1);
+    null = open("/dev/null", O_WRONLY);
+    if (null >= 0) {
+      dup2(null, 1); close(null);
+    }
+  }
+  exit_status = 0;
+  running = 1;
+  if (setjmp(exit_jump) == 0) {
+    if (spcat)
+      exit_status = calcat_main(2, argv);
+    else
+      exit_status = calfit_main(2, argv);
+  }
+  for (k = 0; k < NSTREAM; ++k) {
+    if (streams[k].stream != NULL) calpgm_fclose(streams[k].stream);
+  }
+  running = 0;
+  if (saved >= 0) {
+    fflush(stdout);
+    dup2(saved, 1); close(saved);
+  }
+  return exit_status;
+} /* calpgm_run */
@@ -1,12 +1,20 @@
 from easygui import *
 from numpy import *
-f=open('sorted_omc_cat.txt','r')
-fits = []
-for i in range (1000):
-    r=f.readline()
-    fits.append(r)
-    #print fits
-f.close()
+try: # Result store of the run (autofit/windows/triples_store_module.py on the path); the best 1000 by average omc straight from it
+    import triples_store_module
+    results = triples_store_module.load_results()
+except ImportError:
+    results = []
+if len(results) > 0:
+    fits = [triples_store_module.result_line(record) for record in triples_store_module.top_results(results,'avg',1000)]
+else: # Older runs only have the text results
+    f=open('sorted_omc_cat.txt','r')
+    fits = []
+    for i in range (1000):
+        r=f.readline()
+        fits.append(r)
+        #print fits
+    f.close()
 data = ""
 for i in (fits):
     data+= i +''